@@ -17,4 +17,11 @@
 # THE SOFTWARE.
 from __future__ import absolute_import
 
+import sys
+
 from nearpy.engine import Engine
+from nearpy.querycache import QueryCache
+
+# The asyncio API needs Python 3.6 (async generators and comprehensions)
+if sys.version_info >= (3, 6):
+    from nearpy.engine_async import AsyncEngine
@@ -38,3 +38,12 @@ class CosineDistance(Distance):
             x = x.toarray().ravel()
             y = y.toarray().ravel()
         return 1.0 - numpy.dot(x, y)
+
+    def distances(self, X, y):
+        """
+        Computes distance measures between every row of matrix X and
+        vector y. Returns numpy array of floats.
+        """
+        if scipy.sparse.issparse(y):
+            y = y.toarray()
+        return 1.0 - numpy.ravel(X.dot(numpy.ravel(y)))
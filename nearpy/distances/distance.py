@@ -20,6 +20,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import numpy
+
+from nearpy.utils.utils import matrix_rows
+
 
 class Distance(object):
     """ Interface for distance functions. """
@@ -29,3 +33,14 @@ class Distance(object):
         Computes distance measure between vectors x and y. Returns float.
         """
         raise NotImplementedError
+
+    def distances(self, X, y):
+        """
+        Computes distance measures between every row of matrix X (numpy array
+        or scipy.sparse matrix with one vector per row) and vector y.
+        Returns numpy array of floats.
+
+        This default implementation calls distance for every row.
+        Implementations should override it with a vectorized version.
+        """
+        return numpy.array([self.distance(x, y) for x in matrix_rows(X)])
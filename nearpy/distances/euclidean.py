@@ -38,3 +38,19 @@ class EuclideanDistance(Distance):
         else:
             return numpy.linalg.norm(x-y)
 
+    def distances(self, X, y):
+        """
+        Computes distance measures between every row of matrix X and
+        vector y. Returns numpy array of floats.
+        """
+        if scipy.sparse.issparse(y):
+            y = y.toarray()
+        y = numpy.ravel(y)
+        if scipy.sparse.issparse(X):
+            # Use |x-y|^2 = |x|^2 - 2*x.y + |y|^2 to keep X sparse
+            squared = numpy.ravel(X.multiply(X).sum(axis=1)) \
+                - 2.0 * numpy.ravel(X.dot(y)) + numpy.dot(y, y)
+            return numpy.sqrt(numpy.maximum(squared, 0.0))
+        else:
+            return numpy.linalg.norm(X-y, axis=1)
+
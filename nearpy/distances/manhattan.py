@@ -38,3 +38,15 @@ class ManhattanDistance(Distance):
         else:
             return numpy.sum(numpy.absolute(x-y))
 
+    def distances(self, X, y):
+        """
+        Computes the Manhattan distances between every row of matrix X and
+        vector y. Returns numpy array of floats.
+        """
+        if scipy.sparse.issparse(y):
+            y = y.toarray()
+        y = numpy.ravel(y)
+        if scipy.sparse.issparse(X):
+            X = X.toarray()
+        return numpy.sum(numpy.absolute(X-y), axis=1)
+
@@ -20,7 +20,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import collections
+import itertools
 import json
+import multiprocessing
 
 import numpy as np
 
@@ -31,7 +34,26 @@ from nearpy.filters import NearestFilter, UniqueFilter
 from nearpy.distances import EuclideanDistance
 from nearpy.distances import CosineDistance
 from nearpy.storage import MemoryStorage, MongoStorage
-from nearpy.utils.utils import unitvec
+from nearpy.utils.utils import unitvec, unitvecs, matrix_rows, stack_rows
+
+# Hashes of a bulk_load worker process, set by _init_bulk_load_worker
+_worker_lshashes = None
+
+
+def _init_bulk_load_worker(lshashes):
+    """ Keeps the hashes in the worker process for all its chunks. """
+    global _worker_lshashes
+    _worker_lshashes = lshashes
+
+
+def _hash_chunk(V):
+    """
+    Normalizes the rows of V and hashes them with the hashes of the worker
+    process. Returns the normalized rows and the bucket keys of every row
+    for each hash.
+    """
+    return unitvecs(V), [lshash.hash_vectors(V)
+                         for lshash in _worker_lshashes]
 
 
 class Engine(object):
@@ -64,8 +86,15 @@ class Engine(object):
                  distance=None,
                  fetch_vector_filters=None,
                  vector_filters=None,
-                 storage=None):
-        """ Keeps the configuration. """
+                 storage=None,
+                 executor=None,
+                 query_cache=None):
+        """
+        Keeps the configuration. The optional executor (for example a
+        concurrent.futures.ThreadPoolExecutor) is used to hash and fetch
+        the buckets of every hash in parallel when querying. The optional
+        query_cache (a QueryCache) keeps the results of neighbours().
+        """
         if lshashes is None: lshashes = [RandomBinaryProjections('default', 10)]
         self.lshashes = lshashes
         if distance is None: distance = CosineDistance()
@@ -76,6 +105,8 @@ class Engine(object):
         self.fetch_vector_filters = fetch_vector_filters
         if storage is None: storage = MemoryStorage()
         self.storage = storage
+        self.executor = executor
+        self.query_cache = query_cache
 
         # Initialize all hashes for the data space dimension.
         for lshash in self.lshashes:
@@ -89,42 +120,183 @@ class Engine(object):
         """
         # We will store the normalized vector (used during retrieval)
         nv = unitvec(v)
-        # Store vector in each bucket of all hashes
-        for lshash in self.lshashes:
-            for bucket_key in lshash.hash_vector(v):
-                #print 'Storying in bucket %s one vector' % bucket_key
-                self.storage.store_vector(lshash.hash_name, bucket_key,
-                                          nv, data)
+        # Store vector in each bucket of all hashes, in one go so that
+        # storages can keep the vector itself only once
+        postings = self._vector_postings(v)
+        self.storage.store_postings(postings, [nv], [data])
+        self._invalidate_results(postings)
+
+    def _vector_postings(self, v):
+        """
+        Returns list of (hash_name, bucket_key, 0) for all bucket keys of v.
+        """
+        return [(lshash.hash_name, bucket_key, 0)
+                for lshash in self.lshashes
+                for bucket_key in lshash.hash_vector(v)]
 
     def store_many_vectors(self, vs, data=None):
         """
         Store a batch of vectors.
         Hashes vector vs and stores them in all matching buckets in the storage.
-        The data argument must be either None or a list of JSON-serializable
-        object. It is stored with the vector and will be returned in search
-        results.
+        The vs argument is either a list of vectors or a matrix with one
+        vector per row. The data argument must be either None or a list of
+        JSON-serializable object. It is stored with the vector and will be
+        returned in search results.
         """
-        # We will store the normalized vector (used during retrieval)
-        nvs = [unitvec(i) for i in vs]
-        # Store vector in each bucket of all hashes
+        V = stack_rows(vs)
+        # We will store the normalized vectors (used during retrieval)
+        NV = unitvecs(V)
+        # Let the storage write the whole batch at once
+        postings = self._matrix_postings(V)
+        self.storage.store_postings(postings, NV, data)
+        self._invalidate_results(postings)
+
+    def _matrix_postings(self, V):
+        """
+        Returns list of (hash_name, bucket_key, row) for every bucket key
+        of every row of V and every hash.
+        """
+        postings = []
         for lshash in self.lshashes:
-            bucket_keys = [lshash.hash_vector(i)[0] for i in vs]
-            self.storage.store_many_vectors(lshash.hash_name, bucket_keys,
-                                            nvs, data)
+            for row, bucket_keys in enumerate(lshash.hash_vectors(V)):
+                postings.extend((lshash.hash_name, bucket_key, row)
+                                for bucket_key in bucket_keys)
+        return postings
+
+    def bulk_load(self, vs, data=None, workers=None, chunk_size=10000):
+        """
+        Stores a large number of vectors using a pool of worker processes.
+        vs is a matrix with one vector per row or any iterable of vectors,
+        data is either None or an iterable with one JSON-serializable
+        object per vector.
+
+        The vectors are split into chunks of chunk_size rows, which are
+        normalized and hashed in parallel by worker processes (by default
+        one per CPU). The main process writes the postings of every chunk
+        to the storage with one call of store_postings. Hashes which set
+        updates_on_indexing are evaluated in the main process.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        pool_hashes, local_hashes = self._bulk_load_hashes()
+        chunks = self._bulk_load_chunks(vs, data, chunk_size)
+
+        if workers <= 1:
+            for V, chunk_data in chunks:
+                self._store_chunk(V, chunk_data, [], self.lshashes,
+                                  (unitvecs(V), []))
+            return
+
+        pool = multiprocessing.Pool(workers, _init_bulk_load_worker,
+                                    (pool_hashes,))
+        try:
+            # Keep only a few chunks per worker in flight, so that the
+            # input is not read into memory at once
+            pending = collections.deque()
+            for V, chunk_data in chunks:
+                pending.append((V, chunk_data,
+                                pool.apply_async(_hash_chunk, (V,))))
+                if len(pending) >= 2 * workers:
+                    V, chunk_data, result = pending.popleft()
+                    self._store_chunk(V, chunk_data, pool_hashes,
+                                      local_hashes, result.get())
+            while pending:
+                V, chunk_data, result = pending.popleft()
+                self._store_chunk(V, chunk_data, pool_hashes, local_hashes,
+                                  result.get())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _bulk_load_hashes(self):
+        """
+        Returns the list of hashes the worker processes evaluate and the
+        list of hashes that update on indexing and run in the main process.
+        """
+        return ([lshash for lshash in self.lshashes
+                 if not lshash.updates_on_indexing],
+                [lshash for lshash in self.lshashes
+                 if lshash.updates_on_indexing])
+
+    def _bulk_load_chunks(self, vs, data, chunk_size):
+        """
+        Yields tuples (V, data) with a matrix of at most chunk_size rows
+        and the list of their data (or None).
+        """
+        if data is not None:
+            data = iter(data)
+        if hasattr(vs, 'shape'):
+            # Slicing matrices (and memory-mapped arrays) avoids copying
+            # them row by row
+            for start in range(0, vs.shape[0], chunk_size):
+                V = vs[start:start + chunk_size]
+                yield V, (list(itertools.islice(data, V.shape[0]))
+                          if data is not None else None)
+            return
+        vs = iter(vs)
+        while True:
+            chunk = list(itertools.islice(vs, chunk_size))
+            if not chunk:
+                return
+            yield stack_rows(chunk), (list(itertools.islice(data, len(chunk)))
+                                      if data is not None else None)
+
+    def _store_chunk(self, V, data, pool_hashes, local_hashes, hashed):
+        """ Writes a chunk hashed by _hash_chunk to the storage. """
+        postings = self._chunk_postings(V, pool_hashes, local_hashes, hashed)
+        self.storage.store_postings(postings, hashed[0], data)
+        self._invalidate_results(postings)
+
+    def _chunk_postings(self, V, pool_hashes, local_hashes, hashed):
+        """
+        Returns the postings of a chunk hashed by _hash_chunk, after
+        hashing it with the hashes that have to run in the main process.
+        """
+        hash_keys = hashed[1] + [lshash.hash_vectors(V)
+                                 for lshash in local_hashes]
+        postings = []
+        for lshash, keys in zip(pool_hashes + local_hashes, hash_keys):
+            for row, bucket_keys in enumerate(keys):
+                postings.extend((lshash.hash_name, bucket_key, row)
+                                for bucket_key in bucket_keys)
+        return postings
+
+    def _invalidate_results(self, postings):
+        """
+        Removes cached query results using the buckets of the postings.
+        """
+        if self.query_cache is None:
+            return
+        if any(lshash.updates_on_indexing for lshash in self.lshashes):
+            # The buckets used for a query may have changed as well
+            self.query_cache.clear()
+        else:
+            self.query_cache.invalidate((hash_name, bucket_key) for
+                                        hash_name, bucket_key, _ in postings)
 
     def delete_vector(self, data, v=None):
         """
         Deletes vector v and his id (data) in all matching buckets in the storage.
         The data argument must be JSON-serializable.
+
+        Without v, the buckets are looked up in the reverse index of the
+        storage, if it keeps one, otherwise all buckets are searched.
         """
 
         # Delete data id in each hashes
         for lshash in self.lshashes:
             if v is None:
-                keys = self.storage.get_all_bucket_keys(lshash.hash_name)
+                keys = self.storage.get_data_bucket_keys(lshash.hash_name,
+                                                         data)
+                if keys is None:
+                    keys = self.storage.get_all_bucket_keys(lshash.hash_name)
             else:
                 keys = lshash.hash_vector(v)
+            keys = list(keys)
             self.storage.delete_vector(lshash.hash_name, keys, data)
+            if self.query_cache is not None:
+                self.query_cache.invalidate((lshash.hash_name, key)
+                                            for key in keys)
 
     def candidate_count(self, v):
         """
@@ -152,12 +324,50 @@ class Engine(object):
         buckets in storage, applys the (optional) distance function and
         finally the (optional) filter function to construct the returned list
         of either (vector, data, distance) tuples or (vector, data) tuples.
+
+        If the engine has a query cache and no distance or filters are
+        specified, cached results are returned for repeated queries.
         """
+        use_cache = (self.query_cache is not None and distance is None and
+                     fetch_vector_filters is None and vector_filters is None)
+        if use_cache:
+            cache_key = self.query_cache.query_key(v)
+            result = self.query_cache.get(cache_key)
+            if result is not None:
+                return result
 
         # Collect candidates from all buckets from all hashes
-        candidates = self._get_candidates(v)
+        candidates, bucket_keys = self._fetch_candidates(v)
         # print 'Candidate count is %d' % len(candidates)
 
+        result = self._filter_candidates(v, candidates, distance,
+                                         fetch_vector_filters, vector_filters)
+        if use_cache:
+            self.query_cache.put(cache_key, result, bucket_keys)
+        return result
+
+    def neighbours_many(self, Q,
+                        distance=None,
+                        fetch_vector_filters=None,
+                        vector_filters=None):
+        """
+        Batch version of neighbours(). Q is a numpy array or scipy.sparse
+        matrix with one query vector per row. All queries are hashed at once
+        and every bucket is fetched only once, even if it matches several
+        queries. Returns one result list (see neighbours()) per row of Q.
+        """
+
+        # Collect candidates for all queries
+        candidates = self._get_candidates_many(Q)
+
+        return [self._filter_candidates(v, query_candidates, distance,
+                                        fetch_vector_filters, vector_filters)
+                for v, query_candidates in zip(matrix_rows(Q), candidates)]
+
+    def _filter_candidates(self, v, candidates, distance,
+                           fetch_vector_filters, vector_filters):
+        """ Applies filters and distance to candidates of query vector v """
+
         # Apply fetch vector filters if specified and return filtered list
         if fetch_vector_filters:
             candidates = self._apply_filter(fetch_vector_filters,
@@ -166,28 +376,118 @@ class Engine(object):
         # Apply distance implementation if specified
         if not distance:
             distance = self.distance
-        candidates = self._append_distances(v, distance, candidates)
-
-        # Apply vector filters if specified and return filtered list
         if not vector_filters:
             vector_filters = self.vector_filters
+        if distance and candidates:
+            candidates, vector_filters = self._append_distances(
+                v, distance, candidates, vector_filters)
+
+        # Apply vector filters if specified and return filtered list
         candidates = self._apply_filter(vector_filters, candidates)
 
         # If there is no vector filter, just return list of candidates
         return candidates
 
-
     def _get_candidates(self, v):
-        """ Collect candidates from all buckets from all hashes """
+        """
+        Collect candidates from all buckets from all hashes. All buckets
+        are fetched from storage with one call, or with one call per hash
+        in parallel if the engine has an executor.
+        """
+        return self._fetch_candidates(v)[0]
+
+    def _fetch_candidates(self, v):
+        """
+        Returns the candidates of v (see _get_candidates) and the list of
+        (hash_name, bucket_key) tuples of the buckets they come from.
+        """
+        if self.executor is not None:
+            return self._fetch_candidates_parallel(v)
+        bucket_keys = [(lshash.hash_name, bucket_key)
+                       for lshash in self.lshashes
+                       for bucket_key in lshash.hash_vector(v, querying=True)]
+        if self.storage.store_vectors_once:
+            return self._get_candidates_by_id(bucket_keys), bucket_keys
         candidates = []
+        for bucket_content in self.storage.get_buckets(bucket_keys):
+            candidates.extend(bucket_content)
+        return candidates, bucket_keys
+
+    def _fetch_candidates_parallel(self, v):
+        """
+        Hashes v and fetches the buckets with one executor task per hash,
+        so that hashing and waiting for the storage overlap.
+        """
+        if self.storage.store_vectors_once:
+            fetch = self.storage.get_buckets_ids
+        else:
+            fetch = self.storage.get_buckets
+
+        def hash_and_fetch(lshash):
+            bucket_keys = [(lshash.hash_name, bucket_key) for bucket_key
+                           in lshash.hash_vector(v, querying=True)]
+            return bucket_keys, fetch(bucket_keys)
+
+        futures = [self.executor.submit(hash_and_fetch, lshash)
+                   for lshash in self.lshashes]
+        bucket_keys, buckets = [], []
+        for future in futures:
+            hash_bucket_keys, hash_buckets = future.result()
+            bucket_keys.extend(hash_bucket_keys)
+            buckets.extend(hash_buckets)
+
+        if self.storage.store_vectors_once:
+            return self._get_vectors_once(buckets), bucket_keys
+        candidates = []
+        for bucket_content in buckets:
+            candidates.extend(bucket_content)
+        return candidates, bucket_keys
+
+    def _get_candidates_by_id(self, bucket_keys):
+        """
+        Collect ids from the specified buckets and fetch the candidates in
+        one bulk request. Vectors found in several buckets are fetched only
+        once.
+        """
+        return self._get_vectors_once(self.storage.get_buckets_ids(bucket_keys))
+
+    def _get_vectors_once(self, ids):
+        """
+        Fetches the vectors of the list of id arrays, each of them once.
+        """
+        if not ids:
+            return []
+        return self.storage.get_vectors(np.unique(np.concatenate(ids)))
+
+    def _get_candidates_many(self, Q):
+        """
+        Collect candidates for all rows of Q. Queries sharing a bucket key
+        are grouped so that each bucket is fetched only once, and all
+        buckets are fetched from storage with one call. With storages that
+        store vectors once, the vectors of each query are fetched by their
+        unique ids, like in neighbours().
+        """
+        queries_by_bucket = {}
         for lshash in self.lshashes:
-            for bucket_key in lshash.hash_vector(v, querying=True):
-                bucket_content = self.storage.get_bucket(
-                    lshash.hash_name,
-                    bucket_key,
-                )
-                #print 'Bucket %s size %d' % (bucket_key, len(bucket_content))
-                candidates.extend(bucket_content)
+            for row, bucket_keys in enumerate(
+                    lshash.hash_vectors(Q, querying=True)):
+                for bucket_key in bucket_keys:
+                    queries_by_bucket.setdefault(
+                        (lshash.hash_name, bucket_key), []).append(row)
+        bucket_keys = list(queries_by_bucket.keys())
+        if self.storage.store_vectors_once:
+            # Every query fetches the vectors of its ids once
+            query_ids = [[] for _ in range(Q.shape[0])]
+            for bucket_key, ids in zip(
+                    bucket_keys, self.storage.get_buckets_ids(bucket_keys)):
+                for row in queries_by_bucket[bucket_key]:
+                    query_ids[row].append(ids)
+            return [self._get_vectors_once(ids) for ids in query_ids]
+        candidates = [[] for _ in range(Q.shape[0])]
+        for bucket_key, bucket_content in zip(
+                bucket_keys, self.storage.get_buckets(bucket_keys)):
+            for row in queries_by_bucket[bucket_key]:
+                candidates[row].extend(bucket_content)
         return candidates
 
 
@@ -202,20 +502,50 @@ class Engine(object):
         else:
             return candidates
 
-    def _append_distances(self, v, distance, candidates):
-        """ Apply distance implementation if specified """
-        if distance:
-            # Normalize vector (stored vectors are normalized)
-            nv = unitvec(v)
-            candidates = [(x[0], x[1], self.distance.distance(x[0], nv)) for x
-                            in candidates]
-
-        return candidates
+    def _append_distances(self, v, distance, candidates, vector_filters):
+        """
+        Apply distance implementation to non-empty candidate list. The
+        leading vector filters that only need the distances are applied to
+        the distance array already, so that only their result is turned
+        into (vector, data, distance) tuples. Returns these tuples and the
+        vector filters still to apply.
+        """
+        # Normalize vector (stored vectors are normalized)
+        nv = unitvec(v)
+        # Score all candidates at once
+        distances = np.asarray(distance.distances(
+            stack_rows([x[0] for x in candidates]), nv))
+
+        indices = np.arange(len(candidates))
+        vector_filters = list(vector_filters or [])
+        while vector_filters:
+            selected = vector_filters[0].filter_distances(distances[indices])
+            if selected is None:
+                break
+            indices = indices[selected]
+            vector_filters.pop(0)
+
+        candidates = [(candidates[index][0], candidates[index][1],
+                       distances[index]) for index in indices]
+        return candidates, vector_filters
+
+    def compact(self, threshold=0.5):
+        """
+        Removes deleted vectors from the buckets of the storage in which
+        they make up at least threshold of the content, if the storage
+        records deletes as tombstones. It may be called periodically, for
+        example from a background thread.
+        """
+        self.storage.compact(threshold)
 
     def clean_all_buckets(self):
         """ Clears buckets in storage (removes all vectors and their data). """
         self.storage.clean_all_buckets()
+        if self.query_cache is not None:
+            self.query_cache.clear()
 
     def clean_buckets(self, hash_name):
         """ Clears buckets in storage (removes all vectors and their data). """
         self.storage.clean_buckets(hash_name)
+        if self.query_cache is not None:
+            self.query_cache.clear()
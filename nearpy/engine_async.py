@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+import collections
+import concurrent.futures
+import multiprocessing
+
+import numpy as np
+
+from nearpy.engine import Engine, _init_bulk_load_worker, _hash_chunk
+from nearpy.utils.utils import unitvec, unitvecs, matrix_rows, stack_rows
+
+
+class AsyncEngine(Engine):
+    """
+    Engine for asyncio applications. It is configured like Engine, but the
+    storage must be asynchronous (AsyncRedisStorage or AsyncMongoStorage)
+    and the methods storing, deleting and querying vectors are coroutines.
+
+    The buckets of every hash are fetched concurrently, so that one event
+    loop can keep many queries in flight. Hashing, distances and filters
+    run in the event loop, like in Engine.
+    """
+
+    def __init__(self, dim, lshashes=None,
+                 distance=None,
+                 fetch_vector_filters=None,
+                 vector_filters=None,
+                 storage=None):
+        """ Keeps the configuration. """
+        if storage is None:
+            raise ValueError('AsyncEngine needs an asynchronous storage')
+        super(AsyncEngine, self).__init__(
+            dim, lshashes=lshashes, distance=distance,
+            fetch_vector_filters=fetch_vector_filters,
+            vector_filters=vector_filters, storage=storage)
+
+    async def store_vector(self, v, data=None):
+        """
+        Hashes vector v and stores it in all matching buckets in the storage.
+        The data argument must be JSON-serializable. It is stored with the
+        vector and will be returned in search results.
+        """
+        await self.storage.store_postings(self._vector_postings(v),
+                                          [unitvec(v)], [data])
+
+    async def store_many_vectors(self, vs, data=None):
+        """
+        Store a batch of vectors, see Engine.store_many_vectors.
+        """
+        V = stack_rows(vs)
+        await self.storage.store_postings(self._matrix_postings(V),
+                                          unitvecs(V), data)
+
+    async def bulk_load(self, vs, data=None, workers=None, chunk_size=10000):
+        """
+        Stores a large number of vectors, see Engine.bulk_load. The chunks
+        are hashed by a pool of worker processes while the event loop
+        waits for the writes of earlier chunks.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        pool_hashes, local_hashes = self._bulk_load_hashes()
+        chunks = self._bulk_load_chunks(vs, data, chunk_size)
+
+        if workers <= 1:
+            for V, chunk_data in chunks:
+                await self._store_chunk(V, chunk_data, [], self.lshashes,
+                                        (unitvecs(V), []))
+            return
+
+        loop = asyncio.get_event_loop()
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_init_bulk_load_worker,
+                initargs=(pool_hashes,)) as pool:
+            # Keep only a few chunks per worker in flight, so that the
+            # input is not read into memory at once
+            pending = collections.deque()
+            for V, chunk_data in chunks:
+                pending.append((V, chunk_data,
+                                loop.run_in_executor(pool, _hash_chunk, V)))
+                if len(pending) >= 2 * workers:
+                    V, chunk_data, hashed = pending.popleft()
+                    await self._store_chunk(V, chunk_data, pool_hashes,
+                                            local_hashes, await hashed)
+            while pending:
+                V, chunk_data, hashed = pending.popleft()
+                await self._store_chunk(V, chunk_data, pool_hashes,
+                                        local_hashes, await hashed)
+
+    async def _store_chunk(self, V, data, pool_hashes, local_hashes, hashed):
+        """
+        Writes a chunk hashed by _hash_chunk to the storage, see
+        Engine._store_chunk.
+        """
+        postings = self._chunk_postings(V, pool_hashes, local_hashes, hashed)
+        await self.storage.store_postings(postings, hashed[0], data)
+        self._invalidate_results(postings)
+
+    async def delete_vector(self, data, v=None):
+        """
+        Deletes vector v and his id (data) in all matching buckets in the storage.
+        The data argument must be JSON-serializable.
+        """
+        for lshash in self.lshashes:
+            if v is None:
+                keys = await self.storage.get_data_bucket_keys(
+                    lshash.hash_name, data)
+                if keys is None:
+                    keys = await self.storage.get_all_bucket_keys(
+                        lshash.hash_name)
+            else:
+                keys = lshash.hash_vector(v)
+            await self.storage.delete_vector(lshash.hash_name, keys, data)
+
+    async def candidate_count(self, v):
+        """
+        Returns candidate count for nearest neighbour search for specified
+        vector, see Engine.candidate_count.
+        """
+        return len(await self._get_candidates(v))
+
+    async def neighbours(self, v,
+                         distance=None,
+                         fetch_vector_filters=None,
+                         vector_filters=None):
+        """
+        Hashes vector v, collects all candidate vectors from the matching
+        buckets in storage, applys the (optional) distance function and
+        finally the (optional) filter function to construct the returned list
+        of either (vector, data, distance) tuples or (vector, data) tuples.
+        """
+        candidates = await self._get_candidates(v)
+        return self._filter_candidates(v, candidates, distance,
+                                       fetch_vector_filters, vector_filters)
+
+    async def neighbours_many(self, Q,
+                              distance=None,
+                              fetch_vector_filters=None,
+                              vector_filters=None):
+        """
+        Batch version of neighbours(). Q is a numpy array or scipy.sparse
+        matrix with one query vector per row. All queries run concurrently,
+        returns one result list per row of Q.
+        """
+        return await asyncio.gather(*(
+            self.neighbours(v, distance, fetch_vector_filters, vector_filters)
+            for v in matrix_rows(Q)))
+
+    async def _get_candidates(self, v):
+        """
+        Collect candidates from all buckets from all hashes. The buckets of
+        every hash are fetched concurrently.
+        """
+        hash_bucket_keys = [[(lshash.hash_name, bucket_key) for bucket_key
+                             in lshash.hash_vector(v, querying=True)]
+                            for lshash in self.lshashes]
+        if self.storage.store_vectors_once:
+            hash_ids = await asyncio.gather(*(
+                self.storage.get_buckets_ids(bucket_keys)
+                for bucket_keys in hash_bucket_keys))
+            ids = [bucket_ids for ids in hash_ids for bucket_ids in ids]
+            if not ids:
+                return []
+            return await self.storage.get_vectors(
+                np.unique(np.concatenate(ids)))
+        hash_buckets = await asyncio.gather(*(
+            self.storage.get_buckets(bucket_keys)
+            for bucket_keys in hash_bucket_keys))
+        return [candidate for buckets in hash_buckets
+                for bucket_content in buckets
+                for candidate in bucket_content]
+
+    async def compact(self, threshold=0.5):
+        """
+        Removes deleted vectors from the buckets of the storage in which
+        they make up at least threshold of the content.
+        """
+        await self.storage.compact(threshold)
+
+    async def clean_all_buckets(self):
+        """ Clears buckets in storage (removes all vectors and their data). """
+        await self.storage.clean_all_buckets()
+
+    async def clean_buckets(self, hash_name):
+        """ Clears buckets in storage (removes all vectors and their data). """
+        await self.storage.clean_buckets(hash_name)
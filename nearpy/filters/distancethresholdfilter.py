@@ -20,6 +20,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import numpy
+
 from nearpy.filters.vectorfilter import VectorFilter
 
 
@@ -45,3 +47,9 @@ class DistanceThresholdFilter(VectorFilter):
         except:
             # Otherwise just return input list
             return input_list
+
+    def filter_distances(self, distances):
+        """
+        Returns indices of the distances below the threshold.
+        """
+        return numpy.flatnonzero(distances < self.distance_threshold)
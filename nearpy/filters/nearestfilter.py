@@ -20,6 +20,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import heapq
+import numpy
+
 from nearpy.filters.vectorfilter import VectorFilter
 
 
@@ -38,11 +41,19 @@ class NearestFilter(VectorFilter):
         """
         Returns subset of specified input list.
         """
-        try:
-            # Return filtered (vector, data, distance )tuple list. Will fail
-            # if input is list of (vector, data) tuples.
-            sorted_list = sorted(input_list, key=lambda x: x[2])
-            return sorted_list[:self.N]
-        except:
-            # Otherwise just return input list
+        if not input_list or len(input_list[0]) < 3:
+            # Input is list of (vector, data) tuples, return it unchanged
             return input_list
+        return heapq.nsmallest(self.N, input_list, key=lambda x: x[2])
+
+    def filter_distances(self, distances):
+        """
+        Returns indices of the N smallest distances, sorted by distance.
+        """
+        if self.N < len(distances):
+            indices = numpy.argpartition(distances, max(self.N - 1, 0))
+            indices = indices[:self.N]
+        else:
+            indices = numpy.arange(len(distances))
+        # Sort by distance, ties by position like filter_vectors does
+        return indices[numpy.lexsort((indices, distances[indices]))]
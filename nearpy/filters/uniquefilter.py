@@ -24,6 +24,7 @@ from __future__ import print_function
 import numpy
 
 from nearpy.filters.vectorfilter import VectorFilter
+from nearpy.utils.utils import data_key
 
 
 class UniqueFilter(VectorFilter):
@@ -36,7 +37,9 @@ class UniqueFilter(VectorFilter):
     other feature for uniqueness, you can implement your own filter.
 
     You only need a uniqueness filter if your hash-configuration makes it
-    possible that one vector is saved in many buckets.
+    possible that one vector is saved in many buckets. Storages with
+    store_vectors_once set do not need it, the engine drops duplicate
+    candidates by their ids already.
     """
 
     def __init__(self):
@@ -48,5 +51,6 @@ class UniqueFilter(VectorFilter):
         """
         unique_dict = {}
         for v in input_list:
-            unique_dict[v[1]] = v
+            # Unhashable data like dicts is keyed by its JSON representation
+            unique_dict[data_key(v[1])] = v
         return list(unique_dict.values())
@@ -54,3 +54,14 @@ class VectorFilter(object):
         Returns subset of specified input list.
         """
         raise NotImplementedError
+
+    def filter_distances(self, distances):
+        """
+        Returns indices of the entries of the specified numpy array of
+        candidate distances, that filter_vectors would return (in the same
+        order), or None if the filter needs more than the distances.
+
+        The engine uses this for the filters at the start of the chain, so
+        that only the remaining candidates are turned into tuples.
+        """
+        return None
@@ -20,9 +20,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+from nearpy.utils.utils import matrix_rows
+
 
 class LSHash(object):
-    """ Interface for locality-sensitive hashes. """
+    """
+    Interface for locality-sensitive hashes.
+
+    Hashes that learn from the vectors they index (for example to answer
+    queries from the set of occupied buckets) set updates_on_indexing.
+    Engine.bulk_load hashes with them in the main process only.
+    """
+
+    updates_on_indexing = False
 
     def __init__(self, hash_name):
         """
@@ -44,6 +54,18 @@ class LSHash(object):
         """
         raise NotImplementedError
 
+    def hash_vectors(self, V, querying=False):
+        """
+        Hashes all rows of matrix V (numpy array or scipy.sparse matrix with
+        one vector per row) and returns a list containing the list of bucket
+        keys for each row.
+
+        This default implementation just calls hash_vector for every row.
+        Hashes that can compute the keys for the whole batch at once should
+        override it.
+        """
+        return [self.hash_vector(v, querying) for v in matrix_rows(V)]
+
     def get_config(self):
         """
         Returns pickle-serializable configuration struct for storage.
@@ -27,6 +27,7 @@ import scipy.sparse
 from nearpy.hashes.lshash import LSHash
 
 from nearpy.utils import numpy_array_from_list_or_numpy_array, perform_pca
+from nearpy.utils.utils import binary_keys
 
 
 class PCABinaryProjections(LSHash):
@@ -38,16 +39,21 @@ class PCABinaryProjections(LSHash):
     used as a bucket key for storage.
     """
 
-    def __init__(self, hash_name, projection_count, training_set):
+    def __init__(self, hash_name, projection_count, training_set,
+                 packed_keys=False):
         """
         Computes principal components for training vector set. Uses
         first projection_count principal components for projections.
 
         Training set must be either a numpy matrix or a list of
         numpy vectors.
+
+        If packed_keys is True, the bits are packed into integer bucket keys
+        instead of strings.
         """
         super(PCABinaryProjections, self).__init__(hash_name)
         self.projection_count = projection_count
+        self.packed_keys = packed_keys
 
         # Only do training if training set was specified
         if not training_set is None:
@@ -108,7 +114,17 @@ class PCABinaryProjections(LSHash):
             # Project vector onto all hyperplane normals
             projection = numpy.dot(self.components, v)
         # Return binary key
-        return [''.join(['1' if x > 0.0 else '0' for x in projection])]
+        return binary_keys(projection.T, self.packed_keys)
+
+    def hash_vectors(self, V, querying=False):
+        """
+        Hashes all rows of V with one matrix product and returns the list
+        of binary bucket keys for each row.
+        """
+        # Project all vectors onto all components (one row per vector)
+        projections = V.dot(self.components.T)
+        # Return binary key for each row
+        return [[key] for key in binary_keys(projections, self.packed_keys)]
 
     def get_config(self):
         """
@@ -119,7 +135,8 @@ class PCABinaryProjections(LSHash):
             'hash_name': self.hash_name,
             'dim': self.dim,
             'projection_count': self.projection_count,
-            'components': self.components
+            'components': self.components,
+            'packed_keys': self.packed_keys
         }
 
     def apply_config(self, config):
@@ -130,5 +147,6 @@ class PCABinaryProjections(LSHash):
         self.dim = config['dim']
         self.projection_count = config['projection_count']
         self.components = config['components']
+        self.packed_keys = config.get('packed_keys', False)
 
 
@@ -25,6 +25,7 @@ import scipy
 import scipy.sparse
 
 from nearpy.hashes.lshash import LSHash
+from nearpy.utils.utils import discretized_keys, discretized_probes
 
 from nearpy.utils import numpy_array_from_list_or_numpy_array, perform_pca
 
@@ -35,16 +36,22 @@ class PCADiscretizedProjections(LSHash):
     a discrete value to each projection depending on the bin.
     """
 
-    def __init__(self, hash_name, projection_count, training_set, bin_width):
+    def __init__(self, hash_name, projection_count, training_set, bin_width,
+                 probe_count=1):
         """
         Computes principal components for training vector set. Uses
         first projection_count principal components for projections.
 
         Training set must be either a numpy matrix or a list of
         numpy vectors.
+
+        If probe_count is larger than 1, querying returns that many bucket
+        keys, the bin of the vector followed by the nearest neighbouring
+        bins (see RandomDiscretizedProjections).
         """
         super(PCADiscretizedProjections, self).__init__(hash_name)
         self.projection_count = projection_count
+        self.probe_count = probe_count
         self.bin_width = bin_width
 
         # Only do training if training set was specified
@@ -98,13 +105,29 @@ class PCADiscretizedProjections(LSHash):
             if not scipy.sparse.isspmatrix_csr(v):
                 v = scipy.sparse.csr_matrix(v)
             # Project vector onto all hyperplane normals
-            projection = (self.components_csr.dot(v) / self.bin_width).floor().toarray()
+            projection = (self.components_csr.dot(v) / self.bin_width).toarray()
         else:
             # Project vector onto components
-            projection = numpy.dot(self.components, v)
-            projection = numpy.floor(projection / self.bin_width)
+            projection = numpy.dot(self.components, v) / self.bin_width
+        if querying and self.probe_count > 1:
+            return discretized_keys(discretized_probes(
+                numpy.ravel(projection), self.probe_count))
         # Return key
-        return ['_'.join([str(int(x)) for x in projection])]
+        return discretized_keys(numpy.floor(projection).T)
+
+    def hash_vectors(self, V, querying=False):
+        """
+        Hashes all rows of V with one matrix product and returns the list
+        of bucket keys for each row.
+        """
+        # Project all vectors (one row per vector)
+        projections = numpy.asarray(V.dot(self.components.T)) / self.bin_width
+        if querying and self.probe_count > 1:
+            return [discretized_keys(discretized_probes(projection,
+                                                        self.probe_count))
+                    for projection in projections]
+        # Return key for each row, using the bin indices
+        return [[key] for key in discretized_keys(numpy.floor(projections))]
 
     def get_config(self):
         """
@@ -116,7 +139,8 @@ class PCADiscretizedProjections(LSHash):
             'dim': self.dim,
             'bin_width': self.bin_width,
             'projection_count': self.projection_count,
-            'components': self.components
+            'components': self.components,
+            'probe_count': self.probe_count
         }
 
     def apply_config(self, config):
@@ -128,5 +152,6 @@ class PCADiscretizedProjections(LSHash):
         self.bin_width = config['bin_width']
         self.projection_count = config['projection_count']
         self.components = config['components']
+        self.probe_count = config.get('probe_count', 1)
 
 
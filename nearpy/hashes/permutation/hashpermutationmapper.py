@@ -20,15 +20,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import itertools
+
 import numpy
+from scipy.special import comb
 
 from nearpy.hashes import LSHash, RandomBinaryProjections, PCABinaryProjections, RandomBinaryProjectionTree
 
 
 class HashPermutationMapper(LSHash):
     """
-    This meta-hash performs permutations on binary bucket keys
-    and keeps a dictionary for this mapping.
+    This meta-hash maps binary bucket keys to the keys of all non-empty
+    buckets within a Hamming distance of radius (two by default).
 
     You use this just like every other LSHash implementation and
     add the actual binary hashes you want to use via the add_child_hash
@@ -39,31 +42,63 @@ class HashPermutationMapper(LSHash):
     1. Create HashPermutationMapper instance and use it in the Engine constructor
     2. Add your binary hashes as child hashes by calling add_child_hash()
     3. Store your vectors using the Engine
-    4. Now when you query the bucket key map is used
+    4. Now when you query the keys of the neighbouring buckets are used
+
+    For every child hash the set of occupied bucket keys is kept as
+    integers. When querying, the query key and all keys with up to radius
+    bits flipped are enumerated and looked up in this set, or the set is
+    scanned if it is smaller than this Hamming ball.
     """
 
-    def __init__(self, hash_name):
-        """ Just keeps the name. """
+    updates_on_indexing = True
+
+    def __init__(self, hash_name, radius=2):
+        """
+        Keeps the name and the Hamming radius of the neighbour buckets.
+        """
         super(HashPermutationMapper, self).__init__(hash_name)
+        self.radius = radius
         self.child_hashes = []
         self.dim = None
-        self.bucket_key_map = {}
+        self.occupied_keys = {}
 
     def reset(self, dim):
         """ Resets / Initializes the hash for the specified dimension. """
         self.dim = dim
-        self.bucket_key_map = {}
+        self.occupied_keys = {}
         # Reset all child hashes
         for child_hash in self.child_hashes:
             child_hash.reset(dim)
 
-    def permuted_keys(self, key):
-        result = []
-        for j in range(len(key)):
-            bits = list(key)
-            bits[j] = '1' if key[j]=='0' else '0'
-            result.append(''.join(bits))
-        return result
+    def neighbour_keys(self, lshash, bucket_key):
+        """
+        Returns the occupied bucket keys of the child hash that have a
+        Hamming distance of at most radius to bucket_key, ordered by that
+        distance, in the key format of the child hash.
+        """
+        occupied_keys = self.occupied_keys.get(lshash.hash_name, ())
+        key = bucket_key if lshash.packed_keys else int(bucket_key, 2)
+        bits = lshash.projection_count
+        radius = min(self.radius, bits)
+        ball_size = sum(comb(bits, r, exact=True) for r in range(radius + 1))
+        if len(occupied_keys) < ball_size:
+            distances = [(bin(occupied ^ key).count('1'), occupied)
+                         for occupied in occupied_keys]
+            neighbours = [occupied for distance, occupied in sorted(distances)
+                          if distance <= radius]
+        else:
+            neighbours = []
+            for r in range(radius + 1):
+                for flipped in itertools.combinations(range(bits), r):
+                    variant = key
+                    for bit in flipped:
+                        variant ^= 1 << bit
+                    if variant in occupied_keys:
+                        neighbours.append(variant)
+        if lshash.packed_keys:
+            return neighbours
+        key_format = '0{}b'.format(lshash.projection_count)
+        return [format(neighbour, key_format) for neighbour in neighbours]
 
     def hash_vector(self, v, querying=False):
         """
@@ -71,43 +106,43 @@ class HashPermutationMapper(LSHash):
         """
 
         bucket_keys = []
+        for lshash in self.child_hashes:
+            bucket_keys.extend(self._map_keys(
+                lshash, lshash.hash_vector(v, querying), querying))
+        # Return all the bucket keys
+        return bucket_keys
 
+    def hash_vectors(self, V, querying=False):
+        """
+        Hashes all rows of V with the batch method of every child hash.
+        """
+        result = [[] for _ in range(V.shape[0])]
+        for lshash in self.child_hashes:
+            for bucket_keys, child_keys in zip(
+                    result, lshash.hash_vectors(V, querying)):
+                bucket_keys.extend(self._map_keys(lshash, child_keys,
+                                                  querying))
+        return result
+
+    def _map_keys(self, lshash, child_keys, querying):
+        """
+        Returns the prefixed bucket keys for the keys of one child hash.
+        If we are querying these are the keys of the occupied neighbour
+        buckets, if we are indexing (storing) the keys are registered as
+        occupied and returned as they are.
+        """
         if querying:
-            # If we are querying, use the bucket key map
-            for lshash in self.child_hashes:
-                # Get regular bucket keys from hash
-                for bucket_key in lshash.hash_vector(v, querying):
-                    prefixed_key = lshash.hash_name+'_'+bucket_key
-                    # Get entries from map (bucket keys with hamming distance of 1)
-                    if prefixed_key in self.bucket_key_map:
-                        bucket_keys.extend(self.bucket_key_map[prefixed_key].keys())
+            child_keys = [neighbour for bucket_key in child_keys
+                          for neighbour in self.neighbour_keys(lshash,
+                                                               bucket_key)]
         else:
-            # If we are indexing (storing) just use child hashes without permuted index
-            for lshash in self.child_hashes:
-                # Get regular bucket keys from hash
-                for bucket_key in lshash.hash_vector(v, querying):
-                    # Get permuted keys
-                    perm_keys = self.permuted_keys(bucket_key)
-                    # Put exact hit key into list
-                    perm_keys.append(bucket_key)
-
-                    # Append key for storage (not the permutations)
-                    bucket_keys.append(lshash.hash_name+'_'+bucket_key)
-
-                    # For every permutation register all the variants
-                    for perm_key in perm_keys:
-                        prefixed_key = lshash.hash_name+'_'+perm_key
-
-                        # Make sure dictionary exists
-                        if not prefixed_key in self.bucket_key_map:
-                            self.bucket_key_map[prefixed_key] = {}
-
-                        for variant in perm_keys:
-                            prefixed_variant = lshash.hash_name+'_'+variant
-                            self.bucket_key_map[prefixed_key][prefixed_variant] = 1
-
-        # Return all the bucket keys
-        return bucket_keys
+            occupied_keys = self.occupied_keys.setdefault(lshash.hash_name,
+                                                          set())
+            for bucket_key in child_keys:
+                occupied_keys.add(bucket_key if lshash.packed_keys
+                                  else int(bucket_key, 2))
+        return ['{}_{}'.format(lshash.hash_name, bucket_key)
+                for bucket_key in child_keys]
 
     def get_config(self):
         """
@@ -116,7 +151,9 @@ class HashPermutationMapper(LSHash):
         return {
             'hash_name': self.hash_name,
             'dim': self.dim,
-            'bucket_key_map': self.bucket_key_map
+            'radius': self.radius,
+            'occupied_keys': dict((hash_name, sorted(keys)) for hash_name, keys
+                                  in self.occupied_keys.items())
         }
 
     def apply_config(self, config):
@@ -125,7 +162,34 @@ class HashPermutationMapper(LSHash):
         """
         self.hash_name = config['hash_name']
         self.dim = config['dim']
-        self.bucket_key_map = config['bucket_key_map']
+        self.radius = config.get('radius', 2)
+        if 'occupied_keys' in config:
+            self.occupied_keys = dict(
+                (hash_name, set(keys))
+                for hash_name, keys in config['occupied_keys'].items())
+        else:
+            self.occupied_keys = self._legacy_occupied_keys(
+                config['bucket_key_map'])
+
+    def _legacy_occupied_keys(self, bucket_key_map):
+        """
+        Returns the occupied keys of an old config, which holds a map from
+        every key within a Hamming distance of one to an occupied key to
+        the keys around these occupied keys. Only the map entry of a key
+        holding vectors (or surrounded by such keys) includes all keys
+        around it.
+        """
+        occupied_keys = {}
+        for prefixed_key, variants in bucket_key_map.items():
+            hash_name, bucket_key = prefixed_key.rsplit('_', 1)
+            around = [bucket_key[:bit] + ('1' if bucket_key[bit] == '0'
+                                          else '0') + bucket_key[bit + 1:]
+                      for bit in range(len(bucket_key))] + [bucket_key]
+            if all('{}_{}'.format(hash_name, key) in variants
+                   for key in around):
+                occupied_keys.setdefault(hash_name, set()).add(
+                    int(bucket_key, 2))
+        return occupied_keys
 
     def add_child_hash(self, child_hash):
         """
@@ -138,9 +202,5 @@ class HashPermutationMapper(LSHash):
         if not (isinstance(child_hash,PCABinaryProjections) or isinstance(child_hash,RandomBinaryProjections) or isinstance(child_hash,RandomBinaryProjectionTree)):
             raise ValueError('Child hashes must generate binary keys')
 
-        # Add both hash and config to array of child hashes. Also we are going to
-        # accumulate used bucket keys for every hash in order to build the permuted index
+        # Add child hash to array of child hashes
         self.child_hashes.append(child_hash)
-
-
-
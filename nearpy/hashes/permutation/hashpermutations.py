@@ -35,22 +35,25 @@ class HashPermutations(LSHash):
     add the actual binary hashes you want to use via the add_child_hash
     method. Each child hash will be used separately.
 
-    After all vectors have been indexed you have to call build_permuted_index
-    to generate the permuted index.
+    The permuted index is built on the first query, from the bucket keys of
+    all vectors indexed so far.
 
     So to use this you have to do the following steps:
 
     1. Create HashPermutations instance and use it in the Engine constructor
     2. Add your binary hashes as child hashes by calling add_child_hash()
     3. Store your vectors using the Engine
-    4. Build the permuted index by calling build_permuted_index()
-    5. Now when you query the permuted index is used
+    4. Now when you query the permuted index is used
 
-    If you are adding more vectors afterwards you can update the permuted index
-    by calling build_permuted_index() again and again.
+    If you are adding more vectors afterwards, their new bucket keys are
+    added to the permuted index incrementally, so they are found right
+    away. You can still rebuild the whole permuted index (with new random
+    permutations) by calling build_permuted_index().
 
     """
 
+    updates_on_indexing = True
+
     def __init__(self, hash_name):
         """ Just keeps the name. """
         super(HashPermutations, self).__init__(hash_name)
@@ -61,6 +64,7 @@ class HashPermutations(LSHash):
     def reset(self, dim):
         """ Resets / Initializes the hash for the specified dimension. """
         self.dim = dim
+        self.permutation = Permutation()
         # Reset all child hashes
         for child_hash in self.child_hashes:
             child_hash['hash'].reset(dim)
@@ -79,7 +83,7 @@ class HashPermutations(LSHash):
                 lshash = child_hash['hash']
                 # Make sure the permuted index for this hash is existing
                 if not lshash.hash_name in self.permutation.permutedIndexs:
-                    raise AttributeError('Permuted index is not existing for hash with name %s' % lshash.hash_name)
+                    self._build_child_permuted_index(child_hash)
 
                 # Get regular bucket keys from hash
                 for bucket_key in lshash.hash_vector(v, querying):
@@ -88,7 +92,7 @@ class HashPermutations(LSHash):
                     neighbour_keys = self.permutation.get_neighbour_keys(lshash.hash_name,bucket_key)
                     # Add them to result, but prefix with hash name
                     for n in neighbour_keys:
-                        bucket_keys.append(lshash.hash_name+'_'+n)
+                        bucket_keys.append('{}_{}'.format(lshash.hash_name, n))
 
         else:
             # If we are indexing (storing) just use child hashes without permuted index
@@ -96,11 +100,19 @@ class HashPermutations(LSHash):
                 lshash = child_hash['hash']
 
                 # Get regular bucket keys from hash
+                new_keys = []
                 for bucket_key in lshash.hash_vector(v, querying):
                     # Register bucket key in child hash dict
-                    child_hash['bucket_keys'][bucket_key] = bucket_key
+                    if not bucket_key in child_hash['bucket_keys']:
+                        child_hash['bucket_keys'][bucket_key] = bucket_key
+                        new_keys.append(bucket_key)
                     # Append bucket key to result prefixed with child hash name
-                    bucket_keys.append(lshash.hash_name+'_'+bucket_key)
+                    bucket_keys.append('{}_{}'.format(lshash.hash_name,
+                                                      bucket_key))
+                # Add new keys to permuted index, if it is existing already
+                if new_keys:
+                    self.permutation.add_bucket_keys(lshash.hash_name,
+                                                     new_keys)
 
         # Return all the bucket keys
         return bucket_keys
@@ -155,19 +167,25 @@ class HashPermutations(LSHash):
         """
 
         for child_hash in self.child_hashes:
-            # Get config values for child hash
-            config = child_hash['config']
-            num_permutation = config['num_permutation']
-            beam_size = config['beam_size']
-            num_neighbour = config['num_neighbour']
+            self._build_child_permuted_index(child_hash)
+
+    def _build_child_permuted_index(self, child_hash):
+        """
+        Build PermutedIndex for specified child hash from its bucket keys.
+        """
+        # Get config values for child hash
+        config = child_hash['config']
+        num_permutation = config['num_permutation']
+        beam_size = config['beam_size']
+        num_neighbour = config['num_neighbour']
 
-            # Get used buckets keys for child hash
-            bucket_keys = child_hash['bucket_keys'].keys()
+        # Get used buckets keys for child hash
+        bucket_keys = child_hash['bucket_keys'].keys()
 
-            # Get actual child hash
-            lshash = child_hash['hash']
+        # Get actual child hash
+        lshash = child_hash['hash']
 
-            # Compute permuted index for this hash
-            self.permutation.build_permuted_index(lshash,bucket_keys,num_permutation,beam_size,num_neighbour)
+        # Compute permuted index for this hash
+        self.permutation.build_permuted_index(lshash,bucket_keys,num_permutation,beam_size,num_neighbour)
 
 
@@ -64,6 +64,13 @@ class Permutation:
         hash_name = lshash.hash_name
         self.permutedIndexs[hash_name] = pi
 
+    def add_bucket_keys(self, hash_name, bucket_keys):
+        """
+        Add new bucket keys to the permutedIndex of hash_name, if it exists.
+        """
+        if hash_name in self.permutedIndexs:
+            self.permutedIndexs[hash_name].add_keys(bucket_keys)
+
     def get_neighbour_keys(self, hash_name, bucket_key):
         """
         Return the neighbour buckets given hash_name and query bucket key.
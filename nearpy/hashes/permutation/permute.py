@@ -20,15 +20,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import random
+import numpy
 
-#from bitarray import bitarray
-from bisect import bisect_left
-
-try:
-    from past.builtins import xrange
-except ImportError:
-    xrange = range
 
 class Permute:
 
@@ -36,57 +29,79 @@ class Permute:
     Permute provide a random [n] -> [n] permute operation.
     e.g, a [3] -> [3] permute operation could be:
     [0,1,2] -> [1,0,2], "010" => "100"
+
+    Keys are permuted as numpy uint64 arrays (binary keys of at most 64
+    bits), all at once. Every byte of a key is looked up in a table
+    holding the permuted positions of its bits, so permuting takes one
+    gather per byte instead of one operation per bit.
     """
 
     def __init__(self, n):
         """
         Init a Permute object. Randomly generate a mapping, e.g. [0,1,2] -> [1,0,2]
         """
-        m = list(range(n))
-        for end in xrange(n - 1, 0, -1):
-            r = random.randint(0, end)
-            tmp = m[end]
-            m[end] = m[r]
-            m[r] = tmp
-        self.mapping = m
-
-    def permute(self, ba):
+        self.mapping = numpy.random.permutation(n)
+        positions = numpy.arange(n)
+        self.permute_tables = self._byte_tables(self.mapping, positions)
+        self.revert_tables = self._byte_tables(positions, self.mapping)
+
+    def _byte_tables(self, sources, destinations):
+        """
+        Returns one table per key byte, mapping each byte value to the key
+        bits it sets when bit sources[i] is moved to bit destinations[i].
+        Bits are numbered like characters of the string key, from the most
+        significant one.
+        """
+        n = len(self.mapping)
+        byte_count = (n + 7) // 8
+        # Value of the moved bit for every bit position (from the least
+        # significant one)
+        moved = numpy.zeros(8 * byte_count, dtype=numpy.uint64)
+        moved[n - 1 - sources] = numpy.left_shift(
+            numpy.uint64(1), (n - 1 - destinations).astype(numpy.uint64))
+        byte_bits = (numpy.arange(256)[:, numpy.newaxis] >>
+                     numpy.arange(8)) & 1
+        return [numpy.bitwise_or.reduce(
+            numpy.where(byte_bits == 1, moved[8 * j:8 * j + 8],
+                        numpy.uint64(0)), axis=1)
+                for j in range(byte_count)]
+
+    def _apply(self, tables, keys):
+        keys = numpy.ascontiguousarray(keys, dtype='<u8')
+        key_bytes = keys.view(numpy.uint8).reshape(-1, 8)
+        result = numpy.zeros(len(keys), dtype=numpy.uint64)
+        for j, table in enumerate(tables):
+            result |= table[key_bytes[:, j]]
+        return result
+
+    def permute(self, keys):
         """
-        Permute the bitarray ba inplace.
+        Returns the permuted uint64 keys.
         """
-        c = ba.copy()
-        for i in xrange(len(self.mapping)):
-            ba[i] = c[self.mapping[i]]
-        return ba
+        return self._apply(self.permute_tables, keys)
 
-    def revert(self, ba):
+    def revert(self, keys):
         """
-        Reversely permute the bitarray ba inplace.
+        Returns the reversely permuted uint64 keys.
         """
-        c = ba.copy()
-        for i in xrange(len(self.mapping)):
-            ba[self.mapping[i]] = c[i]
-        return ba
+        return self._apply(self.revert_tables, keys)
 
-    def search_revert(self, bas, ba, beam_size):
+    def search_revert(self, permuted_keys, query_key, beam_size):
         """
-        ba: query bitarray
-        bas: a sorted list of tuples of (permuted bitarray, original bitarray)
-        return : query bitarray's beam-size neighbours (unpermuted bitarray)
+        permuted_keys: sorted uint64 array of the permuted keys
+        query_key: query key (uint64)
+        return : query key's beam-size neighbours (unpermuted keys)
         """
-        pba = ba.copy()
-        self.permute(pba)
         assert(beam_size % 2 == 0)
-        half_beam = beam_size / 2
-
-        # binary search (pba,ba) in bas
-        idx = bisect_left(bas, (pba, ba))
+        half_beam = beam_size // 2
 
-        start = int(max(0, idx - half_beam))
-        end = int(min(len(bas), idx + half_beam))
+        # binary search permuted query key in permuted keys
+        permuted_query = self.permute(numpy.array([query_key],
+                                                  dtype=numpy.uint64))
+        idx = int(numpy.searchsorted(permuted_keys, permuted_query[0]))
 
-        res = bas[start:end]
+        start = max(0, idx - half_beam)
+        end = min(len(permuted_keys), idx + half_beam)
 
         # return the original(unpermuted) keys
-        res = [x[1] for x in res]
-        return res
+        return self.revert(permuted_keys[start:end])
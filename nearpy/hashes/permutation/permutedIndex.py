@@ -22,22 +22,10 @@
 
 import logging
 
-from bitarray import bitarray as _bitarray
+import numpy
 
 from nearpy.hashes.permutation.permute import Permute
-
-try:
-    from past.builtins import xrange
-except ImportError:
-    xrange = range
-
-
-class bitarray(_bitarray):
-    """ This is required to make bitarray hashable with Py3
-        (see http://bit.ly/1NIuA9F for explanation)
-    """
-    def __hash__(self):
-        return id(self)
+from nearpy.utils.utils import pack_bits_array, unpack_keys, popcounts
 
 
 class PermutedIndex:
@@ -73,8 +61,20 @@ class PermutedIndex:
     In the step 4, after we find the position of permuted query key in the list,
     it's better to return more neighbours around that place as candidates.
     The parameter beam_size specifies how many neighbours in the sorted list will be returned.
+
+    Keys are handled as numpy uint64 arrays, so keys may have at most 64
+    bits. Every permuted list is a sorted uint64 array, found neighbours
+    are permuted back as in step 5.
+
+    Keys added later with add_keys are kept in a small buffer, which is
+    searched exhaustively alongside the permuted lists. Once the buffer
+    grows beyond a sixteenth of the index, it is merged into the sorted
+    permuted lists.
     """
 
+    # Size the buffer of added keys may always reach before it is merged
+    min_merge_size = 1024
+
     def __init__(
             self,
             lshash,
@@ -87,38 +87,86 @@ class PermutedIndex:
         self.beam_size = beam_size
         self.lshash = lshash
         self.projection_count = self.lshash.projection_count
+        self.packed_keys = getattr(self.lshash, 'packed_keys', False)
         self.num_neighbour = num_neighbour
 
+        if self.projection_count > 64:
+            raise ValueError('Permuted index supports at most 64 bits')
+
         # add permutations
         self.permutes = []
-        for i in xrange(self.num_permutation):
+        for i in range(self.num_permutation):
             p = Permute(self.projection_count)
             self.permutes.append(p)
 
-        # convert current buckets to an array of bitarray
-        original_keys = []
-        for key in buckets:
-            ba = bitarray(key)
-            original_keys.append(ba)
+        # convert current buckets to uint64 keys
+        original_keys = self.uint64_keys(list(buckets))
 
         # build permutation lists
         self.permuted_lists = []
-        i = 0
-        for p in self.permutes:
+        for i, p in enumerate(self.permutes):
             logging.info(
-                'Creating Permutated Index for {}: #{}/{}'.format(lshash.hash_name, i, len(self.permuted_lists)))
-            i += 1
-            permuted_list = []
-            for ba in original_keys:
-                c = ba.copy()
-                p.permute(c)
-                permuted_list.append((c, ba))
+                'Creating Permutated Index for {}: #{}/{}'.format(lshash.hash_name, i, len(self.permutes)))
+            permuted_keys = p.permute(original_keys)
             # sort the list
-            permuted_list = sorted(permuted_list)
-            self.permuted_lists.append(permuted_list)
+            permuted_keys.sort()
+            self.permuted_lists.append(permuted_keys)
 
-    def hamming_distance(self, a, b):
-        return int((a ^ b).count())
+        # keys added after building, not merged into the lists yet
+        self.new_keys = set()
+
+    def uint64_keys(self, bucket_keys):
+        """ Returns bucket keys (strings or integers) as uint64 array. """
+        if self.packed_keys:
+            return numpy.array(bucket_keys, dtype=numpy.uint64)
+        return pack_bits_array(unpack_keys(bucket_keys,
+                                           self.projection_count))
+
+    def key_count(self):
+        """ Returns count of keys in the permuted lists. """
+        return len(self.permuted_lists[0]) if self.permuted_lists else 0
+
+    def add_keys(self, bucket_keys):
+        """
+        Adds bucket keys (strings or integers) to the index. Keys already
+        in the index are ignored.
+        """
+        keys = self.uint64_keys(list(bucket_keys))
+        if self.permuted_lists:
+            # Look the keys up in the first permuted list
+            permuted_keys = self.permutes[0].permute(keys)
+            permuted_list = self.permuted_lists[0]
+            positions = numpy.searchsorted(permuted_list, permuted_keys)
+            found = numpy.zeros(len(keys), dtype=bool)
+            inside = positions < len(permuted_list)
+            found[inside] = (permuted_list[positions[inside]] ==
+                             permuted_keys[inside])
+            keys = keys[~found]
+        self.new_keys.update(keys.tolist())
+        if len(self.new_keys) > max(self.min_merge_size,
+                                    self.key_count() // 16):
+            self.merge_new_keys()
+
+    def merge_new_keys(self):
+        """
+        Merges the added keys into the sorted permuted lists.
+        """
+        if not self.permuted_lists or not self.new_keys:
+            return
+        keys = numpy.array(list(self.new_keys), dtype=numpy.uint64)
+        for i, p in enumerate(self.permutes):
+            permuted_keys = p.permute(keys)
+            permuted_keys.sort()
+            permuted_list = self.permuted_lists[i]
+            self.permuted_lists[i] = numpy.insert(
+                permuted_list, numpy.searchsorted(permuted_list,
+                                                  permuted_keys),
+                permuted_keys)
+        self.new_keys = set()
+
+    def hamming_distances(self, keys, key):
+        """ Returns Hamming distances of the uint64 keys to key. """
+        return popcounts(keys ^ key)
 
     def get_neighbour_keys(self, bucket_key, k):
         """
@@ -130,19 +178,21 @@ class PermutedIndex:
         Make sure np*beam is much less than the number of bucket keys,
         otherwise we could use brute-force to get the neighbours
         """
-        # convert query_key into bitarray
-        query_key = bitarray(bucket_key)
+        # convert query_key into uint64 key
+        query_key = self.uint64_keys([bucket_key])[0]
 
-        topk = set()
-        for i in xrange(len(self.permutes)):
-            p = self.permutes[i]
-            plist = self.permuted_lists[i]
-            candidates = p.search_revert(plist, query_key, self.beam_size)
-            topk = topk.union(set(candidates))
-        topk = list(topk)
+        # all added keys not merged yet are candidates
+        candidates = [numpy.array(list(self.new_keys), dtype=numpy.uint64)]
+        for p, permuted_keys in zip(self.permutes, self.permuted_lists):
+            candidates.append(p.search_revert(permuted_keys, query_key,
+                                              self.beam_size))
+        topk = numpy.unique(numpy.concatenate(candidates))
 
         # sort the topk neighbour keys according to the Hamming distance to query key
-        topk = sorted(topk, key=lambda x: self.hamming_distance(x, query_key))
-        # return the top k items
-        topk_bin = [x.to01() for x in topk[:k]]
-        return topk_bin
+        distances = self.hamming_distances(topk, query_key)
+        topk = topk[numpy.argsort(distances, kind='mergesort')[:k]]
+        # return the top k items, in the format of the hash
+        if self.packed_keys:
+            return topk.tolist()
+        key_format = '0{}b'.format(self.projection_count)
+        return [format(key, key_format) for key in topk.tolist()]
@@ -25,6 +25,7 @@ import scipy
 import scipy.sparse
 
 from nearpy.hashes.lshash import LSHash
+from nearpy.utils.utils import binary_keys, perturbation_sets
 
 
 class RandomBinaryProjections(LSHash):
@@ -36,7 +37,8 @@ class RandomBinaryProjections(LSHash):
     for storage.
     """
 
-    def __init__(self, hash_name, projection_count, rand_seed=None):
+    def __init__(self, hash_name, projection_count, rand_seed=None,
+                 packed_keys=False, probe_count=1):
         """
         Creates projection_count random vectors, that are used for projections
         thus working as normals of random hyperplanes. Each random vector /
@@ -44,9 +46,20 @@ class RandomBinaryProjections(LSHash):
 
         So if you for example decide to use projection_count=10, the bucket
         keys will have 10 digits and will look like '1010110011'.
+
+        If packed_keys is True, the bits are packed into integer bucket keys
+        instead (the key above would be 691), which are cheaper to compute
+        and smaller in storage.
+
+        If probe_count is larger than 1, querying returns that many bucket
+        keys (multi-probe LSH): the bucket of the vector, followed by the
+        buckets reached by flipping the bits whose projections are closest
+        to zero, so more candidates are found with the same hash tables.
         """
         super(RandomBinaryProjections, self).__init__(hash_name)
         self.projection_count = projection_count
+        self.packed_keys = packed_keys
+        self.probe_count = probe_count
         self.dim = None
         self.normals = None
         self.rand = numpy.random.RandomState(rand_seed)
@@ -71,12 +84,40 @@ class RandomBinaryProjections(LSHash):
             if not scipy.sparse.isspmatrix_csr(v):
                 v = scipy.sparse.csr_matrix(v)
             # Project vector onto all hyperplane normals
-            projection = self.normals_csr.dot(v)
+            projection = self.normals_csr.dot(v).toarray()
         else:
             # Project vector onto all hyperplane normals
             projection = numpy.dot(self.normals, v)
+        if querying and self.probe_count > 1:
+            return self._probe_keys(numpy.ravel(projection))
         # Return binary key
-        return [''.join(['1' if x > 0.0 else '0' for x in projection])]
+        return binary_keys(projection.T, self.packed_keys)
+
+    def hash_vectors(self, V, querying=False):
+        """
+        Hashes all rows of V with one matrix product and returns the list
+        of binary bucket keys for each row.
+        """
+        # Project all vectors onto all hyperplane normals (one row per vector)
+        projections = V.dot(self.normals.T)
+        if querying and self.probe_count > 1:
+            return [self._probe_keys(projection)
+                    for projection in numpy.asarray(projections)]
+        # Return binary key for each row
+        return [[key] for key in binary_keys(projections, self.packed_keys)]
+
+    def _probe_keys(self, projection):
+        """
+        Returns the probe_count most likely bucket keys for the specified
+        projections of one vector. Flipping a bit costs its squared
+        projection, buckets are ordered by the total cost of their flips.
+        """
+        signs = numpy.where(projection > 0.0, 1.0, -1.0)
+        probes = numpy.tile(signs, (self.probe_count, 1))
+        flips = perturbation_sets(projection ** 2, self.probe_count)
+        for probe, bits in enumerate(flips):
+            probes[probe, list(bits)] *= -1.0
+        return binary_keys(probes[:len(flips)], self.packed_keys)
 
     def get_config(self):
         """
@@ -87,7 +128,9 @@ class RandomBinaryProjections(LSHash):
             'hash_name': self.hash_name,
             'dim': self.dim,
             'projection_count': self.projection_count,
-            'normals': self.normals
+            'normals': self.normals,
+            'packed_keys': self.packed_keys,
+            'probe_count': self.probe_count
         }
 
     def apply_config(self, config):
@@ -98,6 +141,8 @@ class RandomBinaryProjections(LSHash):
         self.dim = config['dim']
         self.projection_count = config['projection_count']
         self.normals = config['normals']
+        self.packed_keys = config.get('packed_keys', False)
+        self.probe_count = config.get('probe_count', 1)
 
 
 
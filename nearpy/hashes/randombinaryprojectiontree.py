@@ -25,9 +25,14 @@ import scipy
 import scipy.sparse
 
 from nearpy.hashes.lshash import LSHash
+from nearpy.utils.utils import binary_keys
 
 
 class RandomBinaryProjectionTreeNode(object):
+    """
+    Node of the recursive tree used by older versions. Only kept to load
+    hash configurations stored by them.
+    """
 
     def __init__(self):
         # Count of vectors stored in this subtree
@@ -36,86 +41,21 @@ class RandomBinaryProjectionTreeNode(object):
         self.childs = {}
         self.bucket_key = None
 
-    def insert_entry_for_bucket(self, bucket_key, tree_depth):
-        """
-        Increases counter for specified bucket_key (leaf of tree) and
-        also increases counters along the way from the root to the leaf.
-        """
-
-        # First increase vector count of this subtree
-        self.vector_count = self.vector_count + 1
-
-        if tree_depth < len(bucket_key):
-            hash_char = bucket_key[tree_depth]
-
-            # This is not the leaf so continue down into the tree towards the leaves
-
-            #print 'hash_char=%c' % hash_char
-
-            # If child node for this character ('0' or '1') is not existing yet, create it
-            if not hash_char in self.childs:
-                #print 'Creating child for %c' % hash_char
-                self.childs[hash_char] = RandomBinaryProjectionTreeNode()
-
-            # Continue on the child
-            self.childs[hash_char].insert_entry_for_bucket(bucket_key, tree_depth+1)
-        else:
-            # This is a leaf, so keep the bucket key
-            #print 'Inserting leaf %s(%s, %d), count is %d' % (bucket_key, self.bucket_key, tree_depth, self.vector_count)
-            if not self.bucket_key is None:
-                if self.bucket_key != bucket_key:
-                    raise AttributeError
-            self.bucket_key = bucket_key
-
-    def collect_all_bucket_keys(self):
+    def collect_leaf_counts(self):
         """
-        Just collects all buckets keys from subtree
+        Returns list of (bucket_key, vector_count) tuples of all leaves in
+        the subtree.
         """
-        if len(self.childs) == 0:
-            # This is a leaf so just return the bucket key (we reached the bucket leaf)
-            #print 'Returning (collect) leaf bucket key %s with %d vectors' % (self.bucket_key, self.vector_count)
-            return [self.bucket_key]
-
-        # Not leaf, return results of childs
         result = []
-        for child in self.childs.values():
-            result = result + child.collect_all_bucket_keys()
-
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            if node.childs:
+                nodes.extend(node.childs.values())
+            elif node.bucket_key is not None:
+                result.append((node.bucket_key, node.vector_count))
         return result
 
-    def bucket_keys_to_guarantee_result_set_size(self, bucket_key, N, tree_depth):
-        """
-        Returns list of bucket keys based on the specified bucket key
-        and minimum result size N.
-        """
-
-        if tree_depth == len(bucket_key):
-            #print 'Returning leaf bucket key %s with %d vectors' % (self.bucket_key, self.vector_count)
-            # This is a leaf so just return the bucket key (we reached the bucket leaf)
-            return [self.bucket_key]
-
-        # If not leaf, this is a subtree node.
-
-        hash_char = bucket_key[tree_depth]
-        if hash_char == '0':
-            other_hash_char = '1'
-        else:
-            other_hash_char = '0'
-
-        # Check if child has enough results
-        if hash_char in self.childs:
-            if self.childs[hash_char].vector_count < N:
-                # If not combine buckets of both child subtrees
-                listA = self.childs[hash_char].collect_all_bucket_keys()
-                listB = self.childs[other_hash_char].collect_all_bucket_keys()
-                return listA + listB
-            else:
-                # Child subtree has enough results, so call method on child
-                return self.childs[hash_char].bucket_keys_to_guarantee_result_set_size(bucket_key, N, tree_depth+1)
-        else:
-            # That subtree is not existing, so just follow the other side
-            return self.childs[other_hash_char].bucket_keys_to_guarantee_result_set_size(bucket_key, N, tree_depth+1)
-
 
 class RandomBinaryProjectionTree(LSHash):
     """
@@ -129,9 +69,23 @@ class RandomBinaryProjectionTree(LSHash):
     this hash constructs a binary tree in order to guarantee to
     always be able to retrieve N results. Use minimum_result_size
     to set this N.
+
+    The tree is kept flat: the sorted integer keys of all buckets with
+    their vector counts and the prefix sums of the counts. A subtree
+    (all keys with a given prefix) is a range of the sorted keys, found by
+    binary search, and its vector count is the difference of two prefix
+    sums. Keys added while indexing are kept in a small delta of the same
+    form, which is searched alongside the tree. Once the delta grows
+    beyond a sixteenth of the tree, it is merged into the tree.
     """
 
-    def __init__(self, hash_name, projection_count, minimum_result_size, rand_seed=None):
+    updates_on_indexing = True
+
+    # Size the delta may always reach before it is merged into the tree
+    min_merge_size = 1024
+
+    def __init__(self, hash_name, projection_count, minimum_result_size, rand_seed=None,
+                 packed_keys=False):
         """
         Creates projection_count random vectors, that are used for projections
         thus working as normals of random hyperplanes. Each random vector /
@@ -139,22 +93,26 @@ class RandomBinaryProjectionTree(LSHash):
 
         So if you for example decide to use projection_count=10, the bucket
         keys will have 10 digits and will look like '1010110011'.
+
+        If packed_keys is True, the bits are packed into integer bucket keys
+        instead of strings.
         """
         super(RandomBinaryProjectionTree, self).__init__(hash_name)
         self.projection_count = projection_count
+        self.packed_keys = packed_keys
         self.dim = None
         self.normals = None
         self.rand = numpy.random.RandomState(rand_seed)
         self.normals_csr = None
-        self.tree_root = None
         self.minimum_result_size = minimum_result_size
+        self._set_tree([], [])
 
     def reset(self, dim):
         """ Resets / Initializes the hash for the specified dimension. """
         if self.dim != dim:
             self.dim = dim
             self.normals = self.rand.randn(self.projection_count, dim)
-            self.tree_root = RandomBinaryProjectionTreeNode()
+            self._set_tree([], [])
 
     def hash_vector(self, v, querying=False):
         """
@@ -174,32 +132,174 @@ class RandomBinaryProjectionTree(LSHash):
             # Project vector onto all hyperplane normals
             projection = numpy.dot(self.normals, v)
 
-        # Build binary key
-        binary_key = ''.join(['1' if x > 0.0 else '0' for x in projection])
+        # Build binary key and look it up (or insert it) in the tree
+        return self._tree_bucket_keys(projection.T, querying)[0]
+
+    def hash_vectors(self, V, querying=False):
+        """
+        Hashes all rows of V with one matrix product and returns the list
+        of binary bucket keys for each row.
+        """
+        # Project all vectors onto all hyperplane normals (one row per vector)
+        projections = V.dot(self.normals.T)
+        # Look up (or insert) binary key of each row in the tree
+        return self._tree_bucket_keys(projections, querying)
 
+    def _tree_bucket_keys(self, projections, querying):
+        """
+        Returns list of bucket keys for each row of the projection matrix.
+        When querying, these are the keys that guarantee the minimum result
+        size, otherwise the key of the row is registered in the tree.
+        """
+        keys = binary_keys(projections, packed_keys=True)
         if querying:
-            #print 'Querying...'
             # Make sure returned buckets keys contain at least N results
-            return self.tree_root.bucket_keys_to_guarantee_result_set_size(binary_key, self.minimum_result_size, 0)
-        else:
-            # We are indexing, so adapt bucket key counter in binary tree
-            self.tree_root.insert_entry_for_bucket(binary_key, 0)
-
-            # Return binary key
-            return [binary_key]
+            return [self._format_keys(self._keys_to_guarantee_result_set_size(
+                key)) for key in keys]
+
+        # We are indexing, so count the keys, they are added to the delta
+        # on next query
+        for key in keys:
+            self._new_counts[key] = self._new_counts.get(key, 0) + 1
+        return [[bucket_key] for bucket_key in self._format_keys(keys)]
+
+    def _format_keys(self, keys):
+        """ Returns the integer keys as bucket keys (strings if not packed). """
+        if self.packed_keys:
+            return list(keys)
+        key_format = '0{}b'.format(self.projection_count)
+        return [format(key, key_format) for key in keys]
+
+    def _keys_to_guarantee_result_set_size(self, key):
+        """
+        Walks down the tree along the bits of the integer key and returns
+        the keys of the deepest subtree with at least minimum_result_size
+        vectors on that path (keys of the subtree containing the path first).
+        Missing subtrees on the path are bypassed through their sibling.
+        """
+        self._merge_new_counts()
+        # A subtree is a range of the tree keys and a range of delta keys
+        ranges = [(0, len(self.tree_keys)), (0, len(self.delta_keys))]
+        if self._subtree_count(ranges) == 0:
+            return []
+        prefix = 0
+        for depth in range(self.projection_count):
+            shift = self.projection_count - depth - 1
+            # Keys of the subtree with bit 0 come before the ones with bit 1
+            boundary = ((prefix << 1) | 1) << shift
+            children = [[], []]
+            for keys, (lo, hi) in zip((self.tree_keys, self.delta_keys),
+                                      ranges):
+                middle = int(numpy.searchsorted(keys, boundary))
+                children[0].append((lo, middle))
+                children[1].append((middle, hi))
+            bit = (key >> shift) & 1
+            count = self._subtree_count(children[bit])
+            if count == 0:
+                # That subtree is not existing, so just follow the other side
+                bit = 1 - bit
+            elif count < self.minimum_result_size:
+                # If not enough results combine buckets of both subtrees
+                return (self._subtree_keys(children[bit]) +
+                        self._subtree_keys(children[1 - bit]))
+            ranges = children[bit]
+            prefix = (prefix << 1) | bit
+        return self._subtree_keys(ranges)
+
+    def _subtree_count(self, ranges):
+        """ Returns the vector count of the subtree with these ranges. """
+        (lo, hi), (delta_lo, delta_hi) = ranges
+        return (self.tree_offsets[hi] - self.tree_offsets[lo] +
+                self.delta_offsets[delta_hi] - self.delta_offsets[delta_lo])
+
+    def _subtree_keys(self, ranges):
+        """ Returns the sorted keys of the subtree with these ranges. """
+        (lo, hi), (delta_lo, delta_hi) = ranges
+        if delta_lo == delta_hi:
+            return self.tree_keys[lo:hi].tolist()
+        return numpy.union1d(self.tree_keys[lo:hi],
+                             self.delta_keys[delta_lo:delta_hi]).tolist()
+
+    def _set_tree(self, keys, counts):
+        """
+        Sets the tree to the specified sorted keys and their vector counts.
+        """
+        self.tree_keys = numpy.array(keys, dtype=self._key_dtype())
+        self.tree_counts = numpy.array(counts, dtype=numpy.int64)
+        self.tree_offsets = self._offsets(self.tree_counts)
+        self._set_delta([], [])
+        self._new_counts = {}
+
+    def _set_delta(self, keys, counts):
+        self.delta_keys = numpy.array(keys, dtype=self._key_dtype())
+        self.delta_counts = numpy.array(counts, dtype=numpy.int64)
+        self.delta_offsets = self._offsets(self.delta_counts)
+
+    def _key_dtype(self):
+        # Keys of 63 bits or more could overflow int64 in the searches
+        if self.projection_count is not None and self.projection_count >= 63:
+            return object
+        return numpy.int64
+
+    def _offsets(self, counts):
+        return numpy.concatenate([[0], numpy.cumsum(counts)]).astype(
+            numpy.int64)
+
+    def _add_counts(self, keys, counts, new_keys, new_counts):
+        """
+        Returns sorted keys and counts with the sorted new keys and their
+        counts added.
+        """
+        positions = numpy.searchsorted(keys, new_keys)
+        found = numpy.zeros(len(new_keys), dtype=bool)
+        inside = positions < len(keys)
+        found[inside] = keys[positions[inside]] == new_keys[inside]
+        counts = counts.copy()
+        counts[positions[found]] += new_counts[found]
+        return (numpy.insert(keys, positions[~found], new_keys[~found]),
+                numpy.insert(counts, positions[~found], new_counts[~found]))
+
+    def _merge_new_counts(self):
+        """
+        Adds the keys counted while indexing to the delta, and merges the
+        delta into the tree once it is large enough.
+        """
+        if not self._new_counts:
+            return
+        new_keys = sorted(self._new_counts)
+        self._set_delta(*self._add_counts(
+            self.delta_keys, self.delta_counts,
+            numpy.array(new_keys, dtype=self._key_dtype()),
+            numpy.array([self._new_counts[key] for key in new_keys],
+                        dtype=numpy.int64)))
+        self._new_counts = {}
+        if len(self.delta_keys) > max(self.min_merge_size,
+                                      len(self.tree_keys) // 16):
+            self._merge_delta()
+
+    def _merge_delta(self):
+        """ Merges the delta into the tree. """
+        if len(self.delta_keys):
+            self._set_tree(*self._add_counts(self.tree_keys, self.tree_counts,
+                                             self.delta_keys,
+                                             self.delta_counts))
 
     def get_config(self):
         """
         Returns pickle-serializable configuration struct for storage.
         """
+        self._merge_new_counts()
+        self._merge_delta()
         # Fill this dict with config data
         return {
             'hash_name': self.hash_name,
             'dim': self.dim,
             'projection_count': self.projection_count,
             'normals': self.normals,
-            'tree_root': self.tree_root,
-            'minimum_result_size': self.minimum_result_size
+            'tree_keys': self.tree_keys,
+            'tree_counts': self.tree_counts,
+            'minimum_result_size': self.minimum_result_size,
+            'packed_keys': self.packed_keys
         }
 
     def apply_config(self, config):
@@ -210,9 +310,13 @@ class RandomBinaryProjectionTree(LSHash):
         self.dim = config['dim']
         self.projection_count = config['projection_count']
         self.normals = config['normals']
-        self.tree_root = config['tree_root']
         self.minimum_result_size = config['minimum_result_size']
-
-
-
-
+        self.packed_keys = config.get('packed_keys', False)
+        if 'tree_root' in config:
+            # Configuration of an older version, holding the tree itself
+            leaves = sorted((int(bucket_key, 2), count) for bucket_key, count
+                            in config['tree_root'].collect_leaf_counts())
+            self._set_tree([key for key, _ in leaves],
+                           [count for _, count in leaves])
+        else:
+            self._set_tree(config['tree_keys'], config['tree_counts'])
@@ -25,6 +25,7 @@ import scipy
 import scipy.sparse
 
 from nearpy.hashes.lshash import LSHash
+from nearpy.utils.utils import discretized_keys, discretized_probes
 
 
 class RandomDiscretizedProjections(LSHash):
@@ -34,16 +35,23 @@ class RandomDiscretizedProjections(LSHash):
     random vector using a bin width.
     """
 
-    def __init__(self, hash_name, projection_count, bin_width, rand_seed=None):
+    def __init__(self, hash_name, projection_count, bin_width, rand_seed=None,
+                 probe_count=1):
         """
         Creates projection_count random vectors, that are used for projections.
         Each random vector will result in one discretized coordinate.
 
         So if you for example decide to use projection_count=3, the bucket
         keys will have 3 coordinates and look like '14_4_1' or '-4_18_-1'.
+
+        If probe_count is larger than 1, querying returns that many bucket
+        keys (multi-probe LSH): the bin of the vector, followed by the
+        neighbouring bins ordered by the distance of the vector to their
+        boundaries.
         """
         super(RandomDiscretizedProjections, self).__init__(hash_name)
         self.projection_count = projection_count
+        self.probe_count = probe_count
         self.dim = None
         self.normals = None
         self.bin_width = bin_width
@@ -69,13 +77,29 @@ class RandomDiscretizedProjections(LSHash):
             if not scipy.sparse.isspmatrix_csr(v):
                 v = scipy.sparse.csr_matrix(v)
             # Project vector onto all hyperplane normals
-            projection = (self.normals_csr.dot(v) / self.bin_width).floor().toarray()
+            projection = (self.normals_csr.dot(v) / self.bin_width).toarray()
         else:
             # Project vector onto all hyperplane normals
-            projection = numpy.dot(self.normals, v)
-            projection = numpy.floor(projection / self.bin_width)
+            projection = numpy.dot(self.normals, v) / self.bin_width
+        if querying and self.probe_count > 1:
+            return discretized_keys(discretized_probes(
+                numpy.ravel(projection), self.probe_count))
         # Return key
-        return ['_'.join([str(int(x)) for x in projection])]
+        return discretized_keys(numpy.floor(projection).T)
+
+    def hash_vectors(self, V, querying=False):
+        """
+        Hashes all rows of V with one matrix product and returns the list
+        of bucket keys for each row.
+        """
+        # Project all vectors (one row per vector)
+        projections = numpy.asarray(V.dot(self.normals.T)) / self.bin_width
+        if querying and self.probe_count > 1:
+            return [discretized_keys(discretized_probes(projection,
+                                                        self.probe_count))
+                    for projection in projections]
+        # Return key for each row, using the bin indices
+        return [[key] for key in discretized_keys(numpy.floor(projections))]
 
     def get_config(self):
         """
@@ -87,7 +111,8 @@ class RandomDiscretizedProjections(LSHash):
             'dim': self.dim,
             'bin_width': self.bin_width,
             'projection_count': self.projection_count,
-            'normals': self.normals
+            'normals': self.normals,
+            'probe_count': self.probe_count
         }
 
     def apply_config(self, config):
@@ -99,6 +124,7 @@ class RandomDiscretizedProjections(LSHash):
         self.bin_width = config['bin_width']
         self.projection_count = config['projection_count']
         self.normals = config['normals']
+        self.probe_count = config.get('probe_count', 1)
 
 
 
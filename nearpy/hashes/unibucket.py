@@ -47,6 +47,12 @@ class UniBucket(LSHash):
         # Return bucket key identical to vector string representation
         return [self.hash_name+'']
 
+    def hash_vectors(self, V, querying=False):
+        """
+        Returns the single bucket key for each row of V.
+        """
+        return [[self.hash_name+''] for _ in range(V.shape[0])]
+
     def get_config(self):
         """
         Returns pickle-serializable configuration struct for storage.
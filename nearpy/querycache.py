@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import hashlib
+import time
+
+import numpy
+import scipy.sparse
+
+
+class QueryCache(object):
+    """
+    Cache of query results for Engine.neighbours.
+
+    Results are keyed by a digest of the query vector, with every
+    component rounded to a multiple of resolution, so exact and
+    near-exact repeats of a query are answered without hashing, fetching
+    or scoring. The vector is not normalized, because hashes like the
+    discretized projections put v and 3*v into different buckets. The
+    cache holds at most max_size results, the least recently used are
+    removed first. If ttl is set, results are dropped ttl seconds after
+    they have been computed.
+
+    Every result remembers the (hash_name, bucket_key) tuples it was
+    computed from (bucket keys in string form). The engine invalidates
+    all results using a bucket when it stores vectors into or deletes
+    vectors from that bucket.
+
+    The counts of cache hits and misses are kept in hits and misses.
+    """
+
+    def __init__(self, max_size=10000, ttl=None, resolution=1e-6):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.resolution = resolution
+        self.results = collections.OrderedDict()
+        self.bucket_queries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def query_key(self, v):
+        """ Returns the cache key of query vector v. """
+        if scipy.sparse.issparse(v):
+            v = scipy.sparse.coo_matrix(v)
+            v.sum_duplicates()
+            parts = [numpy.array(v.shape, dtype=numpy.int64).tobytes(),
+                     v.row.astype(numpy.int64).tobytes(),
+                     self._quantize(v.data)]
+        else:
+            parts = [self._quantize(numpy.ravel(v))]
+        return hashlib.sha1(b''.join(parts)).hexdigest()
+
+    def _quantize(self, values):
+        return numpy.round(values / self.resolution).astype(
+            numpy.int64).tobytes()
+
+    def get(self, key):
+        """
+        Returns cached result for the key and marks it as recently used,
+        or None.
+        """
+        if key not in self.results:
+            self.misses += 1
+            return None
+        result, bucket_keys, expires = self.results.pop(key)
+        if expires is not None and expires < time.time():
+            self._forget(key, bucket_keys)
+            self.misses += 1
+            return None
+        self.results[key] = (result, bucket_keys, expires)
+        self.hits += 1
+        return list(result)
+
+    def put(self, key, result, bucket_keys):
+        """
+        Stores the result of a query, which has been computed from the
+        buckets in the list of (hash_name, bucket_key) tuples.
+        """
+        if key in self.results:
+            self._forget(key, self.results.pop(key)[1])
+        bucket_keys = frozenset(self._bucket(hash_name, bucket_key)
+                                for hash_name, bucket_key in bucket_keys)
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        self.results[key] = (list(result), bucket_keys, expires)
+        for bucket_key in bucket_keys:
+            self.bucket_queries.setdefault(bucket_key, set()).add(key)
+        while len(self.results) > self.max_size:
+            removed_key, (_, removed_buckets, _) = \
+                self.results.popitem(last=False)
+            self._forget(removed_key, removed_buckets)
+
+    def _forget(self, key, bucket_keys):
+        """ Removes key from the queries of its buckets. """
+        for bucket_key in bucket_keys:
+            queries = self.bucket_queries.get(bucket_key)
+            if queries is not None:
+                queries.discard(key)
+                if not queries:
+                    del self.bucket_queries[bucket_key]
+
+    def invalidate(self, bucket_keys):
+        """
+        Removes the results of all queries that used one of the buckets in
+        the list of (hash_name, bucket_key) tuples.
+        """
+        for bucket_key in set(self._bucket(hash_name, bucket_key)
+                              for hash_name, bucket_key in bucket_keys):
+            for key in list(self.bucket_queries.get(bucket_key, ())):
+                self._forget(key, self.results.pop(key)[1])
+
+    def _bucket(self, hash_name, bucket_key):
+        # Storages handle bucket keys by their string form, so that integer
+        # keys match the keys storages return for them
+        return (hash_name, '{}'.format(bucket_key))
+
+    def clear(self):
+        """ Removes all results. """
+        self.results.clear()
+        self.bucket_queries.clear()
@@ -21,7 +21,17 @@
 # THE SOFTWARE.
 from __future__ import absolute_import
 
+import sys
+
 from nearpy.storage.storage import Storage
 from nearpy.storage.storage_memory import MemoryStorage
+from nearpy.storage.storage_columnar import ColumnarMemoryStorage
+from nearpy.storage.storage_mmap import MemoryMappedStorage
 from nearpy.storage.storage_redis import RedisStorage
 from nearpy.storage.storage_mongo import MongoStorage
+from nearpy.storage.storage_cache import CachingStorage
+
+# The asyncio storages need Python 3.6 (async generators and comprehensions)
+if sys.version_info >= (3, 6):
+    from nearpy.storage.storage_redis_async import AsyncRedisStorage
+    from nearpy.storage.storage_mongo_async import AsyncMongoStorage
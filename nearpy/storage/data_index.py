@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from nearpy.utils.utils import data_key
+
+
+class DataIndex(object):
+    """
+    Reverse index from data to the buckets holding vectors with that data,
+    used by in-memory storages to find the buckets to delete a vector from.
+    Vectors without data (None) are not indexed.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+
+    def add(self, hash_name, bucket_key, data):
+        """ Registers a vector with data in the specified bucket. """
+        if data is not None:
+            self.buckets.setdefault(data_key(data), set()).add(
+                (hash_name, bucket_key))
+
+    def get_bucket_keys(self, hash_name, data):
+        """
+        Returns list of keys of the buckets of hash_name holding vectors
+        with data, None if data is None.
+        """
+        if data is None:
+            return None
+        return [bucket_key for bucket_hash_name, bucket_key
+                in self.buckets.get(data_key(data), ())
+                if bucket_hash_name == hash_name]
+
+    def remove(self, hash_name, bucket_keys, data):
+        """ Forgets the specified buckets of vectors with data. """
+        if data is None:
+            return
+        key = data_key(data)
+        buckets = self.buckets.get(key)
+        if buckets is None:
+            return
+        buckets.difference_update((hash_name, bucket_key)
+                                  for bucket_key in bucket_keys)
+        if not buckets:
+            del self.buckets[key]
@@ -20,9 +20,27 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+from nearpy.utils.utils import matrix_rows
+
 
 class Storage(object):
-    """ Interface for storage adapters. """
+    """
+    Interface for storage adapters.
+
+    Bucket keys are strings, or integers for binary hashes using packed
+    keys. Adapters must accept both kinds.
+
+    Adapters with store_vectors_once set keep every vector only once under
+    an integer id and their buckets only hold ids. They also implement
+    get_bucket_ids and get_vectors, which the engine uses to fetch all
+    candidates of a query in bulk.
+
+    The engine fetches all buckets of a query with one call of get_buckets
+    (or get_buckets_ids), so adapters for databases can do it with one
+    round trip.
+    """
+
+    store_vectors_once = False
 
     def store_vector(self, hash_name, bucket_key, v, data):
         """
@@ -37,6 +55,24 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def store_postings(self, postings, vs, data):
+        """
+        Stores a batch of vectors in buckets of any number of hashes.
+        vs is a matrix with one vector per row (or a list of vectors) and
+        data is either None or a list with one JSON-serializable object per
+        row. postings is a list of (hash_name, bucket_key, row) tuples, each
+        of them stores the vector and data of that row in the specified
+        bucket.
+
+        This default implementation calls store_vector for every posting.
+        Adapters should override it to write the batch in bulk.
+        """
+        vs = matrix_rows(vs)
+        if data is None:
+            data = [None] * len(vs)
+        for hash_name, bucket_key, row in postings:
+            self.store_vector(hash_name, bucket_key, vs[row], data[row])
+
     def get_all_bucket_keys(self, hash_name):
         """
         Returns all bucket keys for the given hash as iterable of strings
@@ -44,18 +80,74 @@ class Storage(object):
         raise NotImplementedError
 
 
+    def get_data_bucket_keys(self, hash_name, data):
+        """
+        Returns keys of the buckets of the given hash holding vectors with
+        the specified data, so that deleting it does not have to look at
+        all buckets. Returns None if the storage keeps no reverse index
+        from data to buckets (or data is None), then all bucket keys are
+        used.
+        """
+        return None
+
     def delete_vector(self, hash_name, bucket_keys, data):
         """
         Deletes vector and JSON-serializable data in buckets with specified keys.
         """
         raise NotImplementedError
 
+    def compact(self, threshold=0.5):
+        """
+        Removes deleted vectors from the buckets in which they make up at
+        least threshold of the content. Only adapters that record deletes
+        as tombstones instead of rewriting buckets need to implement it.
+        """
+        pass
+
     def get_bucket(self, hash_name, bucket_key):
         """
         Returns bucket content as list of tuples (vector, data).
         """
         raise NotImplementedError
 
+    def get_buckets(self, bucket_keys):
+        """
+        Returns list with the content of every bucket in the specified list
+        of (hash_name, bucket_key) tuples, each as list of tuples
+        (vector, data).
+
+        This default implementation calls get_bucket for every bucket.
+        Adapters for databases should override it to fetch all buckets with
+        one request.
+        """
+        return [self.get_bucket(hash_name, bucket_key)
+                for hash_name, bucket_key in bucket_keys]
+
+    def get_bucket_ids(self, hash_name, bucket_key):
+        """
+        Returns ids of the vectors in the bucket as numpy array.
+        Only used if store_vectors_once is set.
+        """
+        raise NotImplementedError
+
+    def get_buckets_ids(self, bucket_keys):
+        """
+        Returns list with the ids of every bucket in the specified list of
+        (hash_name, bucket_key) tuples, each as numpy array.
+        Only used if store_vectors_once is set.
+
+        This default implementation calls get_bucket_ids for every bucket.
+        """
+        return [self.get_bucket_ids(hash_name, bucket_key)
+                for hash_name, bucket_key in bucket_keys]
+
+    def get_vectors(self, ids):
+        """
+        Returns list of tuples (vector, data) for the specified ids.
+        Only used if store_vectors_once is set.
+        """
+        raise NotImplementedError
+
     def clean_buckets(self, hash_name):
         """
         Removes all buckets and their content.
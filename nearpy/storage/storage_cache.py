@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import sys
+
+import scipy.sparse
+
+from nearpy.storage.storage import Storage
+
+
+class CachingStorage(Storage):
+    """
+    Storage wrapper keeping the decoded content of recently used buckets in
+    memory, in front of a remote storage like RedisStorage or MongoStorage.
+
+    The cache is a LRU cache keyed by (hash_name, bucket_key), which holds
+    at most max_bytes of vectors and data (estimated). Buckets are removed
+    from the cache when vectors are stored into or deleted from them through
+    this wrapper. Changes made by other clients of the remote storage are
+    not noticed, so every writer should use the wrapper.
+
+    The wrapper always returns whole buckets, also if the wrapped storage
+    keeps vectors once: the engine then gets the candidates with
+    get_buckets, and vectors in several buckets are cached once per bucket.
+
+    The counts of cache hits and misses are kept in hits and misses.
+    """
+
+    def __init__(self, storage, max_bytes=256 * 1024 * 1024):
+        """
+        Wraps the specified storage, caching at most max_bytes of buckets.
+        """
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_key(self, hash_name, bucket_key):
+        # Storages handle bucket keys by their string form, so that
+        # integer keys are invalidated by the keys get_all_bucket_keys
+        # returns as well
+        return (hash_name, '{}'.format(bucket_key))
+
+    def _bucket_size(self, bucket):
+        """ Returns estimated count of bytes of the bucket content. """
+        size = sys.getsizeof(bucket)
+        for v, data in bucket:
+            if scipy.sparse.issparse(v):
+                v = scipy.sparse.coo_matrix(v)
+                size += v.data.nbytes + v.row.nbytes + v.col.nbytes
+            else:
+                size += v.nbytes
+            size += sys.getsizeof(data)
+        return size
+
+    def _get_cached(self, key):
+        """ Returns cached bucket and marks it as recently used, or None. """
+        if key not in self.cache:
+            self.misses += 1
+            return None
+        self.hits += 1
+        bucket, size = self.cache.pop(key)
+        self.cache[key] = (bucket, size)
+        return bucket
+
+    def _put_cached(self, key, bucket):
+        """ Adds bucket to the cache, removing the least recently used. """
+        size = self._bucket_size(bucket)
+        if size > self.max_bytes:
+            return
+        self._invalidate(key)
+        self.cache[key] = (bucket, size)
+        self.cached_bytes += size
+        while self.cached_bytes > self.max_bytes:
+            _, (_, removed_size) = self.cache.popitem(last=False)
+            self.cached_bytes -= removed_size
+
+    def _invalidate(self, key):
+        if key in self.cache:
+            self.cached_bytes -= self.cache.pop(key)[1]
+
+    def store_vector(self, hash_name, bucket_key, v, data):
+        """
+        Stores vector and JSON-serializable data in bucket with specified key.
+        """
+        self._invalidate(self._cache_key(hash_name, bucket_key))
+        self.storage.store_vector(hash_name, bucket_key, v, data)
+
+    def store_many_vectors(self, hash_name, bucket_keys, vs, data):
+        """
+        Store a batch of vectors.
+        Stores vector and JSON-serializable data in bucket with specified key.
+        """
+        bucket_keys = list(bucket_keys)
+        for bucket_key in bucket_keys:
+            self._invalidate(self._cache_key(hash_name, bucket_key))
+        self.storage.store_many_vectors(hash_name, bucket_keys, vs, data)
+
+    def store_postings(self, postings, vs, data):
+        """
+        Stores a batch of vectors in buckets of any number of hashes.
+        """
+        for hash_name, bucket_key, _ in postings:
+            self._invalidate(self._cache_key(hash_name, bucket_key))
+        self.storage.store_postings(postings, vs, data)
+
+    def get_all_bucket_keys(self, hash_name):
+        """
+        Returns all bucket keys for the given hash as iterable of strings
+        """
+        return self.storage.get_all_bucket_keys(hash_name)
+
+    def get_data_bucket_keys(self, hash_name, data):
+        """
+        Returns keys of the buckets of the given hash holding vectors with
+        the specified data, if the wrapped storage keeps a reverse index.
+        """
+        return self.storage.get_data_bucket_keys(hash_name, data)
+
+    def delete_vector(self, hash_name, bucket_keys, data):
+        """
+        Deletes vector and JSON-serializable data in buckets with specified keys.
+        """
+        bucket_keys = list(bucket_keys)
+        for bucket_key in bucket_keys:
+            self._invalidate(self._cache_key(hash_name, bucket_key))
+        self.storage.delete_vector(hash_name, bucket_keys, data)
+
+    def compact(self, threshold=0.5):
+        """
+        Compacts the wrapped storage. Cached buckets stay valid, their
+        content does not change.
+        """
+        self.storage.compact(threshold)
+
+    def get_bucket(self, hash_name, bucket_key):
+        """
+        Returns bucket content as list of tuples (vector, data).
+        """
+        return self.get_buckets([(hash_name, bucket_key)])[0]
+
+    def get_buckets(self, bucket_keys):
+        """
+        Returns list with the content of every bucket in the specified list
+        of (hash_name, bucket_key) tuples. Buckets missing in the cache are
+        fetched from the wrapped storage with one call.
+        """
+        buckets = [self._get_cached(self._cache_key(hash_name, bucket_key))
+                   for hash_name, bucket_key in bucket_keys]
+        missing = [index for index, bucket in enumerate(buckets)
+                   if bucket is None]
+        if missing:
+            fetched = self.storage.get_buckets([bucket_keys[index]
+                                                for index in missing])
+            for index, bucket in zip(missing, fetched):
+                buckets[index] = bucket
+                self._put_cached(self._cache_key(*bucket_keys[index]), bucket)
+        return buckets
+
+    def clean_buckets(self, hash_name):
+        """
+        Removes all buckets and their content.
+        """
+        for key in [key for key in self.cache if key[0] == hash_name]:
+            self._invalidate(key)
+        self.storage.clean_buckets(hash_name)
+
+    def clean_all_buckets(self):
+        """
+        Removes all buckets and their content.
+        """
+        self.cache.clear()
+        self.cached_bytes = 0
+        self.storage.clean_all_buckets()
+
+    def store_hash_configuration(self, lshash):
+        """
+        Stores hash configuration
+        """
+        self.storage.store_hash_configuration(lshash)
+
+    def load_hash_configuration(self, hash_name):
+        """
+        Loads and returns hash configuration
+        """
+        return self.storage.load_hash_configuration(hash_name)
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import numpy
+import scipy
+from future.utils import viewkeys
+
+from nearpy.storage.storage import Storage
+from nearpy.storage.data_index import DataIndex
+from nearpy.utils.utils import stack_rows
+
+
+class GrowableArray(object):
+    """
+    Numpy array with amortized constant time appends. The capacity is
+    doubled whenever it is exhausted, values() returns a view on the
+    used part.
+    """
+
+    def __init__(self, dtype, width=None, capacity=16, array=None):
+        """
+        If array is specified, it is used as initial content (without
+        copying it, the first append that needs more room copies it).
+        """
+        self.dtype = dtype
+        self.width = width
+        if array is None:
+            self.size = 0
+            self.array = self._allocate(capacity)
+        else:
+            self.size = len(array)
+            self.array = array
+
+    def _allocate(self, capacity):
+        if self.width is None:
+            return numpy.empty(capacity, dtype=self.dtype)
+        return numpy.empty((capacity, self.width), dtype=self.dtype)
+
+    def extend(self, values):
+        """ Appends values (array of rows or list of objects). """
+        end = self.size + len(values)
+        if end > len(self.array):
+            array = self._allocate(max(end, 2 * len(self.array)))
+            array[:self.size] = self.array[:self.size]
+            self.array = array
+        if self.dtype == object:
+            # Assign one by one, numpy would unpack list-valued entries
+            for index, value in enumerate(values):
+                self.array[self.size + index] = value
+        else:
+            self.array[self.size:end] = values
+        self.size = end
+
+    def keep(self, mask):
+        """
+        Keeps only the values selected by the boolean mask, in order. The
+        array is reallocated if less than a quarter of it stays in use.
+        """
+        kept = self.values()[mask]
+        self.size = 0
+        if len(kept) < len(self.array) // 4:
+            self.array = self._allocate(max(16, 2 * len(kept)))
+        self.extend(kept)
+
+    def values(self):
+        """ Returns view on all appended values. """
+        return self.array[:self.size]
+
+    def __len__(self):
+        return self.size
+
+
+class ColumnarMemoryStorage(Storage):
+    """
+    In-memory storage keeping all vectors in one growable numpy matrix and
+    all data in one object array (the columns), with one row per vector.
+    Buckets are numpy int arrays holding row offsets, so every vector is
+    stored only once and candidates are gathered with one fancy index.
+
+    Only dense vectors are supported. They are returned as 1d vectors.
+
+    Deleted vectors are only marked in a boolean column (tombstones) and
+    skipped when reading buckets, so deleting does not rewrite buckets.
+    compact() removes them from the buckets where they make up a large
+    part, and drops the rows no bucket holds anymore from the columns.
+    """
+
+    store_vectors_once = True
+
+    def __init__(self, dtype=numpy.float64):
+        """ Uses specified dtype (for example numpy.float32) for vectors. """
+        self.dtype = dtype
+        self.vectors = None
+        self.data = GrowableArray(object)
+        self.deleted = GrowableArray(bool)
+        # Count of deleted rows still held by buckets
+        self.deleted_count = 0
+        self.buckets = {}
+        self.hash_configs = {}
+        # Reverse index from data to buckets, built on first use
+        self.data_index = None
+
+    def store_vector(self, hash_name, bucket_key, v, data):
+        """
+        Stores vector and JSON-serializable data in bucket with specified key.
+        """
+        self.store_postings([(hash_name, bucket_key, 0)], [v], [data])
+
+    def store_many_vectors(self, hash_name, bucket_keys, vs, data):
+        """
+        Store a batch of vectors.
+        Stores vector and JSON-serializable data in bucket with specified key.
+        """
+        self.store_postings([(hash_name, bucket_key, row) for row, bucket_key
+                             in enumerate(bucket_keys)], vs, data)
+
+    def store_postings(self, postings, vs, data):
+        """
+        Appends the batch to the vector and data columns and the row
+        offsets to the buckets, one append per bucket.
+        """
+        V = stack_rows(vs)
+        if scipy.sparse.issparse(V):
+            raise ValueError('ColumnarMemoryStorage only supports dense vectors')
+        V = numpy.asarray(V, dtype=self.dtype)
+        if self.vectors is None:
+            self.vectors = self._create_vectors(V.shape[1])
+        if data is None:
+            data = [None] * V.shape[0]
+
+        first_row = len(self.vectors)
+        self.vectors.extend(V)
+        self.data.extend(data)
+        self.deleted.extend(numpy.zeros(V.shape[0], dtype=bool))
+
+        # Group rows by bucket so that every bucket is extended once
+        bucket_rows = {}
+        for hash_name, bucket_key, row in postings:
+            bucket_rows.setdefault((hash_name, bucket_key), []).append(
+                first_row + row)
+        for (hash_name, bucket_key), rows in bucket_rows.items():
+            buckets = self.buckets.setdefault(hash_name, {})
+            if not bucket_key in buckets:
+                buckets[bucket_key] = GrowableArray(numpy.int64)
+            buckets[bucket_key].extend(rows)
+        if self.data_index is not None:
+            for hash_name, bucket_key, row in postings:
+                self.data_index.add(hash_name, bucket_key, data[row])
+
+    def _create_vectors(self, width):
+        """ Returns empty vector column for vectors of specified width. """
+        return GrowableArray(self.dtype, width)
+
+    def get_all_bucket_keys(self, hash_name):
+        return viewkeys(self.buckets[hash_name])
+
+    def get_data_bucket_keys(self, hash_name, data):
+        """
+        Returns keys of the buckets of the given hash holding vectors with
+        the specified data, from the reverse index.
+        """
+        if data is None:
+            return None
+        if self.data_index is None:
+            self.data_index = DataIndex()
+            all_data = self.data.values()
+            for index_hash_name, buckets in self.buckets.items():
+                for bucket_key, bucket in buckets.items():
+                    for row in bucket.values():
+                        self.data_index.add(index_hash_name, bucket_key,
+                                            all_data[row])
+        return self.data_index.get_bucket_keys(hash_name, data)
+
+    def delete_vector(self, hash_name, bucket_keys, data):
+        """
+        Deletes vector and JSON-serializable data in buckets with specified keys.
+        """
+        bucket_keys = list(bucket_keys)
+        if self.data_index is not None:
+            self.data_index.remove(hash_name, bucket_keys, data)
+        rows = numpy.unique(numpy.concatenate(
+            [self.get_bucket_ids(hash_name, key) for key in bucket_keys] +
+            [numpy.empty(0, dtype=numpy.int64)]))
+        all_data = self.data.values()
+        rows = rows[numpy.array([id_data == data for id_data
+                                 in all_data[rows]], dtype=bool)]
+        # Mark rows as deleted, the buckets are left alone
+        self.deleted.values()[rows] = True
+        all_data[rows] = None
+        self.deleted_count += len(rows)
+
+    def compact(self, threshold=0.5):
+        """
+        Removes the rows of deleted vectors from all buckets in which they
+        make up at least threshold of the rows. Deleted rows no bucket
+        holds anymore are then removed from the columns, which renumbers
+        the rows after them.
+        """
+        if not self.deleted_count:
+            return
+        deleted = self.deleted.values()
+        held = numpy.zeros(len(deleted), dtype=bool)
+        for buckets in self.buckets.values():
+            for bucket in buckets.values():
+                rows = bucket.values()
+                dead = deleted[rows]
+                dead_count = numpy.count_nonzero(dead)
+                if dead_count and dead_count >= threshold * len(rows):
+                    rows = rows[~dead]
+                    bucket.size = 0
+                    bucket.extend(rows)
+                held[rows] = True
+        self.deleted_count = int(numpy.count_nonzero(deleted & held))
+        self._drop_rows(deleted & ~held)
+
+    def _drop_rows(self, dropped):
+        """ Removes the rows marked in dropped from all columns. """
+        if not dropped.any():
+            return
+        kept = ~dropped
+        new_rows = numpy.cumsum(kept) - 1
+        for column in (self.vectors, self.data, self.deleted):
+            column.keep(kept)
+        for buckets in self.buckets.values():
+            for bucket in buckets.values():
+                rows = new_rows[bucket.values()]
+                bucket.size = 0
+                bucket.extend(rows)
+
+    def get_bucket(self, hash_name, bucket_key):
+        """
+        Returns bucket content as list of tuples (vector, data).
+        """
+        return self.get_vectors(self.get_bucket_ids(hash_name, bucket_key))
+
+    def get_bucket_ids(self, hash_name, bucket_key):
+        """
+        Returns row offsets of the vectors in the bucket as numpy array.
+        """
+        bucket = self.buckets.get(hash_name, {}).get(bucket_key)
+        if bucket is None:
+            return numpy.empty(0, dtype=numpy.int64)
+        ids = bucket.values()
+        if self.deleted_count:
+            # Skip tombstones
+            ids = ids[~self.deleted.values()[ids]]
+        return ids
+
+    def get_vectors(self, ids):
+        """
+        Returns list of tuples (vector, data) for the specified row offsets.
+        The vectors are rows of one gathered matrix.
+        """
+        if len(ids) == 0:
+            return []
+        return list(zip(self.vectors.values()[ids], self.data.values()[ids]))
+
+    def clean_buckets(self, hash_name):
+        """
+        Removes all buckets and their content for specified hash.
+        """
+        self.buckets[hash_name] = {}
+        self.data_index = None
+
+    def clean_all_buckets(self):
+        """
+        Removes all buckets from all hashes and their content.
+        """
+        self.vectors = None
+        self.data = GrowableArray(object)
+        self.deleted = GrowableArray(bool)
+        self.deleted_count = 0
+        self.buckets = {}
+        self.data_index = None
+
+    def store_hash_configuration(self, lshash):
+        """
+        Stores hash configuration
+        """
+        self.hash_configs[lshash.hash_name] = lshash.get_config()
+
+    def load_hash_configuration(self, hash_name):
+        """
+        Loads and returns hash configuration
+        """
+        return self.hash_configs.get(hash_name)
@@ -30,6 +30,7 @@
 from future.utils import viewkeys
 from future.builtins import zip
 from nearpy.storage.storage import Storage
+from nearpy.storage.data_index import DataIndex
 import itertools
 
 
@@ -39,6 +40,8 @@ class MemoryStorage(Storage):
     def __init__(self):
         self.buckets = {}
         self.hash_configs = {}
+        # Reverse index from data to buckets, built on first use
+        self.data_index = None
 
     def store_vector(self, hash_name, bucket_key, v, data):
         """
@@ -51,6 +54,8 @@ class MemoryStorage(Storage):
         if not bucket_key in self.buckets[hash_name]:
             self.buckets[hash_name][bucket_key] = []
         self.buckets[hash_name][bucket_key].append((v, data))
+        if self.data_index is not None:
+            self.data_index.add(hash_name, bucket_key, data)
 
     def store_many_vectors(self, hash_name, bucket_keys, vs, data):
         """
@@ -65,14 +70,33 @@ class MemoryStorage(Storage):
     def get_all_bucket_keys(self, hash_name):
         return viewkeys(self.buckets[hash_name])
 
+    def get_data_bucket_keys(self, hash_name, data):
+        """
+        Returns keys of the buckets of the given hash holding vectors with
+        the specified data, from the reverse index.
+        """
+        if data is None:
+            return None
+        if self.data_index is None:
+            self.data_index = DataIndex()
+            for index_hash_name, buckets in self.buckets.items():
+                for bucket_key, bucket in buckets.items():
+                    for _, id_data in bucket:
+                        self.data_index.add(index_hash_name, bucket_key,
+                                            id_data)
+        return self.data_index.get_bucket_keys(hash_name, data)
+
     def delete_vector(self, hash_name, bucket_keys, data):
         """
         Deletes vector and JSON-serializable data in buckets with specified keys.
         """
+        bucket_keys = list(bucket_keys)
         for key in bucket_keys:
             bucket = self.get_bucket(hash_name, key)
             bucket[:] = [(v, id_data) for v, id_data
                          in bucket if id_data != data]
+        if self.data_index is not None:
+            self.data_index.remove(hash_name, bucket_keys, data)
 
     def get_bucket(self, hash_name, bucket_key):
         """
@@ -88,12 +112,14 @@ class MemoryStorage(Storage):
         Removes all buckets and their content for specified hash.
         """
         self.buckets[hash_name] = {}
+        self.data_index = None
 
     def clean_all_buckets(self):
         """
         Removes all buckets from all hashes and their content.
         """
         self.buckets = {}
+        self.data_index = None
 
     def store_hash_configuration(self, lshash):
         """
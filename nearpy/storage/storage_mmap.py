@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+
+import numpy
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from nearpy.storage.storage_columnar import ColumnarMemoryStorage, \
+    GrowableArray
+
+
+class MappedArray(GrowableArray):
+    """
+    GrowableArray of rows backed by a memory-mapped .npy file. When the
+    capacity is exhausted the rows are copied into a new file twice as
+    large, which then replaces the old one.
+    """
+
+    def __init__(self, filename, dtype=None, width=None, size=None):
+        """
+        Maps the existing file if size (the count of used rows) is
+        specified, otherwise a new file for rows of specified dtype and
+        width is created.
+        """
+        self.filename = filename
+        if size is None:
+            self.dtype = dtype
+            self.width = width
+            self.size = 0
+            self.array = self._allocate(16)
+            self._replace_file()
+        else:
+            self.array = numpy.load(filename, mmap_mode='r+')
+            self.dtype = self.array.dtype
+            self.width = self.array.shape[1]
+            self.size = size
+
+    def _allocate(self, capacity):
+        return numpy.lib.format.open_memmap(self.filename + '.tmp', mode='w+',
+                                            dtype=self.dtype,
+                                            shape=(capacity, self.width))
+
+    def _replace_file(self):
+        self.array.flush()
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def extend(self, values):
+        """ Appends rows, moving to a larger file if needed. """
+        array = self.array
+        super(MappedArray, self).extend(values)
+        if self.array is not array:
+            self._replace_file()
+
+    def flush(self):
+        """ Writes changed rows to disk. """
+        self.array.flush()
+
+
+class MemoryMappedStorage(ColumnarMemoryStorage):
+    """
+    Storage persisting its content in the specified directory. The vectors
+    are kept in a memory-mapped .npy file (one row per vector), the buckets
+    in a compact index of two .npy files, holding the row offsets of all
+    buckets one after another and the start of every bucket in them.
+
+    Opening an existing directory just maps these files, so neither the
+    vectors nor the buckets have to be hashed or unpickled again, and the
+    pages are shared with other processes using the same files.
+
+    New vectors are written to the vectors file directly. Changes to the
+    buckets, the data and the hash configurations are written by flush().
+
+    Like ColumnarMemoryStorage only dense vectors are supported. compact()
+    removes deleted vectors from the buckets, but their rows stay in the
+    vectors file.
+    """
+
+    def __init__(self, path, dtype=numpy.float64):
+        """
+        Uses specified directory for storage, loading its content if it
+        holds a flushed index. The dtype of new vectors files is specified
+        by dtype (for example numpy.float32).
+        """
+        super(MemoryMappedStorage, self).__init__(dtype)
+        self.path = path
+        if os.path.exists(self._filename('index.pkl')):
+            self._load()
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, name):
+        return os.path.join(self.path, name)
+
+    def _create_vectors(self, width):
+        return MappedArray(self._filename('vectors.npy'), self.dtype, width)
+
+    def _load(self):
+        """
+        Maps vectors and buckets and loads data and hash configurations.
+        """
+        with open(self._filename('index.pkl'), 'rb') as f:
+            index = pickle.load(f)
+        if index['size'] > 0:
+            self.vectors = MappedArray(self._filename('vectors.npy'),
+                                       size=index['size'])
+            self.dtype = self.vectors.dtype
+        self.data.extend(index['data'])
+        # Indexes written by older versions have no tombstones
+        deleted = index.get('deleted', numpy.zeros(len(index['data']),
+                                                   dtype=bool))
+        self.deleted.extend(deleted)
+        self.deleted_count = int(numpy.count_nonzero(deleted))
+        self.hash_configs = index['hash_configs']
+
+        # Copy-on-write mapping, in-place changes of buckets (when deleting)
+        # stay private until they are flushed
+        bucket_ids = numpy.load(self._filename('bucket_ids.npy'),
+                                mmap_mode='c')
+        offsets = numpy.load(self._filename('bucket_offsets.npy'))
+        for bucket, (hash_name, bucket_key) in enumerate(index['buckets']):
+            ids = bucket_ids[offsets[bucket]:offsets[bucket + 1]]
+            self.buckets.setdefault(hash_name, {})[bucket_key] = \
+                GrowableArray(numpy.int64, array=ids)
+
+    def _drop_rows(self, dropped):
+        """
+        Keeps the rows of deleted vectors in the vectors file, moving rows
+        would break the index flushed last, which refers to them.
+        """
+        pass
+
+    def flush(self):
+        """
+        Writes the buckets, the data and the hash configurations to disk and
+        makes sure that all vectors are written as well.
+        """
+        if self.vectors is not None:
+            self.vectors.flush()
+        buckets = [(hash_name, bucket_key, bucket.values())
+                   for hash_name, hash_buckets in self.buckets.items()
+                   for bucket_key, bucket in hash_buckets.items()]
+        offsets = numpy.cumsum([0] + [len(ids) for _, _, ids in buckets])
+        bucket_ids = numpy.concatenate(
+            [ids for _, _, ids in buckets] + [numpy.empty(0, numpy.int64)])
+        self._write('bucket_ids.npy', lambda f: numpy.save(f, bucket_ids))
+        self._write('bucket_offsets.npy',
+                    lambda f: numpy.save(f, offsets.astype(numpy.int64)))
+
+        # The index is written last, it makes the new files valid
+        index = {
+            'size': len(self.vectors) if self.vectors is not None else 0,
+            'data': list(self.data.values()),
+            'deleted': numpy.array(self.deleted.values()),
+            'buckets': [(hash_name, bucket_key)
+                        for hash_name, bucket_key, _ in buckets],
+            'hash_configs': self.hash_configs
+        }
+        self._write('index.pkl', lambda f: pickle.dump(index, f, protocol=2))
+
+    def _write(self, name, write):
+        """
+        Writes file with specified name using a temporary file, so that
+        mappings of the old file stay valid.
+        """
+        filename = self._filename(name)
+        with open(filename + '.tmp', 'wb') as f:
+            write(f)
+        os.rename(filename + '.tmp', filename)
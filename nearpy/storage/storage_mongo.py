@@ -36,23 +36,90 @@ except ImportError:
 
 from future.builtins import bytes
 from nearpy.storage.storage import Storage
+from nearpy.utils.utils import matrix_rows
 
 
 class MongoStorage(Storage):
     """ Storage using MongoDB. """
 
-    def __init__(self, mongo_object):
-        """ Uses specified pymongo object for storage. """
+    def __init__(self, mongo_object, store_vectors_once=False):
+        """
+        Uses specified pymongo object for storage.
+
+        If store_vectors_once is True, every vector and its data is stored
+        only once in a document with an integer id and there is one document
+        per bucket holding the ids, instead of a full copy per hash.
+        Deleting a vector then only removes its document and records its id
+        in a tombstone document, compact() removes the ids from the
+        buckets.
+        """
         self.mongo_object = mongo_object
+        self.store_vectors_once = store_vectors_once
 
     def store_vector(self, hash_name, bucket_key, v, data):
         """
         Stores vector and JSON-serializable data in MongoDB with specified key.
         """
-        mongo_key = self._format_mongo_key(hash_name, bucket_key)
+        if self.store_vectors_once:
+            self.store_postings([(hash_name, bucket_key, 0)], [v], [data])
+            return
+        val_dict = self._encode_vector(v, data)
+        val_dict['lsh'] = self._format_mongo_key(hash_name, bucket_key)
+
+        # Push JSON representation of dict to end of bucket list
+        self.mongo_object.insert_one(val_dict)
 
+    def store_postings(self, postings, vs, data):
+        """
+        Stores a batch of vectors in buckets of any number of hashes.
+        Every vector is encoded once and all documents are inserted at once.
+        """
+        vs = matrix_rows(vs)
+        if data is None:
+            data = [None] * len(vs)
+        rows = [self._encode_vector(v, d) for v, d in zip(vs, data)]
+        if self.store_vectors_once:
+            self._store_postings_ids(postings, rows)
+            return
+        documents = []
+        for hash_name, bucket_key, row in postings:
+            val_dict = dict(rows[row])
+            val_dict['lsh'] = self._format_mongo_key(hash_name, bucket_key)
+            documents.append(val_dict)
+        if documents:
+            self.mongo_object.insert_many(documents)
+
+    def _store_postings_ids(self, postings, rows):
+        """
+        Stores encoded rows once under new ids and appends the ids to the
+        bucket documents.
+        """
+        if not rows:
+            return
+        # Reserve one id per row
+        counter = self.mongo_object.find_one_and_update(
+            {'nearpy_counter': 'vector_id'}, {'$inc': {'value': len(rows)}},
+            upsert=True, return_document=True)
+        first_id = counter['value'] - len(rows)
+        for row, val_dict in enumerate(rows):
+            val_dict['nearpy_vector_id'] = first_id + row
+        self.mongo_object.insert_many(rows)
+
+        # Group ids by bucket so that every bucket is updated once
+        bucket_ids = {}
+        for hash_name, bucket_key, row in postings:
+            lsh_key = self._format_mongo_key(hash_name, bucket_key)
+            bucket_ids.setdefault(lsh_key, []).append(first_id + row)
+        for lsh_key, ids in bucket_ids.items():
+            self.mongo_object.update_one({'lsh': lsh_key},
+                                         {'$push': {'ids': {'$each': ids}}},
+                                         upsert=True)
+
+    def _encode_vector(self, v, data):
+        """
+        Returns document representation of vector and data (without key).
+        """
         val_dict = {}
-        val_dict['lsh'] = mongo_key
 
         # Depending on type (sparse or not) fill value dict
         if scipy.sparse.issparse(v):
@@ -83,8 +150,7 @@ class MongoStorage(Storage):
         if data is not None:
             val_dict['data'] = data
 
-        # Push JSON representation of dict to end of bucket list
-        self.mongo_object.insert_one(val_dict)
+        return val_dict
 
     def _format_mongo_key(self, hash_name, bucket_key):
         return '{}{}'.format(self._format_hash_prefix(hash_name), bucket_key)
@@ -107,60 +173,282 @@ class MongoStorage(Storage):
         lsh_key = self._format_mongo_key(hash_name, bucket_key)
         return self.mongo_object.find({'lsh': lsh_key})
 
+    def get_data_bucket_keys(self, hash_name, data):
+        """
+        Returns keys of the buckets of the given hash holding vectors with
+        the specified data, found by querying the data (which should be
+        indexed in MongoDB).
+        """
+        if data is None:
+            return None
+        if not self.store_vectors_once:
+            return self._data_bucket_keys(hash_name, self.mongo_object.find(
+                self._data_buckets_query(hash_name, data)))
+        ids = [row['nearpy_vector_id'] for row in self.mongo_object.find(
+            self._data_vectors_query(data))]
+        if not ids:
+            return []
+        return self._data_bucket_keys(hash_name, self.mongo_object.find(
+            self._id_buckets_query(hash_name, ids)))
+
+    def _data_buckets_query(self, hash_name, data):
+        return {'lsh': {'$regex': self._format_hash_prefix(hash_name)},
+                'data': data}
+
+    def _data_vectors_query(self, data):
+        return {'nearpy_vector_id': {'$exists': True}, 'data': data}
+
+    def _id_buckets_query(self, hash_name, ids):
+        return {'lsh': {'$regex': self._format_hash_prefix(hash_name)},
+                'ids': {'$in': ids}}
+
+    def _data_bucket_keys(self, hash_name, rows):
+        prefix_len = len(self._format_hash_prefix(hash_name))
+        return list(set(row['lsh'][prefix_len:] for row in rows))
+
     def delete_vector(self, hash_name, bucket_keys, data):
         """
         Deletes vector and JSON-serializable data in buckets with specified keys.
         """
         lsh_keys = [self._format_mongo_key(hash_name, key)
                     for key in bucket_keys]
+        if self.store_vectors_once:
+            self._delete_vector_ids(lsh_keys, data)
+            return
         self.mongo_object.remove({'lsh': {'$in': lsh_keys},
                                   'data': data})
 
+    def _delete_vector_ids(self, lsh_keys, data):
+        """
+        Deletes the vectors with the specified data and records their ids
+        as tombstones. The buckets are left alone.
+        """
+        ids = set()
+        for row in self.mongo_object.find({'lsh': {'$in': lsh_keys}}):
+            ids.update(row.get('ids', []))
+        deleted = self._matching_ids(self.mongo_object.find(
+            self._vector_ids_query(list(ids))), data)
+        if not deleted:
+            # Deleted data is not present in these buckets
+            return
+        self.mongo_object.delete_many(self._vector_ids_query(deleted))
+        self.mongo_object.insert_many(self._tombstone_docs(deleted))
+
+    def _matching_ids(self, rows, data):
+        return [row['nearpy_vector_id'] for row in rows
+                if row.get('data') == data]
+
+    def _tombstone_docs(self, ids):
+        # One document per tombstone, so deleting stays cheap
+        return [{'nearpy_tombstone': int(vector_id)} for vector_id in ids]
+
+    def _tombstones_query(self, ids=None):
+        if ids is None:
+            return {'nearpy_tombstone': {'$exists': True}}
+        return {'nearpy_tombstone': {'$in': ids}}
+
+    def _tombstone_ids(self, rows):
+        return [row['nearpy_tombstone'] for row in rows]
+
+    def compact(self, threshold=0.5):
+        """
+        Removes the ids of deleted vectors from all buckets in which they
+        make up at least threshold of the ids. Tombstones are dropped once
+        no bucket holds their id anymore.
+        """
+        if not self.store_vectors_once:
+            return
+        deleted = self._tombstone_ids(self.mongo_object.find(
+            self._tombstones_query()))
+        if not deleted:
+            return
+        lsh_keys, dropped = self._compact_buckets(self.mongo_object.find(
+            self._held_buckets_query(deleted)), deleted, threshold)
+        if lsh_keys:
+            self.mongo_object.update_many(
+                {'lsh': {'$in': lsh_keys}},
+                {'$pull': {'ids': {'$in': deleted}}})
+        if dropped:
+            self.mongo_object.delete_many(self._tombstones_query(dropped))
+
+    def _compact_buckets(self, rows, deleted, threshold):
+        """
+        Returns the keys of the bucket documents in which the deleted ids
+        make up at least threshold of the ids, and the deleted ids that
+        are left in no bucket after removing them from these.
+        """
+        deleted = set(deleted)
+        lsh_keys = []
+        remaining = set()
+        for row in rows:
+            ids = row.get('ids', [])
+            dead = [vector_id for vector_id in ids if vector_id in deleted]
+            if len(dead) >= threshold * len(ids):
+                lsh_keys.append(row['lsh'])
+            else:
+                remaining.update(dead)
+        return lsh_keys, list(deleted - remaining)
+
     def get_bucket(self, hash_name, bucket_key):
         """
         Returns bucket content as list of tuples (vector, data).
         """
-        results = []
+        if self.store_vectors_once:
+            return self.get_vectors(self.get_bucket_ids(hash_name, bucket_key))
+        return [self._decode_vector(row)
+                for row in self._get_bucket_rows(hash_name, bucket_key)]
+
+    def get_buckets(self, bucket_keys):
+        """
+        Returns list with the content of every bucket in the specified list
+        of (hash_name, bucket_key) tuples. All buckets are fetched with one
+        query (and all vectors with one more query if they are stored once).
+        """
+        if self.store_vectors_once:
+            bucket_ids = self.get_buckets_ids(bucket_keys)
+            rows = self._get_vector_rows(set(vector_id for ids in bucket_ids
+                                             for vector_id in ids))
+            return self._split_vectors(rows, bucket_ids)
+        return self._group_rows(self._get_buckets_rows(bucket_keys),
+                                bucket_keys)
+
+    def _split_vectors(self, rows, bucket_ids):
+        """
+        Returns list of bucket contents from the dict of fetched vectors.
+        """
+        return [[rows[vector_id] for vector_id in ids if vector_id in rows]
+                for ids in bucket_ids]
+
+    def _group_rows(self, rows, bucket_keys):
+        """
+        Returns list of bucket contents from the documents of all buckets.
+        """
+        buckets = {}
+        for row in rows:
+            buckets.setdefault(row['lsh'], []).append(self._decode_vector(row))
+        return [buckets.get(self._format_mongo_key(hash_name, bucket_key), [])
+                for hash_name, bucket_key in bucket_keys]
+
+    def _get_buckets_rows(self, bucket_keys):
+        lsh_keys = [self._format_mongo_key(hash_name, bucket_key)
+                    for hash_name, bucket_key in bucket_keys]
+        return self.mongo_object.find({'lsh': {'$in': lsh_keys}})
+
+    def get_bucket_ids(self, hash_name, bucket_key):
+        """
+        Returns ids of the vectors in the bucket as numpy array.
+        """
+        ids = []
         for row in self._get_bucket_rows(hash_name, bucket_key):
-            val_dict = row
-            # Depending on type (sparse or not) reconstruct vector
-            if 'sparse' in val_dict:
-
-                # Fill these for COO creation
-                row  = []
-                col  = []
-                data = []
-
-                # For each non-zero element, append values
-                for e in val_dict['nonzeros']:
-                    row.append(e[0]) # Row index
-                    data.append(e[1]) # Value
-                    col.append(0) # Column index (always 0)
-
-                # Create numpy arrays for COO creation
-                coo_row = numpy.array(row, dtype=numpy.int32)
-                coo_col = numpy.array(col, dtype=numpy.int32)
-                coo_data = numpy.array(data)
-
-                # Create COO sparse vector
-                vector = scipy.sparse.coo_matrix((coo_data, (coo_row, coo_col)),
-                                                 shape=(val_dict['dim'], 1))
+            ids.extend(row.get('ids', []))
+        return numpy.array(ids, dtype=numpy.int64)
 
-            else:
-                vector = numpy.fromstring(val_dict['vector'],
-                                          dtype=val_dict['dtype'])
-                [val_dict.pop(k) for k in ['vector', 'dtype', '_id']]
-            # Add data to result tuple, if present
-            results.append((vector, val_dict['data']))
+    def get_buckets_ids(self, bucket_keys):
+        """
+        Returns list with the ids of every bucket in the specified list of
+        (hash_name, bucket_key) tuples, fetched with one query.
+        """
+        return self._group_ids(self._get_buckets_rows(bucket_keys),
+                               bucket_keys)
 
-        return results
+    def _group_ids(self, rows, bucket_keys):
+        """
+        Returns list of id arrays from the documents of all buckets.
+        """
+        ids = {}
+        for row in rows:
+            ids.setdefault(row['lsh'], []).extend(row.get('ids', []))
+        return [numpy.array(ids.get(self._format_mongo_key(hash_name,
+                                                           bucket_key), []),
+                            dtype=numpy.int64)
+                for hash_name, bucket_key in bucket_keys]
+
+    def get_vectors(self, ids):
+        """
+        Returns list of tuples (vector, data) for the specified ids, fetched
+        with one query.
+        """
+        rows = self._get_vector_rows(ids)
+        return [rows[vector_id] for vector_id in ids if vector_id in rows]
+
+    def _get_vector_rows(self, ids):
+        """
+        Returns dict mapping the specified ids to tuples (vector, data).
+        Ids of deleted vectors are missing.
+        """
+        if len(ids) == 0:
+            return {}
+        return self._vectors_by_id(self.mongo_object.find(
+            self._vector_ids_query(ids)))
+
+    def _vector_ids_query(self, ids):
+        return {'nearpy_vector_id': {'$in': [int(i) for i in set(ids)]}}
+
+    def _vectors_by_id(self, rows):
+        return dict((row['nearpy_vector_id'], self._decode_vector(row))
+                    for row in rows)
+
+    def _decode_vector(self, val_dict):
+        """
+        Returns tuple (vector, data) from vector document.
+        """
+        # Depending on type (sparse or not) reconstruct vector
+        if 'sparse' in val_dict:
+
+            # Fill these for COO creation
+            row  = []
+            col  = []
+            data = []
+
+            # For each non-zero element, append values
+            for e in val_dict['nonzeros']:
+                row.append(e[0]) # Row index
+                data.append(e[1]) # Value
+                col.append(0) # Column index (always 0)
+
+            # Create numpy arrays for COO creation
+            coo_row = numpy.array(row, dtype=numpy.int32)
+            coo_col = numpy.array(col, dtype=numpy.int32)
+            coo_data = numpy.array(data)
+
+            # Create COO sparse vector
+            vector = scipy.sparse.coo_matrix((coo_data, (coo_row, coo_col)),
+                                             shape=(val_dict['dim'], 1))
+
+        else:
+            vector = numpy.fromstring(val_dict['vector'],
+                                      dtype=val_dict['dtype'])
+        # Add data to result tuple, if present
+        return (vector, val_dict.get('data'))
 
     def clean_buckets(self, hash_name):
         """
-        Removes all buckets and their content for specified hash.
+        Removes all buckets and their content for specified hash. With
+        store_vectors_once, the vectors no bucket of another hash holds
+        are deleted as well.
         """
-        self.mongo_object.remove(
-            {'lsh': {'$regex': self._format_hash_prefix(hash_name)}})
+        query = {'lsh': {'$regex': self._format_hash_prefix(hash_name)}}
+        ids = []
+        if self.store_vectors_once:
+            ids = self._rows_ids(self.mongo_object.find(query))
+        self.mongo_object.remove(query)
+        if ids:
+            unheld = self._unheld_ids(ids, self.mongo_object.find(
+                self._held_buckets_query(ids)))
+            if unheld:
+                self.mongo_object.delete_many(self._vector_ids_query(unheld))
+                self.mongo_object.delete_many(self._tombstones_query(unheld))
+
+    def _rows_ids(self, rows):
+        return list(set(vector_id for row in rows
+                        for vector_id in row.get('ids', [])))
+
+    def _held_buckets_query(self, ids):
+        return {'lsh': {'$exists': True}, 'ids': {'$in': ids}}
+
+    def _unheld_ids(self, ids, rows):
+        """ Returns the ids not held by the bucket documents. """
+        return list(set(ids).difference(self._rows_ids(rows)))
 
     def clean_all_buckets(self):
         """
@@ -168,6 +456,11 @@ class MongoStorage(Storage):
         """
         self.mongo_object.remove(
             {'lsh': {'$regex': 'nearpy_'}})
+        self.mongo_object.remove(
+            {'nearpy_vector_id': {'$exists': True}})
+        self.mongo_object.remove(
+            {'nearpy_counter': {'$exists': True}})
+        self.mongo_object.remove(self._tombstones_query())
 
     def store_hash_configuration(self, lshash):
         """
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from nearpy.storage.storage_mongo import MongoStorage
+from nearpy.utils.utils import matrix_rows
+
+
+class AsyncMongoStorage(MongoStorage):
+    """
+    Storage using MongoDB with an asyncio client, like a motor
+    AsyncIOMotorCollection. All methods of the storage interface are
+    coroutines, use it with AsyncEngine.
+
+    Documents are the same as in MongoStorage, so an index written by one
+    of them can be read by the other.
+    """
+
+    async def store_vector(self, hash_name, bucket_key, v, data):
+        """
+        Stores vector and JSON-serializable data in MongoDB with specified key.
+        """
+        await self.store_postings([(hash_name, bucket_key, 0)], [v], [data])
+
+    async def store_postings(self, postings, vs, data):
+        """
+        Stores a batch of vectors in buckets of any number of hashes.
+        Every vector is encoded once and all documents are inserted at once.
+        """
+        vs = matrix_rows(vs)
+        if data is None:
+            data = [None] * len(vs)
+        rows = [self._encode_vector(v, d) for v, d in zip(vs, data)]
+        if self.store_vectors_once:
+            await self._store_postings_ids(postings, rows)
+            return
+        documents = []
+        for hash_name, bucket_key, row in postings:
+            val_dict = dict(rows[row])
+            val_dict['lsh'] = self._format_mongo_key(hash_name, bucket_key)
+            documents.append(val_dict)
+        if documents:
+            await self.mongo_object.insert_many(documents)
+
+    async def _store_postings_ids(self, postings, rows):
+        """
+        Stores encoded rows once under new ids and appends the ids to the
+        bucket documents, all buckets are updated concurrently.
+        """
+        if not rows:
+            return
+        # Reserve one id per row
+        counter = await self.mongo_object.find_one_and_update(
+            {'nearpy_counter': 'vector_id'}, {'$inc': {'value': len(rows)}},
+            upsert=True, return_document=True)
+        first_id = counter['value'] - len(rows)
+        for row, val_dict in enumerate(rows):
+            val_dict['nearpy_vector_id'] = first_id + row
+        await self.mongo_object.insert_many(rows)
+
+        # Group ids by bucket so that every bucket is updated once
+        bucket_ids = {}
+        for hash_name, bucket_key, row in postings:
+            lsh_key = self._format_mongo_key(hash_name, bucket_key)
+            bucket_ids.setdefault(lsh_key, []).append(first_id + row)
+        await asyncio.gather(*(
+            self.mongo_object.update_one({'lsh': lsh_key},
+                                         {'$push': {'ids': {'$each': ids}}},
+                                         upsert=True)
+            for lsh_key, ids in bucket_ids.items()))
+
+    async def get_all_bucket_keys(self, hash_name):
+        prefix_len = len(self._format_hash_prefix(hash_name))
+        rows = await self.mongo_object.find(
+            {'lsh': {'$regex': self._format_hash_prefix(hash_name)}}
+        ).to_list(None)
+        return [row['lsh'][prefix_len:] for row in rows]
+
+    async def get_data_bucket_keys(self, hash_name, data):
+        """
+        Returns keys of the buckets of the given hash holding vectors with
+        the specified data, found by querying the data.
+        """
+        if data is None:
+            return None
+        if not self.store_vectors_once:
+            return self._data_bucket_keys(hash_name, await self.mongo_object.find(
+                self._data_buckets_query(hash_name, data)).to_list(None))
+        ids = [row['nearpy_vector_id'] for row in await self.mongo_object.find(
+            self._data_vectors_query(data)).to_list(None)]
+        if not ids:
+            return []
+        return self._data_bucket_keys(hash_name, await self.mongo_object.find(
+            self._id_buckets_query(hash_name, ids)).to_list(None))
+
+    async def delete_vector(self, hash_name, bucket_keys, data):
+        """
+        Deletes vector and JSON-serializable data in buckets with specified keys.
+        """
+        lsh_keys = [self._format_mongo_key(hash_name, key)
+                    for key in bucket_keys]
+        if not self.store_vectors_once:
+            await self.mongo_object.delete_many({'lsh': {'$in': lsh_keys},
+                                                 'data': data})
+            return
+        # The vectors are deleted and their ids recorded as tombstones
+        ids = set()
+        for row in await self.mongo_object.find(
+                {'lsh': {'$in': lsh_keys}}).to_list(None):
+            ids.update(row.get('ids', []))
+        deleted = self._matching_ids(await self.mongo_object.find(
+            self._vector_ids_query(list(ids))).to_list(None), data)
+        if not deleted:
+            # Deleted data is not present in these buckets
+            return
+        await self.mongo_object.delete_many(self._vector_ids_query(deleted))
+        await self.mongo_object.insert_many(self._tombstone_docs(deleted))
+
+    async def compact(self, threshold=0.5):
+        """
+        Removes the ids of deleted vectors from all buckets in which they
+        make up at least threshold of the ids. Tombstones are dropped once
+        no bucket holds their id anymore.
+        """
+        if not self.store_vectors_once:
+            return
+        deleted = self._tombstone_ids(await self.mongo_object.find(
+            self._tombstones_query()).to_list(None))
+        if not deleted:
+            return
+        lsh_keys, dropped = self._compact_buckets(
+            await self.mongo_object.find(
+                self._held_buckets_query(deleted)).to_list(None),
+            deleted, threshold)
+        if lsh_keys:
+            await self.mongo_object.update_many(
+                {'lsh': {'$in': lsh_keys}},
+                {'$pull': {'ids': {'$in': deleted}}})
+        if dropped:
+            await self.mongo_object.delete_many(
+                self._tombstones_query(dropped))
+
+    async def get_bucket(self, hash_name, bucket_key):
+        """
+        Returns bucket content as list of tuples (vector, data).
+        """
+        return (await self.get_buckets([(hash_name, bucket_key)]))[0]
+
+    async def get_buckets(self, bucket_keys):
+        """
+        Returns list with the content of every bucket in the specified list
+        of (hash_name, bucket_key) tuples. All buckets are fetched with one
+        query (and all vectors with one more query if they are stored once).
+        """
+        if self.store_vectors_once:
+            bucket_ids = await self.get_buckets_ids(bucket_keys)
+            rows = await self._get_vector_rows(set(
+                vector_id for ids in bucket_ids for vector_id in ids))
+            return self._split_vectors(rows, bucket_ids)
+        return self._group_rows(await self._get_buckets_rows(bucket_keys),
+                                bucket_keys)
+
+    async def _get_buckets_rows(self, bucket_keys):
+        lsh_keys = [self._format_mongo_key(hash_name, bucket_key)
+                    for hash_name, bucket_key in bucket_keys]
+        return await self.mongo_object.find(
+            {'lsh': {'$in': lsh_keys}}).to_list(None)
+
+    async def get_bucket_ids(self, hash_name, bucket_key):
+        """
+        Returns ids of the vectors in the bucket as numpy array.
+        """
+        return (await self.get_buckets_ids([(hash_name, bucket_key)]))[0]
+
+    async def get_buckets_ids(self, bucket_keys):
+        """
+        Returns list with the ids of every bucket in the specified list of
+        (hash_name, bucket_key) tuples, fetched with one query.
+        """
+        return self._group_ids(await self._get_buckets_rows(bucket_keys),
+                               bucket_keys)
+
+    async def get_vectors(self, ids):
+        """
+        Returns list of tuples (vector, data) for the specified ids, fetched
+        with one query.
+        """
+        rows = await self._get_vector_rows(ids)
+        return [rows[vector_id] for vector_id in ids if vector_id in rows]
+
+    async def _get_vector_rows(self, ids):
+        """
+        Returns dict mapping the specified ids to tuples (vector, data).
+        Ids of deleted vectors are missing.
+        """
+        if len(ids) == 0:
+            return {}
+        return self._vectors_by_id(await self.mongo_object.find(
+            self._vector_ids_query(ids)).to_list(None))
+
+    async def clean_buckets(self, hash_name):
+        """
+        Removes all buckets and their content for specified hash. With
+        store_vectors_once, the vectors no bucket of another hash holds
+        are deleted as well.
+        """
+        query = {'lsh': {'$regex': self._format_hash_prefix(hash_name)}}
+        ids = []
+        if self.store_vectors_once:
+            ids = self._rows_ids(
+                await self.mongo_object.find(query).to_list(None))
+        await self.mongo_object.delete_many(query)
+        if ids:
+            unheld = self._unheld_ids(ids, await self.mongo_object.find(
+                self._held_buckets_query(ids)).to_list(None))
+            if unheld:
+                await self.mongo_object.delete_many(
+                    self._vector_ids_query(unheld))
+                await self.mongo_object.delete_many(
+                    self._tombstones_query(unheld))
+
+    async def clean_all_buckets(self):
+        """
+        Removes all buckets from all hashes and their content.
+        """
+        await self.mongo_object.delete_many(
+            {'lsh': {'$regex': 'nearpy_'}})
+        await self.mongo_object.delete_many(
+            {'nearpy_vector_id': {'$exists': True}})
+        await self.mongo_object.delete_many(
+            {'nearpy_counter': {'$exists': True}})
+        await self.mongo_object.delete_many(self._tombstones_query())
+
+    async def store_hash_configuration(self, lshash):
+        """
+        Stores hash configuration
+        """
+        await self.mongo_object.insert_one(
+            {'hash_conf_name': lshash.hash_name+'_conf',
+             'hash_configuration': pickle.dumps(lshash.get_config())
+             }
+        )
+
+    async def load_hash_configuration(self, hash_name):
+        """
+        Loads and returns hash configuration
+        """
+        conf = await self.mongo_object.find_one(
+            {'hash_conf_name': hash_name + '_conf'}
+        )
+        return pickle.loads(conf['hash_configuration']) if conf is not None\
+            else None
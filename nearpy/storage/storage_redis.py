@@ -27,6 +27,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import json
+import struct
 import numpy
 import scipy
 try:
@@ -36,27 +38,70 @@ except ImportError:
 
 from future.builtins import bytes
 from nearpy.storage.storage import Storage
-
+from nearpy.utils.utils import matrix_rows
+
+# Bucket rows start with this header: magic, row format, dtype character of
+# the values, vector dimension, count of values (the dimension for dense
+# vectors) and length of the pickled data, which is 0 if data is None.
+ROW_HEADER = struct.Struct('<2sBcIII')
+ROW_HEADER_DTYPE = numpy.dtype([('magic', 'S2'), ('format', 'u1'),
+                                ('dtype', 'S1'), ('dim', '<u4'),
+                                ('count', '<u4'), ('data_length', '<u4')])
+ROW_MAGIC = b'NP'
+DENSE_ROW = 0
+SPARSE_ROW = 1
 
 class RedisStorage(Storage):
 
     """ Storage using redis. """
 
-    def __init__(self, redis_object):
-        """ Uses specified redis object for storage. """
+    # Number of buckets read and rewritten per pipeline when going through
+    # all buckets
+    compact_batch_size = 1000
+
+    def __init__(self, redis_object, store_vectors_once=False,
+                 index_data=False):
+        """
+        Uses specified redis object for storage.
+
+        If store_vectors_once is True, every vector and its data is stored
+        only once in a redis hash under an integer id and the bucket lists
+        just hold these ids, instead of a full copy per hash.
+
+        If index_data is True, a redis set per data value holds the buckets
+        of the vectors with that data, so that deleting a vector only
+        touches these buckets. Only vectors stored with index_data set are
+        in this index.
+
+        With store_vectors_once, deleting a vector only removes the vector
+        and records its id in a redis set of tombstones. Reading a bucket
+        skips these ids, compact() removes them from the bucket lists.
+        """
         self.redis_object = redis_object
+        self.store_vectors_once = store_vectors_once
+        self.index_data = index_data
+        self.vectors_key = 'nearpy__vectors'
+        self.next_id_key = 'nearpy__next_id'
+        self.deleted_key = 'nearpy__deleted'
 
     def store_vector(self, hash_name, bucket_key, v, data):
         """
         Stores vector and JSON-serializable data in bucket with specified key.
         """
-        self._add_vector(hash_name, bucket_key, v, data, self.redis_object)
+        if self.store_vectors_once:
+            self.store_postings([(hash_name, bucket_key, 0)], [v], [data])
+        else:
+            self._add_vector(hash_name, bucket_key, v, data, self.redis_object)
 
     def store_many_vectors(self, hash_name, bucket_keys, vs, data):
         """
         Store a batch of vectors in Redis.
         Stores vector and JSON-serializable data in bucket with specified key.
         """
+        if self.store_vectors_once:
+            self.store_postings([(hash_name, bucket_key, row) for row, bucket_key
+                                 in enumerate(bucket_keys)], vs, data)
+            return
         with self.redis_object.pipeline() as pipeline:
             if data is None:
                 data = [None] * len(vs)
@@ -64,45 +109,114 @@ class RedisStorage(Storage):
                 self._add_vector(hash_name, bucket_key, v, data, pipeline)
             pipeline.execute()
 
+    def store_postings(self, postings, vs, data):
+        """
+        Stores a batch of vectors in buckets of any number of hashes.
+        Every vector is encoded once and all rows are pushed in one pipeline.
+        """
+        vs = matrix_rows(vs)
+        if data is None:
+            data = [None] * len(vs)
+        rows = [self._encode_vector(v, d) for v, d in zip(vs, data)]
+        if self.store_vectors_once:
+            # Reserve one id per row and push ids instead of the rows
+            first_id = self.redis_object.incrby(self.next_id_key,
+                                                len(rows)) - len(rows)
+            with self.redis_object.pipeline() as pipeline:
+                if rows:
+                    pipeline.hmset(self.vectors_key,
+                                   dict((first_id + row, encoded)
+                                        for row, encoded in enumerate(rows)))
+                for hash_name, bucket_key, row in postings:
+                    redis_key = self._format_redis_key(hash_name, bucket_key)
+                    pipeline.rpush(redis_key, first_id + row)
+                    self._add_data_bucket(pipeline, hash_name, bucket_key,
+                                          data[row])
+                pipeline.execute()
+            return
+        with self.redis_object.pipeline() as pipeline:
+            for hash_name, bucket_key, row in postings:
+                redis_key = self._format_redis_key(hash_name, bucket_key)
+                pipeline.rpush(redis_key, rows[row])
+                self._add_data_bucket(pipeline, hash_name, bucket_key,
+                                      data[row])
+            pipeline.execute()
+
     def _add_vector(self, hash_name, bucket_key, v, data, redis_object):
         '''
         Store vector and JSON-serializable data in bucket with specified key.
         '''
         redis_key = self._format_redis_key(hash_name, bucket_key)
 
-        val_dict = {}
+        # Push encoded row to end of bucket list
+        redis_object.rpush(redis_key, self._encode_vector(v, data))
+        self._add_data_bucket(redis_object, hash_name, bucket_key, data)
 
-        # Depending on type (sparse or not) fill value dict
-        if scipy.sparse.issparse(v):
-            # Make sure that we are using COO format (easy to handle)
-            if not scipy.sparse.isspmatrix_coo(v):
-                v = scipy.sparse.coo_matrix(v)
+    def _format_data_key(self, data):
+        return 'nearpy__data_{}'.format(json.dumps(data, sort_keys=True,
+                                                   default=str))
 
-            # Construct list of [index, value] items,
-            # one for each non-zero element of the sparse vector
-            encoded_values = []
+    def _format_data_bucket(self, hash_name, bucket_key):
+        return json.dumps([hash_name, '{}'.format(bucket_key)])
 
-            for k in range(v.data.size):
-                row_index = v.row[k]
-                value = v.data[k]
-                encoded_values.append([int(row_index), value])
+    def _add_data_bucket(self, redis_object, hash_name, bucket_key, data):
+        """
+        Adds bucket to the set of buckets of data, if index_data is set.
+        """
+        if self.index_data and data is not None:
+            redis_object.sadd(self._format_data_key(data),
+                              self._format_data_bucket(hash_name, bucket_key))
 
-            val_dict['sparse'] = 1
-            val_dict['nonzeros'] = encoded_values
-            val_dict['dim'] = v.shape[0]
-        else:
-            # Make sure it is a 1d vector
-            v = numpy.reshape(v, v.shape[0])
-            val_dict['vector'] = v.tostring()
+    def _remove_data_buckets(self, redis_object, hash_name, bucket_keys,
+                             data):
+        """
+        Removes buckets from the set of buckets of data.
+        """
+        if self.index_data and data is not None and bucket_keys:
+            redis_object.srem(self._format_data_key(data),
+                              *(self._format_data_bucket(hash_name, key)
+                                for key in bucket_keys))
 
-        val_dict['dtype'] = v.dtype.name
+    def _hash_members(self, hash_name, members):
+        """
+        Returns the members of a data set that are buckets of hash_name.
+        """
+        return [member for member in members
+                if json.loads(bytes(member).decode())[0] == hash_name]
 
-        # Add data if set
-        if data is not None:
-            val_dict['data'] = data
+    def _data_bucket_keys(self, hash_name, members):
+        """
+        Returns the bucket keys of hash_name from the members of a data set.
+        """
+        bucket_keys = []
+        for member in members:
+            member_hash_name, bucket_key = json.loads(bytes(member).decode())
+            if member_hash_name == hash_name:
+                bucket_keys.append(bucket_key)
+        return bucket_keys
+
+    def _encode_vector(self, v, data):
+        '''
+        Returns binary row for bucket lists: the fixed header, the raw
+        little-endian values (preceded by their int32 row indices if v is
+        sparse) and finally the pickled data, if not None.
+        '''
+        if scipy.sparse.issparse(v):
+            # Make sure that we are using COO format (easy to handle)
+            v = scipy.sparse.coo_matrix(v)
+            row_format, dim, values = SPARSE_ROW, v.shape[0], v.data
+            indices = v.row.astype('<i4').tobytes()
+        else:
+            # Make sure it is a 1d vector
+            values = numpy.ravel(v)
+            row_format, dim, indices = DENSE_ROW, values.shape[0], b''
 
-        # Push JSON representation of dict to end of bucket list
-        self.redis_object.rpush(redis_key, pickle.dumps(val_dict, protocol=2))
+        dtype = values.dtype.newbyteorder('<')
+        encoded_data = b'' if data is None else pickle.dumps(data, protocol=2)
+        header = ROW_HEADER.pack(ROW_MAGIC, row_format, dtype.char.encode(),
+                                 dim, values.shape[0], len(encoded_data))
+        return b''.join([header, indices, values.astype(dtype).tobytes(),
+                         encoded_data])
 
     def _format_redis_key(self, hash_name, bucket_key):
         return '{}{}'.format(self._format_hash_prefix(hash_name), bucket_key)
@@ -123,14 +237,29 @@ class RedisStorage(Storage):
         redis_key = self._format_redis_key(hash_name, bucket_key)
         return self.redis_object.lrange(redis_key, 0, -1)
 
+    def get_data_bucket_keys(self, hash_name, data):
+        """
+        Returns keys of the buckets of the given hash holding vectors with
+        the specified data, if index_data is set.
+        """
+        if not self.index_data or data is None:
+            return None
+        return self._data_bucket_keys(hash_name, self.redis_object.smembers(
+            self._format_data_key(data)))
+
     def delete_vector(self, hash_name, bucket_keys, data):
         """
         Deletes vector and JSON-serializable data in buckets with specified keys.
         """
+        bucket_keys = list(bucket_keys)
+        if self.store_vectors_once:
+            self._delete_vector_ids(hash_name, bucket_keys, data)
+            return
         with self.redis_object.pipeline() as pipeline:
+            self._remove_data_buckets(pipeline, hash_name, bucket_keys, data)
             for key in bucket_keys:
                 redis_key = self._format_redis_key(hash_name, key)
-                rows = [(row, pickle.loads(row).get('data'))
+                rows = [(row, self._decode_data(row))
                         for row in self._get_bucket_rows(hash_name, key)]
                 for _, id_data in rows:
                     if id_data == data:
@@ -143,50 +272,361 @@ class RedisStorage(Storage):
                                             if id_data != data))
             pipeline.execute()
 
+    def _delete_vector_ids(self, hash_name, bucket_keys, data):
+        """
+        Deletes the vectors with the specified data and records their ids
+        as tombstones. The buckets are left alone.
+        """
+        bucket_ids = self.get_buckets_ids([(hash_name, key)
+                                           for key in bucket_keys])
+        ids = numpy.unique(self._concatenate_ids(bucket_ids)).tolist()
+        deleted = self._matching_ids(ids, self._get_vector_rows(ids), data)
+        with self.redis_object.pipeline() as pipeline:
+            self._remove_data_buckets(pipeline, hash_name, bucket_keys, data)
+            self._add_tombstones(pipeline, deleted)
+            pipeline.execute()
+
+    def _matching_ids(self, ids, rows, data):
+        """
+        Returns ids of the rows holding the specified data, rows of vectors
+        deleted already are None.
+        """
+        return [vector_id for vector_id, row in zip(ids, rows)
+                if row is not None and self._decode_data(row) == data]
+
+    def _add_tombstones(self, redis_object, ids):
+        if ids:
+            redis_object.hdel(self.vectors_key, *ids)
+            redis_object.sadd(self.deleted_key, *ids)
+
+    def compact(self, threshold=0.5):
+        """
+        Removes the ids of deleted vectors from all buckets in which they
+        make up at least threshold of the ids. Tombstones are dropped once
+        no bucket holds their id anymore.
+
+        Buckets are rewritten, so vectors should not be stored at the same
+        time.
+        """
+        if not self.store_vectors_once:
+            return
+        deleted = set(int(vector_id) for vector_id
+                      in self.redis_object.smembers(self.deleted_key))
+        if not deleted:
+            return
+        remaining = set()
+        for batch, bucket_rows in self._iter_lists(self._bucket_redis_keys()):
+            with self.redis_object.pipeline() as pipeline:
+                remaining.update(self._compact_buckets(
+                    pipeline, batch, bucket_rows, deleted, threshold))
+                pipeline.execute()
+        dropped = deleted - remaining
+        if dropped:
+            self.redis_object.srem(self.deleted_key, *dropped)
+
+    def _bucket_redis_keys(self):
+        """ Returns the redis keys of the buckets of all hashes. """
+        return [key for key in self.redis_object.scan_iter('nearpy_*')
+                if self._is_bucket_redis_key(key)]
+
+    def _iter_lists(self, redis_keys):
+        """
+        Yields batches of the redis keys together with the content of their
+        lists, every batch is read with one pipeline.
+        """
+        for start in range(0, len(redis_keys), self.compact_batch_size):
+            batch = redis_keys[start:start + self.compact_batch_size]
+            with self.redis_object.pipeline() as pipeline:
+                for redis_key in batch:
+                    pipeline.lrange(redis_key, 0, -1)
+                bucket_rows = pipeline.execute()
+            yield batch, bucket_rows
+
+    def _is_bucket_redis_key(self, redis_key):
+        # Vectors, tombstones and the data index start with nearpy__
+        return not bytes(redis_key).startswith(b'nearpy__')
+
+    def _compact_buckets(self, redis_object, redis_keys, bucket_rows,
+                         deleted, threshold):
+        """
+        Rewrites the buckets in which the deleted ids make up at least
+        threshold of the ids. Returns the deleted ids left in buckets.
+        """
+        remaining = set()
+        for redis_key, rows in zip(redis_keys, bucket_rows):
+            ids = [int(vector_id) for vector_id in rows]
+            dead = [vector_id for vector_id in ids if vector_id in deleted]
+            if not dead:
+                continue
+            if len(dead) < threshold * len(ids):
+                remaining.update(dead)
+                continue
+            redis_object.delete(redis_key)
+            kept = [vector_id for vector_id in ids
+                    if vector_id not in deleted]
+            if kept:
+                redis_object.rpush(redis_key, *kept)
+        return remaining
+
     def get_bucket(self, hash_name, bucket_key):
         """
         Returns bucket content as list of tuples (vector, data).
         """
-        results = []
-        for row in self._get_bucket_rows(hash_name, bucket_key):
-            val_dict = pickle.loads(row)
-            # Depending on type (sparse or not) reconstruct vector
-            if 'sparse' in val_dict:
+        if self.store_vectors_once:
+            return self.get_vectors(self.get_bucket_ids(hash_name, bucket_key))
+        return self._decode_rows(self._get_bucket_rows(hash_name, bucket_key))
+
+    def get_buckets(self, bucket_keys):
+        """
+        Returns list with the content of every bucket in the specified list
+        of (hash_name, bucket_key) tuples. All buckets are fetched with one
+        pipeline (and all vectors with one more request if they are stored
+        once) and decoded at once.
+        """
+        if self.store_vectors_once:
+            bucket_ids = self.get_buckets_ids(bucket_keys)
+            rows = self._get_vector_rows(self._concatenate_ids(bucket_ids))
+            bucket_rows = self._split_rows(rows, bucket_ids)
+        else:
+            bucket_rows = self._get_buckets_rows(bucket_keys)
+        return self._decode_buckets(bucket_rows)
+
+    def _concatenate_ids(self, bucket_ids):
+        return numpy.concatenate(bucket_ids +
+                                 [numpy.empty(0, dtype=numpy.int64)])
+
+    def _split_rows(self, rows, bucket_ids):
+        """
+        Splits the rows fetched for the concatenated ids into one list per
+        bucket.
+        """
+        ends = numpy.cumsum([len(ids) for ids in bucket_ids])
+        return [rows[end - len(ids):end]
+                for ids, end in zip(bucket_ids, ends)]
+
+    def _decode_buckets(self, bucket_rows):
+        """
+        Returns list of bucket contents from list of rows per bucket, all
+        rows are decoded at once.
+        """
+        # Rows of deleted vectors are None and dropped
+        counts = [len(rows) - rows.count(None) for rows in bucket_rows]
+        decoded = self._decode_rows([row for rows in bucket_rows
+                                     for row in rows if row is not None])
+        ends = numpy.cumsum(counts)
+        return [decoded[end - count:end] for count, end in zip(counts, ends)]
+
+    def _get_buckets_rows(self, bucket_keys):
+        with self.redis_object.pipeline() as pipeline:
+            for hash_name, bucket_key in bucket_keys:
+                redis_key = self._format_redis_key(hash_name, bucket_key)
+                pipeline.lrange(redis_key, 0, -1)
+            return pipeline.execute()
+
+    def get_bucket_ids(self, hash_name, bucket_key):
+        """
+        Returns ids of the vectors in the bucket as numpy array.
+        """
+        return self._ids_array(self._get_bucket_rows(hash_name, bucket_key))
+
+    def get_buckets_ids(self, bucket_keys):
+        """
+        Returns list with the ids of every bucket in the specified list of
+        (hash_name, bucket_key) tuples, fetched with one pipeline.
+        """
+        return [self._ids_array(rows)
+                for rows in self._get_buckets_rows(bucket_keys)]
 
-                # Fill these for COO creation
-                row = []
-                col = []
-                data = []
+    def _ids_array(self, rows):
+        return numpy.array([int(vector_id) for vector_id in rows],
+                           dtype=numpy.int64)
 
-                # For each non-zero element, append values
-                for e in val_dict['nonzeros']:
-                    row.append(e[0])  # Row index
-                    data.append(e[1])  # Value
-                    col.append(0)  # Column index (always 0)
+    def get_vectors(self, ids):
+        """
+        Returns list of tuples (vector, data) for the specified ids, fetched
+        with one request.
+        """
+        rows = self._get_vector_rows(ids)
+        return self._decode_rows([row for row in rows if row is not None])
 
-                # Create numpy arrays for COO creation
-                coo_row = numpy.array(row, dtype=numpy.int32)
-                coo_col = numpy.array(col, dtype=numpy.int32)
-                coo_data = numpy.array(data)
+    def _get_vector_rows(self, ids):
+        """
+        Returns list of encoded rows for the specified ids, None for ids of
+        deleted vectors.
+        """
+        if len(ids) == 0:
+            return []
+        return self.redis_object.hmget(self.vectors_key,
+                                       [int(vector_id) for vector_id in ids])
 
-                # Create COO sparse vector
-                vector = scipy.sparse.coo_matrix((coo_data, (coo_row, coo_col)), shape=(val_dict['dim'], 1))
+    def _decode_rows(self, rows):
+        """
+        Returns list of tuples (vector, data) from bucket rows.
 
-            else:
-                vector = numpy.fromstring(val_dict['vector'],
-                                          dtype=val_dict['dtype'])
+        If all rows hold dense vectors with the same dtype and dimension,
+        the vectors are cut out of the concatenated rows at once and
+        returned as rows of one matrix. Only the data is decoded per row.
+        """
+        if len(rows) == 0:
+            return []
+        lengths = numpy.array([len(row) for row in rows])
+        if lengths.min() < ROW_HEADER.size:
+            return [self._decode_row(row) for row in rows]
+
+        buf = numpy.frombuffer(b''.join(rows), dtype=numpy.uint8)
+        starts = numpy.cumsum(lengths) - lengths
+        headers = buf[starts[:, numpy.newaxis] +
+                      numpy.arange(ROW_HEADER.size)].view(ROW_HEADER_DTYPE)
+        headers = headers.ravel()
+        if not (numpy.all(headers['magic'] == ROW_MAGIC) and
+                numpy.all(headers['format'] == DENSE_ROW) and
+                numpy.all(headers['dtype'] == headers['dtype'][0]) and
+                numpy.all(headers['dim'] == headers['dim'][0])):
+            return [self._decode_row(row) for row in rows]
+
+        dim = int(headers['dim'][0])
+        dtype = numpy.dtype(headers['dtype'][0].decode()).newbyteorder('<')
+        width = dim * dtype.itemsize
+
+        # Mask the value bytes of all rows (1 from the first value byte up
+        # to the last one) and gather them with one boolean index
+        value_starts = starts + ROW_HEADER.size
+        marks = numpy.zeros(len(buf) + 1, dtype=numpy.int8)
+        marks[value_starts] = 1
+        marks[value_starts + width] -= 1
+        mask = numpy.cumsum(marks[:-1], dtype=numpy.int8).view(bool)
+        vectors = buf[mask].view(dtype).reshape(len(rows), dim)
+        vectors = vectors.astype(dtype.newbyteorder('='), copy=False)
+
+        offset = ROW_HEADER.size + width
+        data = [pickle.loads(row[offset:]) if data_length else None
+                for row, data_length in zip(rows, headers['data_length'])]
+        return list(zip(vectors, data))
+
+    def _decode_row(self, row):
+        """
+        Returns tuple (vector, data) from one bucket row.
+        """
+        if not row.startswith(ROW_MAGIC):
+            # Row has been stored as pickled dict by an older version
+            return self._decode_vector(pickle.loads(row))
+
+        _, row_format, dtype, dim, count, data_length = \
+            ROW_HEADER.unpack_from(row)
+        dtype = numpy.dtype(dtype.decode()).newbyteorder('<')
+        offset = ROW_HEADER.size
+        if row_format == SPARSE_ROW:
+            indices = numpy.frombuffer(row, '<i4', count, offset)
+            offset += indices.nbytes
+        values = numpy.frombuffer(row, dtype, count, offset)
+        values = values.astype(dtype.newbyteorder('='))
+
+        if row_format == SPARSE_ROW:
+            vector = scipy.sparse.coo_matrix(
+                (values, (indices.astype(numpy.int32),
+                          numpy.zeros(count, dtype=numpy.int32))),
+                shape=(dim, 1))
+        else:
+            vector = values
 
-            # Add data to result tuple, if present
-            results.append((vector, val_dict.get('data')))
+        return (vector, self._decode_data(row))
 
-        return results
+    def _decode_data(self, row):
+        """
+        Returns data of bucket row without decoding the vector.
+        """
+        if not row.startswith(ROW_MAGIC):
+            return pickle.loads(row).get('data')
+        data_length = ROW_HEADER.unpack_from(row)[-1]
+        if data_length == 0:
+            return None
+        return pickle.loads(row[len(row) - data_length:])
+
+    def _decode_vector(self, val_dict):
+        """
+        Returns tuple (vector, data) from unpickled bucket row (the format
+        of older versions).
+        """
+        # Depending on type (sparse or not) reconstruct vector
+        if 'sparse' in val_dict:
+
+            # Fill these for COO creation
+            row = []
+            col = []
+            data = []
+
+            # For each non-zero element, append values
+            for e in val_dict['nonzeros']:
+                row.append(e[0])  # Row index
+                data.append(e[1])  # Value
+                col.append(0)  # Column index (always 0)
+
+            # Create numpy arrays for COO creation
+            coo_row = numpy.array(row, dtype=numpy.int32)
+            coo_col = numpy.array(col, dtype=numpy.int32)
+            coo_data = numpy.array(data)
+
+            # Create COO sparse vector
+            vector = scipy.sparse.coo_matrix((coo_data, (coo_row, coo_col)), shape=(val_dict['dim'], 1))
+
+        else:
+            vector = numpy.fromstring(val_dict['vector'],
+                                      dtype=val_dict['dtype'])
+
+        # Add data to result tuple, if present
+        return (vector, val_dict.get('data'))
 
     def clean_buckets(self, hash_name):
         """
-        Removes all buckets and their content for specified hash.
+        Removes all buckets and their content for specified hash. With
+        store_vectors_once, the vectors no bucket of another hash holds
+        are deleted as well.
         """
-        bucket_keys = self._iter_bucket_keys(hash_name)
+        if self.index_data:
+            self._clean_data_buckets(hash_name)
+        bucket_keys = list(self._iter_bucket_keys(hash_name))
+        if not bucket_keys:
+            return
+        ids = set()
+        if self.store_vectors_once:
+            for _, bucket_rows in self._iter_lists(bucket_keys):
+                ids.update(self._rows_ids(bucket_rows))
         self.redis_object.delete(*bucket_keys)
+        if ids:
+            held = set()
+            for _, bucket_rows in self._iter_lists(self._bucket_redis_keys()):
+                held.update(ids.intersection(self._rows_ids(bucket_rows)))
+            self._remove_vectors(ids - held)
+
+    def _clean_data_buckets(self, hash_name):
+        """
+        Removes the buckets of hash_name from all sets of the data index.
+        """
+        data_keys = list(self.redis_object.scan_iter('nearpy__data_*'))
+        for start in range(0, len(data_keys), self.compact_batch_size):
+            batch = data_keys[start:start + self.compact_batch_size]
+            with self.redis_object.pipeline() as pipeline:
+                for data_key in batch:
+                    pipeline.smembers(data_key)
+                member_sets = pipeline.execute()
+            with self.redis_object.pipeline() as pipeline:
+                for data_key, members in zip(batch, member_sets):
+                    members = self._hash_members(hash_name, members)
+                    if members:
+                        pipeline.srem(data_key, *members)
+                pipeline.execute()
+
+    def _rows_ids(self, bucket_rows):
+        return set(int(vector_id) for rows in bucket_rows
+                   for vector_id in rows)
+
+    def _remove_vectors(self, ids):
+        """ Removes the vectors and tombstones of ids no bucket holds. """
+        if ids:
+            with self.redis_object.pipeline() as pipeline:
+                pipeline.hdel(self.vectors_key, *ids)
+                pipeline.srem(self.deleted_key, *ids)
+                pipeline.execute()
 
     def clean_all_buckets(self):
         """
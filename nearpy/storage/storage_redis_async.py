@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from future.builtins import bytes
+from nearpy.storage.storage_redis import RedisStorage
+from nearpy.utils.utils import matrix_rows
+
+
+class AsyncRedisStorage(RedisStorage):
+
+    """
+    Storage using redis with an asyncio client, like redis.asyncio.Redis.
+    All methods of the storage interface are coroutines, use it with
+    AsyncEngine.
+
+    Rows are encoded like in RedisStorage, so an index written by one of
+    them can be read by the other.
+    """
+
+    async def store_vector(self, hash_name, bucket_key, v, data):
+        """
+        Stores vector and JSON-serializable data in bucket with specified key.
+        """
+        await self.store_postings([(hash_name, bucket_key, 0)], [v], [data])
+
+    async def store_many_vectors(self, hash_name, bucket_keys, vs, data):
+        """
+        Store a batch of vectors in Redis.
+        Stores vector and JSON-serializable data in bucket with specified key.
+        """
+        await self.store_postings([(hash_name, bucket_key, row) for row, bucket_key
+                                   in enumerate(bucket_keys)], vs, data)
+
+    async def store_postings(self, postings, vs, data):
+        """
+        Stores a batch of vectors in buckets of any number of hashes.
+        Every vector is encoded once and all rows are pushed in one pipeline.
+        """
+        vs = matrix_rows(vs)
+        if data is None:
+            data = [None] * len(vs)
+        rows = [self._encode_vector(v, d) for v, d in zip(vs, data)]
+        if self.store_vectors_once:
+            # Reserve one id per row and push ids instead of the rows
+            first_id = await self.redis_object.incrby(self.next_id_key,
+                                                      len(rows)) - len(rows)
+            values = [first_id + row for row in range(len(rows))]
+        else:
+            values = rows
+        async with self.redis_object.pipeline() as pipeline:
+            if self.store_vectors_once and rows:
+                pipeline.hset(self.vectors_key,
+                              mapping=dict(zip(values, rows)))
+            for hash_name, bucket_key, row in postings:
+                redis_key = self._format_redis_key(hash_name, bucket_key)
+                pipeline.rpush(redis_key, values[row])
+                self._add_data_bucket(pipeline, hash_name, bucket_key,
+                                      data[row])
+            await pipeline.execute()
+
+    async def get_all_bucket_keys(self, hash_name):
+        prefix_len = len(self._format_hash_prefix(hash_name))
+        return [bytes(key).decode()[prefix_len:]
+                for key in await self._get_bucket_redis_keys(hash_name)]
+
+    async def _get_bucket_redis_keys(self, hash_name):
+        pattern = "{}*".format(self._format_hash_prefix(hash_name))
+        return [key async for key in self.redis_object.scan_iter(pattern)]
+
+    async def get_data_bucket_keys(self, hash_name, data):
+        """
+        Returns keys of the buckets of the given hash holding vectors with
+        the specified data, if index_data is set.
+        """
+        if not self.index_data or data is None:
+            return None
+        return self._data_bucket_keys(hash_name, await self.redis_object.smembers(
+            self._format_data_key(data)))
+
+    async def delete_vector(self, hash_name, bucket_keys, data):
+        """
+        Deletes vector and JSON-serializable data in buckets with specified keys.
+        The buckets are fetched with one pipeline and rewritten with another.
+        With store_vectors_once the vectors are deleted and their ids
+        recorded as tombstones instead, the buckets are left alone.
+        """
+        bucket_keys = list(bucket_keys)
+        bucket_rows = await self._get_buckets_rows(
+            [(hash_name, key) for key in bucket_keys])
+        if self.store_vectors_once:
+            ids = list(set(int(vector_id) for rows in bucket_rows
+                           for vector_id in rows))
+            deleted = self._matching_ids(
+                ids, await self._get_vector_rows(ids), data)
+            async with self.redis_object.pipeline() as pipeline:
+                self._remove_data_buckets(pipeline, hash_name, bucket_keys,
+                                          data)
+                self._add_tombstones(pipeline, deleted)
+                await pipeline.execute()
+            return
+        deleted = set(row for rows in bucket_rows for row in rows
+                      if self._decode_data(row) == data)
+        if not deleted:
+            # Deleted data is not present in these buckets
+            return
+        async with self.redis_object.pipeline() as pipeline:
+            self._remove_data_buckets(pipeline, hash_name, bucket_keys, data)
+            for key, rows in zip(bucket_keys, bucket_rows):
+                if deleted.isdisjoint(rows):
+                    continue
+                redis_key = self._format_redis_key(hash_name, key)
+                pipeline.delete(redis_key)
+                kept = [row for row in rows if row not in deleted]
+                if kept:
+                    pipeline.rpush(redis_key, *kept)
+            await pipeline.execute()
+
+    async def compact(self, threshold=0.5):
+        """
+        Removes the ids of deleted vectors from all buckets in which they
+        make up at least threshold of the ids. Tombstones are dropped once
+        no bucket holds their id anymore.
+
+        Buckets are rewritten, so vectors should not be stored at the same
+        time.
+        """
+        if not self.store_vectors_once:
+            return
+        deleted = set(int(vector_id) for vector_id
+                      in await self.redis_object.smembers(self.deleted_key))
+        if not deleted:
+            return
+        remaining = set()
+        async for batch, bucket_rows in self._iter_lists(
+                await self._bucket_redis_keys()):
+            async with self.redis_object.pipeline() as pipeline:
+                remaining.update(self._compact_buckets(
+                    pipeline, batch, bucket_rows, deleted, threshold))
+                await pipeline.execute()
+        dropped = deleted - remaining
+        if dropped:
+            await self.redis_object.srem(self.deleted_key, *dropped)
+
+    async def _bucket_redis_keys(self):
+        """ Returns the redis keys of the buckets of all hashes. """
+        return [key async for key
+                in self.redis_object.scan_iter('nearpy_*')
+                if self._is_bucket_redis_key(key)]
+
+    async def _iter_lists(self, redis_keys):
+        """
+        Yields batches of the redis keys together with the content of their
+        lists, every batch is read with one pipeline.
+        """
+        for start in range(0, len(redis_keys), self.compact_batch_size):
+            batch = redis_keys[start:start + self.compact_batch_size]
+            async with self.redis_object.pipeline() as pipeline:
+                for redis_key in batch:
+                    pipeline.lrange(redis_key, 0, -1)
+                bucket_rows = await pipeline.execute()
+            yield batch, bucket_rows
+
+    async def get_bucket(self, hash_name, bucket_key):
+        """
+        Returns bucket content as list of tuples (vector, data).
+        """
+        return (await self.get_buckets([(hash_name, bucket_key)]))[0]
+
+    async def get_buckets(self, bucket_keys):
+        """
+        Returns list with the content of every bucket in the specified list
+        of (hash_name, bucket_key) tuples. All buckets are fetched with one
+        pipeline (and all vectors with one more request if they are stored
+        once) and decoded at once.
+        """
+        if self.store_vectors_once:
+            bucket_ids = await self.get_buckets_ids(bucket_keys)
+            rows = await self._get_vector_rows(
+                self._concatenate_ids(bucket_ids))
+            bucket_rows = self._split_rows(rows, bucket_ids)
+        else:
+            bucket_rows = await self._get_buckets_rows(bucket_keys)
+        return self._decode_buckets(bucket_rows)
+
+    async def _get_buckets_rows(self, bucket_keys):
+        async with self.redis_object.pipeline() as pipeline:
+            for hash_name, bucket_key in bucket_keys:
+                redis_key = self._format_redis_key(hash_name, bucket_key)
+                pipeline.lrange(redis_key, 0, -1)
+            return await pipeline.execute()
+
+    async def get_bucket_ids(self, hash_name, bucket_key):
+        """
+        Returns ids of the vectors in the bucket as numpy array.
+        """
+        return (await self.get_buckets_ids([(hash_name, bucket_key)]))[0]
+
+    async def get_buckets_ids(self, bucket_keys):
+        """
+        Returns list with the ids of every bucket in the specified list of
+        (hash_name, bucket_key) tuples, fetched with one pipeline.
+        """
+        return [self._ids_array(rows)
+                for rows in await self._get_buckets_rows(bucket_keys)]
+
+    async def get_vectors(self, ids):
+        """
+        Returns list of tuples (vector, data) for the specified ids, fetched
+        with one request.
+        """
+        rows = await self._get_vector_rows(ids)
+        return self._decode_rows([row for row in rows if row is not None])
+
+    async def _get_vector_rows(self, ids):
+        """
+        Returns list of encoded rows for the specified ids, None for ids of
+        deleted vectors.
+        """
+        if len(ids) == 0:
+            return []
+        return await self.redis_object.hmget(
+            self.vectors_key, [int(vector_id) for vector_id in ids])
+
+    async def clean_buckets(self, hash_name):
+        """
+        Removes all buckets and their content for specified hash. With
+        store_vectors_once, the vectors no bucket of another hash holds
+        are deleted as well.
+        """
+        if self.index_data:
+            await self._clean_data_buckets(hash_name)
+        bucket_keys = await self._get_bucket_redis_keys(hash_name)
+        if not bucket_keys:
+            return
+        ids = set()
+        if self.store_vectors_once:
+            async for _, bucket_rows in self._iter_lists(bucket_keys):
+                ids.update(self._rows_ids(bucket_rows))
+        await self.redis_object.delete(*bucket_keys)
+        if ids:
+            held = set()
+            async for _, bucket_rows in self._iter_lists(
+                    await self._bucket_redis_keys()):
+                held.update(ids.intersection(self._rows_ids(bucket_rows)))
+            await self._remove_vectors(ids - held)
+
+    async def _clean_data_buckets(self, hash_name):
+        """
+        Removes the buckets of hash_name from all sets of the data index.
+        """
+        data_keys = [key async for key
+                     in self.redis_object.scan_iter('nearpy__data_*')]
+        for start in range(0, len(data_keys), self.compact_batch_size):
+            batch = data_keys[start:start + self.compact_batch_size]
+            async with self.redis_object.pipeline() as pipeline:
+                for data_key in batch:
+                    pipeline.smembers(data_key)
+                member_sets = await pipeline.execute()
+            async with self.redis_object.pipeline() as pipeline:
+                for data_key, members in zip(batch, member_sets):
+                    members = self._hash_members(hash_name, members)
+                    if members:
+                        pipeline.srem(data_key, *members)
+                await pipeline.execute()
+
+    async def _remove_vectors(self, ids):
+        """ Removes the vectors and tombstones of ids no bucket holds. """
+        if ids:
+            async with self.redis_object.pipeline() as pipeline:
+                pipeline.hdel(self.vectors_key, *ids)
+                pipeline.srem(self.deleted_key, *ids)
+                await pipeline.execute()
+
+    async def clean_all_buckets(self):
+        """
+        Removes all buckets from all hashes and their content.
+        """
+        bucket_keys = await self.redis_object.keys('nearpy_*')
+        if len(bucket_keys) > 0:
+            await self.redis_object.delete(*bucket_keys)
+
+    async def store_hash_configuration(self, lshash):
+        """
+        Stores hash configuration
+        """
+        await self.redis_object.set(lshash.hash_name+'_conf',
+                                    pickle.dumps(lshash.get_config()))
+
+    async def load_hash_configuration(self, hash_name):
+        """
+        Loads and returns hash configuration
+        """
+        conf = await self.redis_object.get(hash_name+'_conf')
+
+        return pickle.loads(conf) if conf is not None else None
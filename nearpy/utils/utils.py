@@ -21,6 +21,10 @@
 # THE SOFTWARE.
 
 import sys
+import json
+import heapq
+import numbers
+import binascii
 import numpy
 import scipy
 
@@ -43,6 +47,200 @@ def numpy_array_from_list_or_numpy_array(vectors):
     return vectors
 
 
+def matrix_rows(vectors):
+    """
+    Returns list of the row vectors of matrix vectors.
+
+    Rows of numpy arrays are returned as 1d vectors, rows of scipy.sparse
+    matrices as (dim, 1) column vectors, which is the shape used for sparse
+    vectors everywhere else.
+    """
+    if scipy.sparse.issparse(vectors):
+        vectors = vectors.tocsr()
+        return [vectors.getrow(index).T for index in range(vectors.shape[0])]
+
+    return list(vectors)
+
+
+def stack_rows(vectors):
+    """
+    Returns matrix with one row per vector in the specified list. This is
+    the inverse of matrix_rows, so the list may hold numpy vectors or
+    scipy.sparse column vectors.
+
+    Argument may also be such a matrix already (input is returned).
+    """
+    if isinstance(vectors, numpy.ndarray) or scipy.sparse.issparse(vectors):
+        return vectors
+
+    if scipy.sparse.issparse(vectors[0]):
+        return scipy.sparse.hstack(vectors).T.tocsr()
+
+    if vectors[0].ndim == 1:
+        return numpy.vstack(vectors)
+
+    return numpy.hstack(vectors).T
+
+
+def binary_keys(projections, packed_keys=False):
+    """
+    Returns list of binary bucket keys, one for each row of the projection
+    matrix. Each column contributes one bit, which is set if the projection
+    is positive.
+
+    By default the keys are strings like '1010110011'. If packed_keys is
+    True, the bits are packed into integers instead, with the first column
+    as the most significant bit (so the packed key is int(string_key, 2)).
+    """
+    if scipy.sparse.issparse(projections):
+        projections = projections.toarray()
+    bits = numpy.atleast_2d(numpy.asarray(projections) > 0.0)
+
+    if packed_keys:
+        return pack_bits(bits)
+
+    # Build all strings at once from the ascii codes of '0' and '1'
+    chars = numpy.ascontiguousarray(bits, dtype=numpy.uint8) + ord('0')
+    return chars.view('S{}'.format(bits.shape[1])).ravel().astype(str).tolist()
+
+
+def discretized_keys(cells):
+    """
+    Returns list of bucket keys like '14_4_-1', one for each row of the
+    specified matrix of bin indices.
+    """
+    cells = numpy.atleast_2d(numpy.asarray(cells)).astype(int)
+    return ['_'.join(map(str, row)) for row in cells.tolist()]
+
+
+def pack_bits(bits):
+    """
+    Packs the rows of the specified boolean matrix into integers, with the
+    first column as the most significant bit.
+    """
+    if bits.shape[1] <= 64:
+        return pack_bits_array(bits).tolist()
+
+    packed = numpy.packbits(bits, axis=1)
+    padding = 8 * packed.shape[1] - bits.shape[1]
+    return [int(binascii.hexlify(row.tobytes()), 16) >> padding
+            for row in packed]
+
+
+def pack_bits_array(bits):
+    """
+    Packs the rows of the specified boolean matrix with at most 64 columns
+    into a numpy uint64 array, with the first column as the most
+    significant bit.
+    """
+    packed = numpy.packbits(bits, axis=1)
+    padding = 8 * packed.shape[1] - bits.shape[1]
+    # Up to 64 bits fit into one big-endian unsigned integer per row
+    words = numpy.zeros((packed.shape[0], 8), dtype=numpy.uint8)
+    words[:, 8 - packed.shape[1]:] = packed
+    keys = words.view('>u8').ravel() >> numpy.uint64(padding)
+    return keys.astype(numpy.uint64)
+
+
+def unpack_keys(keys, bit_count):
+    """
+    Returns boolean matrix with one row of bit_count bits per binary bucket
+    key. Keys are either strings like '1010110011' or packed integer keys
+    of at most 64 bits.
+    """
+    if len(keys) > 0 and isinstance(keys[0], numbers.Integral):
+        shifts = numpy.arange(bit_count - 1, -1, -1, dtype=numpy.uint64)
+        keys = numpy.asarray(keys, dtype=numpy.uint64)
+        return ((keys[:, numpy.newaxis] >> shifts) & numpy.uint64(1)) == 1
+
+    chars = numpy.array(keys, dtype='S{}'.format(bit_count))
+    return chars.view(numpy.uint8).reshape(len(keys), bit_count) == ord('1')
+
+
+# Count of set bits of every byte value
+POPCOUNTS = numpy.array([bin(value).count('1') for value in range(256)],
+                        dtype=numpy.uint8)
+
+
+def popcounts(values):
+    """
+    Returns the count of set bits of every entry of the uint64 array.
+    """
+    values = numpy.ascontiguousarray(values, dtype=numpy.uint64)
+    return POPCOUNTS[values.view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def perturbation_sets(costs, count, conflicts=None):
+    """
+    Returns up to count sets of perturbations with the lowest total cost,
+    in increasing order of total cost, as tuples of indices into costs.
+    The first set is the empty one (the unperturbed bucket).
+
+    This is the heap based generation of query-directed multi-probe LSH
+    (Lv et al., 2007). If conflicts is specified, conflicts[i] is the
+    index of a perturbation that can not be combined with perturbation i
+    (like moving one coordinate in both directions).
+    """
+    order = numpy.argsort(costs, kind='mergesort')
+    sorted_costs = numpy.asarray(costs, dtype=float)[order].tolist()
+    order = order.tolist()
+    result = [()]
+    heap = [(sorted_costs[0], (0,))] if order else []
+    while heap and len(result) < count:
+        cost, positions = heapq.heappop(heap)
+        last = positions[-1]
+        if last + 1 < len(order):
+            # Shift (replace the last perturbation by the next one) and
+            # expand (add the next one)
+            heapq.heappush(heap, (cost - sorted_costs[last] +
+                                  sorted_costs[last + 1],
+                                  positions[:-1] + (last + 1,)))
+            heapq.heappush(heap, (cost + sorted_costs[last + 1],
+                                  positions + (last + 1,)))
+        indices = tuple(order[position] for position in positions)
+        if conflicts is not None and \
+                any(conflicts[index] in indices for index in indices):
+            continue
+        result.append(indices)
+    return result
+
+
+def discretized_probes(projection, count):
+    """
+    Returns matrix with the bin indices of the count most likely bins of
+    one vector, one row per bin, given its projections divided by the bin
+    width. The first row is the bin of the vector. Moving a coordinate one
+    bin down or up costs the squared distance to that bin boundary.
+    """
+    cells = numpy.floor(projection)
+    offsets = projection - cells
+    n = len(cells)
+    # Perturbation i moves coordinate i one bin down, n + i one bin up
+    costs = numpy.concatenate([offsets ** 2, (1.0 - offsets) ** 2])
+    conflicts = list(range(n, 2 * n)) + list(range(n))
+    moves = perturbation_sets(costs, count, conflicts)
+    probes = numpy.tile(cells, (len(moves), 1))
+    for probe, perturbations in enumerate(moves):
+        for perturbation in perturbations:
+            if perturbation < n:
+                probes[probe, perturbation] -= 1
+            else:
+                probes[probe, perturbation - n] += 1
+    return probes
+
+
+def data_key(data):
+    """
+    Returns hashable key for JSON-serializable data: the data itself if it
+    is hashable, its JSON representation otherwise (like for dicts).
+    """
+    try:
+        hash(data)
+        return data
+    except TypeError:
+        return json.dumps(data, sort_keys=True)
+
+
 def unitvec(vec):
     """
     Scale a vector to unit length. The only exception is the zero vector, which
@@ -65,6 +263,23 @@ def unitvec(vec):
             return vec
 
 
+def unitvecs(vectors):
+    """
+    Scales every row of the specified matrix (numpy array or scipy.sparse
+    matrix) to unit length. Zero rows are returned back unchanged.
+    """
+    if scipy.sparse.issparse(vectors):
+        vectors = vectors.tocsr()
+        veclens = numpy.sqrt(numpy.ravel(vectors.multiply(vectors).sum(axis=1)))
+        veclens[veclens == 0.0] = 1.0
+        return scipy.sparse.diags(1.0 / veclens).dot(vectors).tocsr()
+
+    vectors = numpy.asarray(vectors, dtype=float)
+    veclens = numpy.linalg.norm(vectors, axis=1)
+    veclens[veclens == 0.0] = 1.0
+    return vectors / veclens[:, numpy.newaxis]
+
+
 def perform_pca(A):
     """
     Computes eigenvalues and eigenvectors of covariance matrix of A.
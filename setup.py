@@ -19,7 +19,6 @@ setup(
     install_requires=[
         "numpy",
         "scipy",
-        "bitarray",
         "future",
     ],
     setup_requires=setup_requires,
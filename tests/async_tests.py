@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 Ole Krause-Sparmann
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+import time
+import unittest
+
+import mongomock
+import numpy
+from mockredis import MockRedis
+
+from nearpy import Engine, AsyncEngine
+from nearpy.filters import NearestFilter
+from nearpy.hashes import RandomBinaryProjections, UniBucket
+from nearpy.storage import RedisStorage, MongoStorage, AsyncRedisStorage, \
+    AsyncMongoStorage
+
+
+class FakeAsyncRedis(object):
+    """
+    Local stand-in for redis.asyncio.Redis. Commands run on a MockRedis
+    after waiting latency seconds, once per command or pipeline.
+    """
+
+    def __init__(self, redis_object, latency=0.0):
+        self.redis_object = redis_object
+        self.latency = latency
+
+    def __getattr__(self, name):
+        command = getattr(self.redis_object, name)
+
+        async def call(*args, **kwargs):
+            await asyncio.sleep(self.latency)
+            return command(*args, **kwargs)
+        return call
+
+    async def scan_iter(self, pattern):
+        await asyncio.sleep(self.latency)
+        for key in self.redis_object.scan_iter(pattern):
+            yield key
+
+    def pipeline(self):
+        return FakeAsyncPipeline(self)
+
+
+class FakeAsyncPipeline(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def hset(self, name, mapping):
+        self.commands.append(('hmset', (name, mapping)))
+
+    def __getattr__(self, name):
+        def queue(*args):
+            self.commands.append((name, args))
+        return queue
+
+    async def execute(self):
+        await asyncio.sleep(self.server.latency)
+        pipeline = self.server.redis_object.pipeline()
+        for name, args in self.commands:
+            getattr(pipeline, name)(*args)
+        self.commands = []
+        return pipeline.execute()
+
+
+class FakeMotorCollection(object):
+    """
+    Local stand-in for a motor collection, running on a mongomock
+    collection after waiting latency seconds per request.
+    """
+
+    def __init__(self, collection, latency=0.0):
+        self.collection = collection
+        self.latency = latency
+
+    def __getattr__(self, name):
+        command = getattr(self.collection, name)
+
+        async def call(*args, **kwargs):
+            await asyncio.sleep(self.latency)
+            return command(*args, **kwargs)
+        return call
+
+    def find(self, query):
+        return FakeMotorCursor(self, query)
+
+
+class FakeMotorCursor(object):
+
+    def __init__(self, server, query):
+        self.server = server
+        self.query = query
+
+    async def to_list(self, length):
+        await asyncio.sleep(self.server.latency)
+        return list(self.server.collection.find(self.query))
+
+
+class AsyncEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(4)
+        self.V = numpy.random.randn(60, 20)
+
+    def make_storages(self, store_vectors_once):
+        redis_object = MockRedis()
+        yield (RedisStorage(redis_object, store_vectors_once, index_data=True),
+               AsyncRedisStorage(FakeAsyncRedis(redis_object),
+                                 store_vectors_once, index_data=True))
+        collection = mongomock.MongoClient().db.collection
+        yield (MongoStorage(collection, store_vectors_once),
+               AsyncMongoStorage(FakeMotorCollection(collection),
+                                 store_vectors_once))
+
+    def make_hashes(self):
+        return [RandomBinaryProjections('rbp%d' % k, 3, rand_seed=k)
+                for k in range(2)]
+
+    def test_neighbours(self):
+        for store_vectors_once in (False, True):
+            for storage, async_storage in self.make_storages(
+                    store_vectors_once):
+                engine = Engine(20, lshashes=self.make_hashes(),
+                                storage=storage)
+                async_engine = AsyncEngine(20, lshashes=self.make_hashes(),
+                                           storage=async_storage)
+
+                async def run():
+                    await async_engine.store_many_vectors(self.V[:50],
+                                                          list(range(50)))
+                    for k in range(50, 60):
+                        await async_engine.store_vector(self.V[k], k)
+                    return await asyncio.gather(*(
+                        async_engine.neighbours(v) for v in self.V))
+                results = asyncio.run(run())
+
+                # Both engines read the same index
+                for v, result in zip(self.V, results):
+                    self.assertEqual(sorted(r[1] for r in result),
+                                     sorted(r[1] for r in engine.neighbours(v)))
+                self.assertEqual([r[0][1] for r in results], list(range(60)))
+
+    def test_delete_vector(self):
+        for store_vectors_once in (False, True):
+            for _, storage in self.make_storages(store_vectors_once):
+                engine = AsyncEngine(20, lshashes=[UniBucket('a'),
+                                                   UniBucket('b')],
+                                     storage=storage)
+
+                async def run():
+                    await engine.store_many_vectors(self.V[:10],
+                                                    list(range(10)))
+                    await engine.delete_vector(3)
+                    await engine.delete_vector(5, self.V[5])
+                    return await engine.candidate_count(self.V[0]), \
+                        await engine.neighbours(
+                            self.V[0], vector_filters=[NearestFilter(20)])
+                count, result = asyncio.run(run())
+                expected = [k for k in range(10) if k not in (3, 5)]
+                self.assertEqual(sorted(set(r[1] for r in result)), expected)
+                self.assertEqual(count, len(expected) *
+                                 (1 if store_vectors_once else 2))
+
+    def test_compact(self):
+        for storage, async_storage in self.make_storages(True):
+            engine = AsyncEngine(20, lshashes=[UniBucket('a')],
+                                 storage=async_storage)
+
+            async def run():
+                await engine.store_many_vectors(self.V[:10], list(range(10)))
+                for k in range(6):
+                    await engine.delete_vector(k)
+                await engine.compact()
+                return await engine.neighbours(
+                    self.V[0], vector_filters=[NearestFilter(20)])
+            result = asyncio.run(run())
+            self.assertEqual(sorted(r[1] for r in result), [6, 7, 8, 9])
+            # The ids of the deleted vectors are removed from the bucket
+            self.assertEqual(len(storage.get_bucket_ids('a', 'a')), 4)
+
+    def test_bulk_load(self):
+        reference = Engine(20, lshashes=self.make_hashes())
+        reference.store_many_vectors(self.V, list(range(60)))
+        for storage, async_storage in self.make_storages(True):
+            engine = AsyncEngine(20, lshashes=self.make_hashes(),
+                                 storage=async_storage)
+
+            async def run():
+                await engine.bulk_load(self.V, range(60), workers=2,
+                                       chunk_size=16)
+                return await asyncio.gather(*(
+                    engine.neighbours(v, vector_filters=[NearestFilter(60)])
+                    for v in self.V))
+            results = asyncio.run(run())
+            for v, result in zip(self.V, results):
+                self.assertEqual(
+                    sorted(r[1] for r in result),
+                    sorted(set(r[1] for r in reference.neighbours(
+                        v, vector_filters=[NearestFilter(60)]))))
+
+    def test_clean_buckets(self):
+        for storage, async_storage in self.make_storages(True):
+            engine = AsyncEngine(20, lshashes=[UniBucket('a'), UniBucket('b')],
+                                 storage=async_storage)
+
+            async def run():
+                await engine.store_many_vectors(self.V[:10], list(range(10)))
+                await engine.clean_buckets('a')
+                # The vectors are still held by the buckets of hash b
+                result = await engine.neighbours(
+                    self.V[0], vector_filters=[NearestFilter(20)])
+                await engine.clean_buckets('b')
+                return result
+            result = asyncio.run(run())
+            self.assertEqual(sorted(r[1] for r in result), list(range(10)))
+            self.assertEqual(storage.get_vectors(list(range(10))), [])
+
+    def test_clean_buckets_data_index(self):
+        storage = RedisStorage(MockRedis(), index_data=True)
+        async_storage = AsyncRedisStorage(
+            FakeAsyncRedis(storage.redis_object), index_data=True)
+        engine = AsyncEngine(20, lshashes=[UniBucket('a'), UniBucket('b')],
+                             storage=async_storage)
+
+        async def run():
+            await engine.store_many_vectors(self.V[:10], list(range(10)))
+            await engine.clean_buckets('a')
+        asyncio.run(run())
+        self.assertEqual(list(storage.get_data_bucket_keys('a', 3)), [])
+        self.assertEqual(list(storage.get_data_bucket_keys('b', 3)), ['b'])
+
+    def test_concurrent_queries(self):
+        latency = 0.02
+        storage = AsyncRedisStorage(FakeAsyncRedis(MockRedis(), latency))
+        engine = AsyncEngine(20, lshashes=self.make_hashes(), storage=storage)
+
+        async def run():
+            await engine.store_many_vectors(self.V, list(range(60)))
+            start = time.time()
+            results = await engine.neighbours_many(self.V)
+            return results, time.time() - start
+        results, elapsed = asyncio.run(run())
+        self.assertEqual([r[0][1] for r in results], list(range(60)))
+        # Queries one after another would wait at least 60 * latency
+        self.assertLess(elapsed, 60 * latency / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
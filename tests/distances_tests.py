@@ -74,6 +74,23 @@ def check_distance_triangle_inequality(test_obj, distance):
 
         test_obj.assertTrue(d_xy <= d_xz + d_yz)
 
+
+def check_distances_batch(test_obj, distance):
+    X = numpy.random.randn(20, 10)
+    y = numpy.random.randn(10)
+    D = distance.distances(X, y)
+    test_obj.assertEqual(D.shape, (20,))
+    for x, d in zip(X, D):
+        test_obj.assertAlmostEqual(d, distance.distance(x, y), delta=0.000000001)
+
+    X = scipy.sparse.rand(20, 30, density=0.3, format='csr')
+    y = scipy.sparse.rand(30, 1, density=0.3)
+    D = distance.distances(X, y)
+    test_obj.assertEqual(D.shape, (20,))
+    for k in range(20):
+        test_obj.assertAlmostEqual(D[k], distance.distance(X.getrow(k).T, y),
+                                   delta=0.000000001)
+
 ########################################################################
 
 
@@ -88,6 +105,9 @@ class TestEuclideanDistance(unittest.TestCase):
     def test_symmetry(self):
         check_distance_symmetry(self, self.euclidean)
 
+    def test_distances(self):
+        check_distances_batch(self, self.euclidean)
+
 class TestCosineDistance(unittest.TestCase):
 
     def setUp(self):
@@ -96,6 +116,9 @@ class TestCosineDistance(unittest.TestCase):
     def test_symmetry(self):
         check_distance_symmetry(self, self.cosine)
 
+    def test_distances(self):
+        check_distances_batch(self, self.cosine)
+
 class TestManhattanDistance(unittest.TestCase):
 
     def setUp(self):
@@ -107,5 +130,8 @@ class TestManhattanDistance(unittest.TestCase):
     def test_symmetry(self):
         check_distance_symmetry(self, self.manhattan)
 
+    def test_distances(self):
+        check_distances_batch(self, self.manhattan)
+
 if __name__ == '__main__':
     unittest.main()
@@ -21,15 +21,23 @@
 # THE SOFTWARE.
 
 import itertools
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
 import scipy
 from future.builtins import range
 
-from nearpy import Engine
+from nearpy import Engine, QueryCache
 from nearpy.utils.utils import unitvec
-from nearpy.hashes import UniBucket
+from nearpy.hashes import UniBucket, RandomBinaryProjections, \
+    HashPermutationMapper, RandomDiscretizedProjections
+from nearpy.distances import EuclideanDistance
+from nearpy.filters import NearestFilter
+from nearpy.storage import RedisStorage, ColumnarMemoryStorage
+
+from mockredis import MockRedis as Redis
 
 
 class TestEngine(unittest.TestCase):
@@ -76,6 +84,226 @@ class TestEngine(unittest.TestCase):
             self.assertEqual(y_data, x_data)
             self.assertAlmostEqual(y_distance, 0.0, delta=delta)
 
+    def test_store_many_vectors(self):
+        V = numpy.random.randn(50, 1000)
+        self.engine.store_many_vectors(V, list(range(50)))
+        for k, v in enumerate(V):
+            n = self.engine.neighbours(v)
+            y, y_data, y_distance = n[0]
+            self.assertEqual(y_data, k)
+            self.assertAlmostEqual(numpy.abs(unitvec(v) - y).max(), 0,
+                                   delta=0.000000001)
+
+    def test_store_many_vectors_multiple_keys(self):
+        def make_engine():
+            mapper = HashPermutationMapper('mapper')
+            mapper.add_child_hash(RandomBinaryProjections('rbp1', 4,
+                                                          rand_seed=1))
+            mapper.add_child_hash(RandomBinaryProjections('rbp2', 4,
+                                                          rand_seed=2))
+            return Engine(100, lshashes=[mapper])
+
+        vs = [numpy.random.randn(100) for k in range(30)]
+        single, batch = make_engine(), make_engine()
+        for k, v in enumerate(vs):
+            single.store_vector(v, k)
+        batch.store_many_vectors(vs, list(range(30)))
+
+        def bucket_contents(engine):
+            return dict((key, sorted(data for v, data in bucket))
+                        for key, bucket in engine.storage.buckets['mapper'].items())
+        self.assertEqual(bucket_contents(batch), bucket_contents(single))
+        self.assertEqual(sum(len(b) for b in bucket_contents(batch).values()),
+                         60)
+
+    def test_bulk_load(self):
+        def make_engine():
+            mapper = HashPermutationMapper('mapper')
+            mapper.add_child_hash(RandomBinaryProjections('rbp1', 4,
+                                                          rand_seed=1))
+            return Engine(100, lshashes=[mapper, RandomBinaryProjections(
+                'rbp2', 6, rand_seed=2)])
+
+        V = numpy.random.randn(250, 100)
+        single, batch, generated = make_engine(), make_engine(), make_engine()
+        single.store_many_vectors(V, list(range(250)))
+        batch.bulk_load(V, range(250), workers=2, chunk_size=40)
+        generated.bulk_load((v for v in V), iter(range(250)), workers=1,
+                            chunk_size=64)
+
+        def bucket_contents(engine):
+            return dict(((hash_name, key), sorted(data for v, data in bucket))
+                        for hash_name, buckets in engine.storage.buckets.items()
+                        for key, bucket in buckets.items())
+        self.assertEqual(bucket_contents(batch), bucket_contents(single))
+        self.assertEqual(bucket_contents(generated), bucket_contents(single))
+        self.assertEqual(batch.neighbours(V[7])[0][1], 7)
+
+    def test_store_many_vectors_sparse(self):
+        vs = [scipy.sparse.rand(1000, 1, density=0.05) for k in range(10)]
+        self.engine.store_many_vectors(vs)
+        for v in vs:
+            y, y_data, y_distance = self.engine.neighbours(v)[0]
+            self.assertAlmostEqual(y_distance, 0.0, delta=0.000000001)
+
+    def test_distance_argument(self):
+        engine = Engine(1000, lshashes=[UniBucket('testHash')])
+        x = numpy.random.randn(1000)
+        engine.store_vector(x, 'data')
+        y = numpy.random.randn(1000)
+        n = engine.neighbours(y, distance=EuclideanDistance())
+        expected = EuclideanDistance().distance(unitvec(x), unitvec(y))
+        self.assertAlmostEqual(n[0][2], expected, delta=0.000000001)
+
+    def test_retrieval_columnar(self):
+        engine = Engine(1000, storage=ColumnarMemoryStorage())
+        V = numpy.random.randn(100, 1000)
+        engine.store_many_vectors(V, list(range(100)))
+        for k in range(0, 100, 10):
+            y, y_data, y_distance = engine.neighbours(V[k])[0]
+            self.assertEqual(y_data, k)
+            self.assertAlmostEqual(y_distance, 0.0, delta=0.000000001)
+
+    def test_duplicate_candidates(self):
+        # Every vector is in the same bucket of both hashes
+        engine = Engine(10, lshashes=[UniBucket('first'), UniBucket('second')],
+                        vector_filters=[NearestFilter(30)],
+                        storage=ColumnarMemoryStorage())
+        V = numpy.random.randn(20, 10)
+        engine.store_many_vectors(V, [{'id': k} for k in range(20)])
+        self.assertEqual(engine.candidate_count(V[0]), 20)
+        result = engine.neighbours(V[0])
+        self.assertEqual(sorted(r[1]['id'] for r in result), list(range(20)))
+
+    def test_executor(self):
+        hashes = [RandomBinaryProjections('rbp%d' % k, 4, rand_seed=k)
+                  for k in range(4)]
+        for storage in (ColumnarMemoryStorage(),
+                        RedisStorage(Redis(), store_vectors_once=True)):
+            engine = Engine(50, lshashes=hashes, storage=storage)
+            V = numpy.random.randn(100, 50)
+            engine.store_many_vectors(V, list(range(100)))
+            with ThreadPoolExecutor(4) as executor:
+                parallel = Engine(50, lshashes=hashes, storage=storage,
+                                  executor=executor)
+                for v in V[:10]:
+                    self.assertEqual(
+                        sorted(r[1] for r in parallel.neighbours(v)),
+                        sorted(r[1] for r in engine.neighbours(v)))
+                    self.assertEqual(parallel.candidate_count(v),
+                                     engine.candidate_count(v))
+
+    def test_neighbours_many(self):
+        for k in range(20):
+            x = numpy.random.randn(1000)
+            self.engine.store_vector(x, 'data {}'.format(k))
+        Q = numpy.random.randn(5, 1000)
+        results = self.engine.neighbours_many(Q)
+        self.assertEqual(len(results), 5)
+        for q, result in zip(Q, results):
+            expected = self.engine.neighbours(q)
+            self.assertEqual(sorted(r[1] for r in result),
+                             sorted(r[1] for r in expected))
+
+    def test_neighbours_many_stored_once(self):
+        V = numpy.random.randn(300, 20)
+        hashes = [RandomBinaryProjections('rbp%d' % k, 2, rand_seed=k)
+                  for k in range(4)]
+        engine = Engine(20, lshashes=hashes, storage=ColumnarMemoryStorage())
+        engine.store_many_vectors(V, list(range(300)))
+        Q = numpy.random.randn(5, 20)
+        for q, result in zip(Q, engine.neighbours_many(Q)):
+            # Vectors in buckets of several hashes are candidates once
+            self.assertEqual([r[1] for r in result],
+                             [r[1] for r in engine.neighbours(q)])
+
+    def test_neighbours_many_sparse(self):
+        x = scipy.sparse.rand(1000, 1, density=0.05)
+        self.engine.store_vector(x, 'data')
+        Q = scipy.sparse.hstack([x, x]).T.tocsr()
+        results = self.engine.neighbours_many(Q)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            y, y_data, y_distance = result[0]
+            self.assertEqual(y_data, 'data')
+            self.assertAlmostEqual(y_distance, 0.0, delta=0.000000001)
+
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        numpy.random.seed(7)
+        self.rbp = RandomBinaryProjections('rbp', 3, rand_seed=5)
+        self.engine = Engine(20, lshashes=[self.rbp],
+                             query_cache=QueryCache(max_size=2))
+        self.V = numpy.random.randn(30, 20)
+        self.engine.store_many_vectors(self.V, list(range(30)))
+
+    def test_repeated_query(self):
+        cache = self.engine.query_cache
+        result = self.engine.neighbours(self.V[0])
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        # Near-exact repeats are answered from the cache
+        self.assertEqual(self.engine.neighbours(self.V[0] + 1e-9), result)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # Scaled queries are not, hashes may put them into other buckets
+        self.engine.neighbours(self.V[0] * 2.0)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        # Queries with explicit filters are not cached
+        self.engine.neighbours(self.V[0], vector_filters=[NearestFilter(3)])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_scaled_query_discretized(self):
+        V = numpy.random.randn(2000, 20)
+        results = []
+        for query_cache in (None, QueryCache()):
+            engine = Engine(20, lshashes=[RandomDiscretizedProjections(
+                'rdp', 2, 1.0, rand_seed=3)], query_cache=query_cache)
+            engine.store_many_vectors(V, list(range(2000)))
+            engine.neighbours(V[0])
+            results.append(engine.neighbours(V[0] * 3.0))
+        self.assertEqual([r[1] for r in results[1]],
+                         [r[1] for r in results[0]])
+
+    def test_invalidate(self):
+        cache = self.engine.query_cache
+        query = self.V[0]
+        self.engine.neighbours(query)
+        # Storing into another bucket keeps the result
+        other = next(v for v in numpy.random.randn(100, 20)
+                     if self.rbp.hash_vector(v) != self.rbp.hash_vector(query))
+        self.engine.store_vector(other, 'other')
+        self.engine.neighbours(query)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # Storing into the bucket of the query invalidates it
+        self.engine.store_vector(query, 'same')
+        result = self.engine.neighbours(query)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(set(r[1] for r in result if r[2] < 1e-9),
+                         set([0, 'same']))
+        self.engine.delete_vector('same', query)
+        self.assertNotIn('same', [r[1] for r in self.engine.neighbours(query)])
+
+    def test_size_and_ttl(self):
+        cache = QueryCache(max_size=2, ttl=0.01)
+        for k in range(3):
+            cache.put(cache.query_key(self.V[k]), [k], [('rbp', k)])
+        self.assertEqual(len(cache.results), 2)
+        self.assertIsNone(cache.get(cache.query_key(self.V[0])))
+        self.assertEqual(cache.get(cache.query_key(self.V[2])), [2])
+        self.assertEqual(sorted(cache.bucket_queries),
+                         [('rbp', '1'), ('rbp', '2')])
+        time.sleep(0.05)
+        self.assertIsNone(cache.get(cache.query_key(self.V[2])))
+
+    def test_sparse_query_key(self):
+        cache = QueryCache()
+        x = scipy.sparse.rand(20, 1, density=0.3)
+        self.assertEqual(cache.query_key(x), cache.query_key(x * 1.0))
+        self.assertNotEqual(cache.query_key(x), cache.query_key(x * 3))
+        self.assertNotEqual(cache.query_key(x),
+                            cache.query_key(scipy.sparse.rand(20, 1,
+                                                              density=0.3)))
+
 
 class TestDelete(unittest.TestCase):
     def setUp(self):
@@ -118,6 +346,36 @@ class TestDelete(unittest.TestCase):
         engine.delete_vector(self.removed_value)
         self.check_delete(engine)
 
+    def test_delete_vector_store_vectors_once(self):
+        hashes = [UniBucket('name_hash_%d' % k) for k in range(3)]
+        engine = Engine(self.dim, lshashes=hashes,
+                        storage=RedisStorage(Redis(), store_vectors_once=True))
+        for index in self.all_values:
+            engine.store_vector(numpy.ones(self.dim) * index, index)
+        engine.delete_vector(self.removed_value)
+        self.all_values.remove(self.removed_value)
+        candidates = engine._get_candidates(numpy.ones(self.dim))
+        self.assertEqual(sorted(set(data for v, data in candidates)),
+                         self.all_values)
+        self.assertEqual(len(candidates), len(self.all_values))
+
+    def test_delete_vector_data_index(self):
+        hashes = [UniBucket('name_hash_%d' % k) for k in range(3)]
+        for storage in (None, ColumnarMemoryStorage(),
+                        RedisStorage(Redis(), index_data=True)):
+            engine = Engine(self.dim, lshashes=hashes, storage=storage)
+            for index in self.all_values:
+                engine.store_vector(numpy.ones(self.dim) * index, index)
+
+            def get_all_bucket_keys(hash_name):
+                raise AssertionError('All buckets are searched')
+            engine.storage.get_all_bucket_keys = get_all_bucket_keys
+            engine.delete_vector(self.removed_value)
+            candidates = engine._get_candidates(numpy.ones(self.dim))
+            self.assertEqual(sorted(set(data for v, data in candidates)),
+                             [k for k in self.all_values
+                              if k != self.removed_value])
+
     def test_delete_vector_with_provided_value(self):
         engine = Engine(self.dim, lshashes=[UniBucket('testHash')])
         self.fill_engine(engine)
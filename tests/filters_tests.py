@@ -59,6 +59,21 @@ class TestVectorFilters(unittest.TestCase):
         self.assertIn(self.V[2], result)
         self.assertIn(self.V[3], result)
 
+    def test_nearest_order(self):
+        result = NearestFilter(3).filter_vectors(self.V)
+        self.assertEqual([x[1] for x in result], ['data5', 'data1', 'data2'])
+        W = [(x[0], x[1]) for x in self.V]
+        self.assertEqual(self.nearest_filter.filter_vectors(W), W)
+
+    def test_filter_distances(self):
+        distances = numpy.array([x[2] for x in self.V])
+        for vector_filter in [self.threshold_filter, self.nearest_filter,
+                              NearestFilter(1), NearestFilter(20)]:
+            indices = vector_filter.filter_distances(distances)
+            self.assertEqual([self.V[index] for index in indices],
+                             vector_filter.filter_vectors(self.V))
+        self.assertEqual(self.unique.filter_distances(distances), None)
+
     def test_unique(self):
         W = self.V
         W.append((numpy.array([7]), 'data8', 2.8))
@@ -69,6 +84,11 @@ class TestVectorFilters(unittest.TestCase):
         result = self.unique.filter_vectors(W)
         self.assertEqual(len(result), 8)
 
+    def test_unique_unhashable_data(self):
+        W = [(numpy.array([k % 3]), {'id': k % 3}, 0.1) for k in range(10)]
+        result = self.unique.filter_vectors(W)
+        self.assertEqual(sorted(x[1]['id'] for x in result), [0, 1, 2])
+
 
 if __name__ == '__main__':
     unittest.main()
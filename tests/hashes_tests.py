@@ -63,6 +63,56 @@ class TestRandomBinaryProjections(unittest.TestCase):
         for k in range(100):
             self.assertEqual(first_hash, self.rbp.hash_vector(x)[0])
 
+    def test_hash_vectors(self):
+        V = numpy.random.randn(20, 100)
+        keys = self.rbp.hash_vectors(V)
+        self.assertEqual(len(keys), 20)
+        for v, v_keys in zip(V, keys):
+            self.assertEqual(v_keys, self.rbp.hash_vector(v))
+
+    def test_hash_vectors_sparse(self):
+        V = scipy.sparse.rand(20, 100, density=0.1, format='csr')
+        keys = self.rbp.hash_vectors(V)
+        self.assertEqual(len(keys), 20)
+        for k in range(20):
+            self.assertEqual(keys[k], self.rbp.hash_vector(V.getrow(k).T))
+
+    def test_hash_packed_keys(self):
+        packed = RandomBinaryProjections('testHash', 10, packed_keys=True)
+        packed.reset(100)
+        packed.normals = self.rbp.normals
+        V = numpy.random.randn(20, 100)
+        for v, keys in zip(V, packed.hash_vectors(V)):
+            key = packed.hash_vector(v)[0]
+            self.assertIsInstance(key, int)
+            self.assertEqual(keys, [key])
+            self.assertEqual(key, int(self.rbp.hash_vector(v)[0], 2))
+
+    def test_multi_probe(self):
+        probing = RandomBinaryProjections('testHash', 10, probe_count=12)
+        probing.reset(100)
+        probing.normals = self.rbp.normals
+        x = numpy.random.randn(100)
+        keys = probing.hash_vector(x, querying=True)
+        self.assertEqual(len(keys), 12)
+        self.assertEqual(len(set(keys)), 12)
+        self.assertEqual(keys[0], self.rbp.hash_vector(x)[0])
+        self.assertEqual(probing.hash_vector(x), keys[:1])
+
+        # The second bucket flips the bit closest to the hyperplane
+        projection = numpy.dot(self.rbp.normals, x)
+        flipped = numpy.argmin(abs(projection))
+        self.assertEqual([k for k in range(10)
+                          if keys[0][k] != keys[1][k]], [flipped])
+        # Costs (sum of flipped squared projections) never decrease
+        costs = [sum(projection[k] ** 2 for k in range(10)
+                     if key[k] != keys[0][k]) for key in keys]
+        self.assertEqual(costs, sorted(costs))
+
+        V = numpy.random.randn(5, 100)
+        for v, v_keys in zip(V, probing.hash_vectors(V, querying=True)):
+            self.assertEqual(v_keys, probing.hash_vector(v, querying=True))
+
 class TestRandomDiscretizedProjections(unittest.TestCase):
 
     def setUp(self):
@@ -91,6 +141,46 @@ class TestRandomDiscretizedProjections(unittest.TestCase):
         for k in range(100):
             self.assertEqual(first_hash, self.rbp.hash_vector(x)[0])
 
+    def test_hash_vectors(self):
+        V = numpy.random.randn(20, 100)
+        keys = self.rbp.hash_vectors(V)
+        self.assertEqual(len(keys), 20)
+        for v, v_keys in zip(V, keys):
+            self.assertEqual(v_keys, self.rbp.hash_vector(v))
+
+    def test_hash_vectors_sparse(self):
+        V = scipy.sparse.rand(20, 100, density=0.1, format='csr')
+        keys = self.rbp.hash_vectors(V)
+        for k in range(20):
+            self.assertEqual(keys[k], self.rbp.hash_vector(V.getrow(k).T))
+
+    def test_multi_probe(self):
+        probing = RandomDiscretizedProjections('testHash', 10, 0.1,
+                                               probe_count=8)
+        probing.reset(100)
+        probing.normals = self.rbp.normals
+        x = numpy.random.randn(100)
+        keys = probing.hash_vector(x, querying=True)
+        self.assertEqual(len(keys), 8)
+        self.assertEqual(len(set(keys)), 8)
+        self.assertEqual(keys[0], self.rbp.hash_vector(x)[0])
+
+        # The second bin is next to the closest bin boundary
+        projection = numpy.dot(self.rbp.normals, x) / 0.1
+        offsets = projection - numpy.floor(projection)
+        nearest = numpy.argmin(numpy.minimum(offsets, 1.0 - offsets))
+        cell = numpy.floor(projection[nearest])
+        cell += -1 if offsets[nearest] < 0.5 else 1
+        self.assertEqual(int(keys[1].split('_')[nearest]), cell)
+        for key in keys:
+            moves = numpy.array(key.split('_'), dtype=int) - \
+                numpy.floor(projection)
+            self.assertTrue(numpy.all(abs(moves) <= 1))
+
+        V = numpy.random.randn(5, 100)
+        for v, v_keys in zip(V, probing.hash_vectors(V, querying=True)):
+            self.assertEqual(v_keys, probing.hash_vector(v, querying=True))
+
 class TestPCABinaryProjections(unittest.TestCase):
 
     def setUp(self):
@@ -126,6 +216,21 @@ class TestPCABinaryProjections(unittest.TestCase):
             self.assertEqual(first_hash, self.pbp.hash_vector(x)[0])
 
 
+    def test_hash_vectors(self):
+        V = numpy.random.randn(20, 10)
+        keys = self.pbp.hash_vectors(V)
+        self.assertEqual(len(keys), 20)
+        for v, v_keys in zip(V, keys):
+            self.assertEqual(v_keys, self.pbp.hash_vector(v))
+
+    def test_hash_packed_keys(self):
+        packed = PCABinaryProjections('pbp', 4, self.vectors, packed_keys=True)
+        x = numpy.random.randn(10)
+        key = packed.hash_vector(x)[0]
+        self.assertIsInstance(key, int)
+        self.assertEqual(key, int(self.pbp.hash_vector(x)[0], 2))
+
+
 class TestPCADiscretizedProjections(unittest.TestCase):
 
     def setUp(self):
@@ -154,6 +259,23 @@ class TestPCADiscretizedProjections(unittest.TestCase):
         for k in range(100):
             self.assertEqual(first_hash, self.pdp.hash_vector(x)[0])
 
+    def test_hash_vectors(self):
+        V = numpy.random.randn(20, 10)
+        keys = self.pdp.hash_vectors(V)
+        self.assertEqual(len(keys), 20)
+        for v, v_keys in zip(V, keys):
+            self.assertEqual(v_keys, self.pdp.hash_vector(v))
+
+    def test_multi_probe(self):
+        probing = PCADiscretizedProjections('pdp', 4, self.vectors, 0.1,
+                                            probe_count=5)
+        x = numpy.random.randn(10)
+        keys = probing.hash_vector(x, querying=True)
+        self.assertEqual(len(keys), 5)
+        self.assertEqual(len(set(keys)), 5)
+        self.assertEqual(keys[0], self.pdp.hash_vector(x)[0])
+        self.assertEqual(probing.hash_vector(x), keys[:1])
+
 
 if __name__ == '__main__':
     unittest.main()
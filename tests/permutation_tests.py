@@ -27,8 +27,10 @@ import logging
 from nearpy import Engine
 from nearpy.distances import CosineDistance
 
-from nearpy.hashes import HashPermutations
+from nearpy.hashes import HashPermutations, HashPermutationMapper
 from nearpy.hashes import RandomBinaryProjections
+from nearpy.hashes.permutation.permute import Permute
+from nearpy.hashes.permutation.permutedIndex import PermutedIndex
 
 from past.builtins import xrange
 
@@ -79,5 +81,163 @@ class TestPermutation(unittest.TestCase):
 
         self.assertLess(permuted_dists[0], dists[0])
 
+    def test_permute(self):
+        keys = numpy.random.randint(0, 2 ** 20, 50).astype(numpy.uint64)
+        permute = Permute(20)
+        permuted = permute.permute(keys)
+        for key, permuted_key in zip(keys, permuted):
+            bits = format(int(key), '020b')
+            self.assertEqual(format(int(permuted_key), '020b'),
+                             ''.join(bits[m] for m in permute.mapping))
+        self.assertTrue(numpy.array_equal(permute.revert(permuted), keys))
+
+    def test_neighbour_keys(self):
+        rbp = RandomBinaryProjections('rbp', 12)
+        keys = set(format(key, '012b')
+                   for key in numpy.random.randint(0, 2 ** 12, 300))
+        index = PermutedIndex(rbp, keys, 20, 10, 5)
+        query = format(1234, '012b')
+        neighbours = index.get_neighbour_keys(query, 5)
+        self.assertEqual(len(neighbours), 5)
+        distances = [sum(a != b for a, b in zip(key, query))
+                     for key in neighbours]
+        self.assertEqual(distances, sorted(distances))
+        self.assertTrue(set(neighbours) <= keys)
+
+        packed = RandomBinaryProjections('rbp', 12, packed_keys=True)
+        numpy.random.seed(3)
+        index = PermutedIndex(rbp, keys, 20, 10, 5)
+        numpy.random.seed(3)
+        packed_index = PermutedIndex(packed, [int(key, 2) for key in keys],
+                                     20, 10, 5)
+        self.assertEqual(packed_index.get_neighbour_keys(1234, 5),
+                         [int(key, 2) for key
+                          in index.get_neighbour_keys(query, 5)])
+
+    def test_add_keys(self):
+        rbp = RandomBinaryProjections('rbp', 12)
+        keys = list(set(format(key, '012b')
+                        for key in numpy.random.randint(0, 2 ** 12, 400)))
+        numpy.random.seed(5)
+        full_index = PermutedIndex(rbp, keys, 20, 10, 5)
+        numpy.random.seed(5)
+        index = PermutedIndex(rbp, keys[:100], 20, 10, 5)
+        index.min_merge_size = 50
+        for start in range(100, len(keys), 30):
+            index.add_keys(keys[start:start + 30] + keys[:5])
+        self.assertEqual(index.key_count() + len(index.new_keys), len(keys))
+        self.assertTrue(len(index.new_keys) < 50)
+        query = format(1234, '012b')
+        self.assertEqual(index.get_neighbour_keys(query, 5),
+                         full_index.get_neighbour_keys(query, 5))
+        index.merge_new_keys()
+        self.assertEqual(len(index.new_keys), 0)
+        self.assertEqual(index.get_neighbour_keys(query, 5),
+                         full_index.get_neighbour_keys(query, 5))
+
+    def test_incremental_index(self):
+        # Query without building the permuted index first
+        v = numpy.random.randn(200)
+        self.engine_perm.store_vector(v, 'first')
+        self.assertEqual(self.engine_perm.neighbours(v)[0][1], 'first')
+
+        # Vectors stored afterwards are found without a rebuild
+        for i in xrange(100):
+            w = numpy.random.randn(200)
+            self.engine_perm.store_vector(w, i)
+            self.assertEqual(self.engine_perm.neighbours(w)[0][1], i)
+
+
+def legacy_bucket_key_map(hash_name, keys):
+    """
+    Returns the bucket key map older versions of HashPermutationMapper
+    built when storing into the buckets with the specified keys.
+    """
+    bucket_key_map = {}
+    for key in keys:
+        around = [key[:bit] + ('1' if key[bit] == '0' else '0') + key[bit + 1:]
+                  for bit in range(len(key))] + [key]
+        for perm_key in around:
+            variants = bucket_key_map.setdefault(
+                '{}_{}'.format(hash_name, perm_key), {})
+            for variant in around:
+                variants['{}_{}'.format(hash_name, variant)] = 1
+    return bucket_key_map
+
+
+class TestHashPermutationMapper(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(5)
+
+    def test_neighbour_keys(self):
+        for packed_keys in (False, True):
+            mapper = HashPermutationMapper('mapper')
+            rbp = RandomBinaryProjections('rbp', 6, rand_seed=3,
+                                          packed_keys=packed_keys)
+            mapper.add_child_hash(rbp)
+            engine = Engine(20, lshashes=[mapper])
+            V = numpy.random.randn(200, 20)
+            engine.store_many_vectors(V, list(range(200)))
+
+            occupied = set(int(key, 2) if not packed_keys else key
+                           for v in V for key in rbp.hash_vector(v))
+            query = numpy.random.randn(20)
+            key = rbp.hash_vector(query)[0]
+            key = key if packed_keys else int(key, 2)
+            expected = set('rbp_{}'.format(k if packed_keys
+                                           else format(k, '06b'))
+                           for k in occupied if bin(k ^ key).count('1') <= 2)
+            self.assertEqual(set(mapper.hash_vector(query, querying=True)),
+                             expected)
+            self.assertEqual(mapper.get_config()['occupied_keys'],
+                             {'rbp': sorted(occupied)})
+
+    def test_radius(self):
+        # Both ways of finding neighbours (enumerating the Hamming ball
+        # and scanning the occupied keys) return the same buckets
+        rbp = RandomBinaryProjections('rbp', 12, rand_seed=3)
+        V = numpy.random.randn(300, 20)
+        for radius in (0, 1, 2, 3):
+            mapper = HashPermutationMapper('mapper', radius=radius)
+            mapper.add_child_hash(rbp)
+            Engine(20, lshashes=[mapper]).store_many_vectors(V)
+            occupied = mapper.occupied_keys['rbp']
+            for v in numpy.random.randn(10, 20):
+                key = int(rbp.hash_vector(v)[0], 2)
+                neighbours = [int(k, 2) for k in mapper.neighbour_keys(
+                    rbp, format(key, '012b'))]
+                distances = [bin(k ^ key).count('1') for k in neighbours]
+                self.assertEqual(distances, sorted(distances))
+                self.assertEqual(sorted(neighbours),
+                                 sorted(k for k in occupied
+                                        if bin(k ^ key).count('1') <= radius))
+
+    def test_legacy_recall(self):
+        # All occupied buckets the old bucket key map returned are found
+        rbp = RandomBinaryProjections('rbp', 10, rand_seed=3)
+        mapper = HashPermutationMapper('mapper')
+        mapper.add_child_hash(rbp)
+        V = numpy.random.randn(300, 20)
+        Engine(20, lshashes=[mapper]).store_many_vectors(V)
+        keys = set(rbp.hash_vector(v)[0] for v in V)
+        bucket_key_map = legacy_bucket_key_map('rbp', keys)
+        for v in numpy.random.randn(50, 20):
+            prefixed_key = 'rbp_' + rbp.hash_vector(v)[0]
+            legacy = set(key for key in bucket_key_map.get(prefixed_key, {})
+                         if key[len('rbp_'):] in keys)
+            self.assertTrue(legacy.issubset(
+                mapper.hash_vector(v, querying=True)))
+
+    def test_legacy_config(self):
+        keys = ['0110', '0111', '1000']
+        mapper = HashPermutationMapper(None)
+        mapper.apply_config({'hash_name': 'mapper', 'dim': 20,
+                             'bucket_key_map': legacy_bucket_key_map('rbp',
+                                                                     keys)})
+        # The variants around the keys are not occupied
+        self.assertEqual(mapper.occupied_keys, {'rbp': set([6, 7, 8])})
+        self.assertEqual(mapper.radius, 2)
+
 if __name__ == '__main__':
     unittest.main()
@@ -65,6 +65,81 @@ class TestRandomBinaryProjectionTree(unittest.TestCase):
             n = self.engine.neighbours(x)
             self.assertEqual(len(n), 20)
 
+    def test_packed_keys(self):
+        rbpt = RandomBinaryProjectionTree('testHash', 10, 20)
+        packed = RandomBinaryProjectionTree('testHash', 10, 20,
+                                            packed_keys=True)
+        rbpt.reset(100)
+        packed.reset(100)
+
+        for k in range(500):
+            x = numpy.random.randn(100)
+            key = packed.hash_vector(x)[0]
+            self.assertEqual(key, int(rbpt.hash_vector(x)[0], 2))
+
+        for k in range(10):
+            x = numpy.random.randn(100)
+            keys = packed.hash_vector(x, querying=True)
+            self.assertEqual(keys, [int(key, 2) for key
+                                    in rbpt.hash_vector(x, querying=True)])
+
+    def test_hash_vectors(self):
+        rbpt = RandomBinaryProjectionTree('testHash', 10, 20)
+        rbpt.reset(100)
+        V = numpy.random.randn(500, 100)
+        keys = rbpt.hash_vectors(V)
+        self.assertEqual(rbpt.get_config()['tree_counts'].sum(), 500)
+        for v, v_keys in zip(V, keys):
+            self.assertEqual(v_keys, rbpt.hash_vector(v))
+        Q = numpy.random.randn(10, 100)
+        for q, q_keys in zip(Q, rbpt.hash_vectors(Q, querying=True)):
+            self.assertEqual(q_keys, rbpt.hash_vector(q, querying=True))
+
+    def test_tree_counts(self):
+        rbpt = RandomBinaryProjectionTree('testHash', 8, 50)
+        rbpt.reset(100)
+        V = numpy.random.randn(1000, 100)
+        keys = [key[0] for key in rbpt.hash_vectors(V)]
+        config = rbpt.get_config()
+        self.assertEqual(list(config['tree_keys']),
+                         sorted(set(int(key, 2) for key in keys)))
+        self.assertEqual(list(config['tree_counts']),
+                         [keys.count(key) for key in sorted(set(keys))])
+        for q in numpy.random.randn(10, 100):
+            q_keys = rbpt.hash_vector(q, querying=True)
+            self.assertGreaterEqual(sum(keys.count(key) for key in q_keys), 50)
+
+    def test_streaming_inserts(self):
+        # Queries between inserts search the delta of new keys, which is
+        # merged into the tree once it is large enough
+        streamed = RandomBinaryProjectionTree('testHash', 10, 20)
+        streamed.min_merge_size = 8
+        bulk = RandomBinaryProjectionTree('testHash', 10, 20)
+        streamed.reset(100)
+        bulk.reset(100)
+        V = numpy.random.randn(600, 100)
+        Q = numpy.random.randn(600, 100)
+        bulk.hash_vectors(V)
+        bulk.get_config()
+        merged_sizes = set()
+        for k, (v, q) in enumerate(zip(V, Q)):
+            streamed.hash_vector(v)
+            keys = streamed.hash_vector(q, querying=True)
+            merged_sizes.add(len(streamed.tree_keys))
+            self.assertLessEqual(len(streamed.delta_keys),
+                                 max(8, len(streamed.tree_keys) // 16))
+            if k == len(V) - 1:
+                self.assertEqual(keys, bulk.hash_vector(q, querying=True))
+        self.assertGreater(len(merged_sizes), 2)
+        config = streamed.get_config()
+        self.assertEqual(list(config['tree_keys']),
+                         list(bulk.get_config()['tree_keys']))
+        self.assertEqual(list(config['tree_counts']),
+                         list(bulk.get_config()['tree_counts']))
+        for q in Q[:20]:
+            self.assertEqual(streamed.hash_vector(q, querying=True),
+                             bulk.hash_vector(q, querying=True))
+
     def test_storage_memory(self):
         # We want 10 projections, 20 results at least
         rbpt = RandomBinaryProjectionTree('testHash', 10, 20)
@@ -21,6 +21,9 @@
 # THE SOFTWARE.
 
 import unittest
+import shutil
+import tempfile
+import pickle
 import numpy
 import scipy
 
@@ -29,7 +32,8 @@ import mongomock
 from future.builtins import range
 from future.builtins import zip
 
-from nearpy.storage import MemoryStorage, RedisStorage, MongoStorage
+from nearpy.storage import MemoryStorage, RedisStorage, MongoStorage, \
+    ColumnarMemoryStorage, MemoryMappedStorage, CachingStorage
 
 
 class StorageTest(unittest.TestCase):
@@ -56,6 +60,15 @@ class StorageTest(unittest.TestCase):
         self.storage.clean_all_buckets()
         self.assertEqual(self.storage.get_bucket('testHash', bucket_key), [])
 
+    def check_store_packed_key(self):
+        x, bucket_key = numpy.ones(100), 691
+        self.storage.store_vector('testHash', bucket_key, x, 'data')
+        bucket = self.storage.get_bucket('testHash', bucket_key)
+        self.assertEqual(len(bucket), 1)
+        self.assertEqual(bucket[0][1], 'data')
+        self.storage.delete_vector('testHash', [bucket_key], 'data')
+        self.assertEqual(self.storage.get_bucket('testHash', bucket_key), [])
+
     def check_store_many_vectors(self, xs):
         num_vector = len(xs)
         bucket_keys = list(map(str,
@@ -74,6 +87,32 @@ class StorageTest(unittest.TestCase):
         self.storage.clean_all_buckets()
         self.assertEqual(self.storage.get_bucket('testHash', bucket_key), [])
 
+    def check_store_postings(self, xs):
+        postings = [('firstHash', '1', 0), ('secondHash', '1', 0),
+                    ('firstHash', '1', 1), ('firstHash', '2', 2)]
+        self.storage.store_postings(postings, xs, ['a', 'b', 'c'])
+
+        def get_bucket_items(hash_name, bucket_key):
+            return [(list(numpy.ravel(v)), data) for v, data
+                    in self.storage.get_bucket(hash_name, bucket_key)]
+        self.assertEqual(get_bucket_items('firstHash', '1'),
+                         [(list(xs[0]), 'a'), (list(xs[1]), 'b')])
+        self.assertEqual(get_bucket_items('secondHash', '1'),
+                         [(list(xs[0]), 'a')])
+        self.assertEqual(get_bucket_items('firstHash', '2'),
+                         [(list(xs[2]), 'c')])
+
+    def check_get_buckets(self, xs):
+        postings = [('firstHash', '1', 0), ('secondHash', '1', 0),
+                    ('firstHash', '1', 1), ('firstHash', '2', 2)]
+        self.storage.store_postings(postings, xs, ['a', 'b', 'c'])
+        buckets = self.storage.get_buckets([
+            ('firstHash', '2'), ('firstHash', '3'), ('firstHash', '1'),
+            ('secondHash', '1'), ('firstHash', '2')])
+        self.assertEqual([[data for v, data in bucket] for bucket in buckets],
+                         [['c'], [], ['a', 'b'], ['a'], ['c']])
+        self.assertTrue(numpy.array_equal(buckets[2][1][0], xs[1]))
+
     def check_get_all_bucket_keys(self):
         x, x_data = numpy.ones(100), "data"
         hash_config = [
@@ -89,6 +128,26 @@ class StorageTest(unittest.TestCase):
                 sorted(bucket_keys)
             )
 
+    def check_data_bucket_keys(self, xs):
+        postings = [('firstHash', '1', 0), ('secondHash', '1', 0),
+                    ('firstHash', '2', 0), ('firstHash', '2', 1),
+                    ('firstHash', '3', 2)]
+        self.storage.store_postings(postings, xs, [{'id': 1}, 'b', None])
+
+        def data_bucket_keys(hash_name, data):
+            return sorted('{}'.format(key) for key in
+                          self.storage.get_data_bucket_keys(hash_name, data))
+        self.assertEqual(data_bucket_keys('firstHash', {'id': 1}), ['1', '2'])
+        self.assertEqual(data_bucket_keys('secondHash', {'id': 1}), ['1'])
+        self.assertEqual(data_bucket_keys('firstHash', 'b'), ['2'])
+        self.assertEqual(data_bucket_keys('firstHash', 'c'), [])
+        self.assertIsNone(self.storage.get_data_bucket_keys('firstHash', None))
+
+        self.storage.delete_vector('firstHash', ['1', '2'], {'id': 1})
+        self.assertEqual(data_bucket_keys('firstHash', {'id': 1}), [])
+        self.assertEqual([data for v, data
+                          in self.storage.get_bucket('firstHash', '2')], ['b'])
+
     def check_delete_vector(self, x):
         hash_name, bucket_name = "tastHash", "testBucket"
         samples = list(range(10))
@@ -104,6 +163,70 @@ class StorageTest(unittest.TestCase):
         samples.remove(deleted_sample)
         self.assertEqual(get_bucket_items(), samples)
 
+    def check_clean_buckets_once(self, vector_count, tombstone_count):
+        # Vector 0 is held by both hashes, 1 and 2 only by the first one
+        xs = numpy.random.randn(3, 5)
+        postings = [('firstHash', '1', 0), ('firstHash', '1', 1),
+                    ('firstHash', '2', 2), ('secondHash', '1', 0)]
+        self.storage.store_postings(postings, xs, ['a', 'b', 'c'])
+        self.storage.delete_vector('firstHash', ['2'], 'c')
+        self.assertEqual((vector_count(), tombstone_count()), (2, 1))
+
+        # Vectors and tombstones only the cleaned hash held are removed
+        self.storage.clean_buckets('firstHash')
+        self.assertEqual((vector_count(), tombstone_count()), (1, 0))
+        self.assertEqual(self.storage.get_all_bucket_keys('firstHash'), [])
+        self.assertEqual([data for v, data
+                          in self.storage.get_bucket('secondHash', '1')],
+                         ['a'])
+
+    def check_clean_buckets_data_index(self):
+        xs = numpy.random.randn(3, 5)
+        postings = [('firstHash', '1', 0), ('firstHash', '2', 1),
+                    ('secondHash', '1', 0)]
+        self.storage.store_postings(postings, xs, ['a', 'a', 'b'])
+        self.storage.clean_buckets('firstHash')
+        # The buckets of the other hash stay in the index
+        self.assertEqual(
+            sorted(self.storage.get_data_bucket_keys('firstHash', 'a')), [])
+        self.assertEqual(
+            sorted(self.storage.get_data_bucket_keys('secondHash', 'a')),
+            ['1'])
+
+        # Re-indexing only finds the new buckets
+        self.storage.store_postings([('firstHash', '3', 0)], xs[2:], ['a'])
+        self.assertEqual(
+            sorted(self.storage.get_data_bucket_keys('firstHash', 'a')), ['3'])
+
+    def check_compact(self, bucket_size):
+        # Bucket 'b' holds the first four of the vectors in bucket 'a'
+        xs = numpy.random.randn(10, 5)
+        postings = [('testHash', 'a', row) for row in range(10)] + \
+            [('testHash', 'b', row) for row in range(4)]
+        self.storage.store_postings(postings, xs, list(range(10)))
+        for data in [0, 1, 2, 5]:
+            self.storage.delete_vector('testHash', ['a', 'b'], data)
+
+        def check_buckets():
+            buckets = self.storage.get_buckets([('testHash', 'a'),
+                                                ('testHash', 'b')])
+            self.assertEqual([[data for v, data in bucket]
+                              for bucket in buckets],
+                             [[3, 4, 6, 7, 8, 9], [3]])
+        check_buckets()
+        self.assertEqual(bucket_size('a'), 10)
+        self.assertEqual(bucket_size('b'), 4)
+
+        # Only bucket 'b' is mostly deleted
+        self.storage.compact()
+        check_buckets()
+        self.assertEqual(bucket_size('a'), 10)
+        self.assertEqual(bucket_size('b'), 1)
+
+        self.storage.compact(0.1)
+        check_buckets()
+        self.assertEqual(bucket_size('a'), 6)
+
 
 class MemoryStorageTest(StorageTest):
 
@@ -125,6 +248,178 @@ class MemoryStorageTest(StorageTest):
     def test_delete_vector(self):
         self.check_delete_vector(numpy.ones(100))
 
+    def test_store_packed_key(self):
+        self.check_store_packed_key()
+
+    def test_store_postings(self):
+        self.check_store_postings(numpy.random.randn(3, 10))
+
+    def test_get_buckets(self):
+        self.check_get_buckets(numpy.random.randn(3, 10))
+
+    def test_data_bucket_keys(self):
+        self.check_data_bucket_keys(numpy.random.randn(3, 10))
+
+
+class ColumnarMemoryStorageTest(StorageTest):
+
+    def setUp(self):
+        self.storage = ColumnarMemoryStorage()
+        super(ColumnarMemoryStorageTest, self).setUp()
+
+    def test_store_vector(self):
+        x = numpy.random.randn(100)
+        self.check_store_vector(x)
+
+    def test_store_sparse_vector(self):
+        x = scipy.sparse.rand(100, 1, density=0.1)
+        self.assertRaises(ValueError, self.storage.store_vector,
+                          'testHash', 'testBucket', x, 'data')
+
+    def test_get_all_bucket_keys(self):
+        self.check_get_all_bucket_keys()
+
+    def test_delete_vector(self):
+        self.check_delete_vector(numpy.ones(100))
+
+    def test_store_packed_key(self):
+        self.check_store_packed_key()
+
+    def test_store_postings(self):
+        self.check_store_postings(numpy.random.randn(3, 10))
+
+    def test_get_buckets(self):
+        self.check_get_buckets(numpy.random.randn(3, 10))
+
+    def test_data_bucket_keys(self):
+        self.check_data_bucket_keys(numpy.random.randn(3, 10))
+
+    def test_store_many_vectors(self):
+        x = numpy.random.randn(100, 10)
+        self.check_store_many_vectors(x)
+
+    def test_float32(self):
+        self.storage = ColumnarMemoryStorage(dtype=numpy.float32)
+        xs = numpy.random.randn(50, 10)
+        self.storage.store_postings([('testHash', 'a', row)
+                                     for row in range(50)], xs, None)
+        ids = self.storage.get_bucket_ids('testHash', 'a')
+        self.assertEqual(list(ids), list(range(50)))
+        bucket = self.storage.get_bucket('testHash', 'a')
+        self.assertEqual(bucket[0][0].dtype, numpy.float32)
+        self.assertTrue(numpy.allclose([v for v, data in bucket], xs,
+                                       atol=0.00001))
+
+    def test_compact(self):
+        self.check_compact(lambda key: len(
+            self.storage.buckets['testHash'][key].values()))
+        # The rows of the deleted vectors are dropped and the others
+        # renumbered
+        self.assertEqual(self.storage.deleted_count, 0)
+        self.assertEqual(len(self.storage.vectors), 6)
+        self.assertEqual(list(self.storage.data.values()), [3, 4, 6, 7, 8, 9])
+        self.assertEqual(list(self.storage.get_bucket_ids('testHash', 'b')),
+                         [0])
+        self.storage.store_vector('testHash', 'b', numpy.ones(5), 'new')
+        self.assertEqual([data for v, data
+                          in self.storage.get_bucket('testHash', 'b')],
+                         [3, 'new'])
+
+    def test_compact_keeps_held_rows(self):
+        xs = numpy.random.randn(4, 5)
+        self.storage.store_postings([('testHash', 'a', row)
+                                     for row in range(4)], xs, list(range(4)))
+        self.storage.delete_vector('testHash', ['a'], 1)
+        # The bucket is not compacted, so the deleted row stays
+        self.storage.compact(0.5)
+        self.assertEqual(self.storage.deleted_count, 1)
+        self.assertEqual(len(self.storage.vectors), 4)
+        self.storage.compact(0.25)
+        self.assertEqual(self.storage.deleted_count, 0)
+        self.assertEqual(len(self.storage.vectors), 3)
+        bucket = self.storage.get_bucket('testHash', 'a')
+        self.assertEqual([data for v, data in bucket], [0, 2, 3])
+        self.assertTrue(numpy.array_equal([v for v, data in bucket],
+                                          xs[[0, 2, 3]]))
+
+
+class MemoryMappedStorageTest(StorageTest):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = MemoryMappedStorage(self.path)
+        super(MemoryMappedStorageTest, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_store_vector(self):
+        x = numpy.random.randn(100)
+        self.check_store_vector(x)
+
+    def test_get_all_bucket_keys(self):
+        self.check_get_all_bucket_keys()
+
+    def test_delete_vector(self):
+        self.check_delete_vector(numpy.ones(100))
+
+    def test_store_packed_key(self):
+        self.check_store_packed_key()
+
+    def test_store_postings(self):
+        self.check_store_postings(numpy.random.randn(3, 10))
+
+    def test_get_buckets(self):
+        self.check_get_buckets(numpy.random.randn(3, 10))
+
+    def test_store_many_vectors(self):
+        x = numpy.random.randn(100, 10)
+        self.check_store_many_vectors(x)
+
+    def test_reopen(self):
+        xs = numpy.random.randn(100, 10)
+        self.storage.store_postings([('testHash', row % 7, row)
+                                     for row in range(100)], xs,
+                                    list(range(100)))
+        self.storage.hash_configs['testHash'] = {'dim': 10}
+        self.storage.flush()
+        storage = MemoryMappedStorage(self.path)
+        self.assertEqual(sorted(storage.get_all_bucket_keys('testHash')),
+                         list(range(7)))
+        self.assertEqual(storage.load_hash_configuration('testHash'),
+                         {'dim': 10})
+        for key in range(7):
+            bucket = storage.get_bucket('testHash', key)
+            self.assertEqual([data for v, data in bucket],
+                             list(range(key, 100, 7)))
+            self.assertTrue(numpy.array_equal([v for v, data in bucket],
+                                              xs[key::7]))
+
+        # Changes of the reopened storage are only persisted by flush
+        storage.delete_vector('testHash', [3], 3)
+        storage.store_vector('testHash', 3, numpy.ones(10), 'new')
+        self.assertEqual(len(MemoryMappedStorage(self.path).get_bucket(
+            'testHash', 3)), 14)
+        storage.flush()
+        bucket = MemoryMappedStorage(self.path).get_bucket('testHash', 3)
+        self.assertEqual([data for v, data in bucket][:1], [10])
+        self.assertEqual([data for v, data in bucket][-2:], [94, 'new'])
+        self.assertEqual(len(bucket), 14)
+
+    def test_compact(self):
+        self.check_compact(lambda key: len(
+            self.storage.buckets['testHash'][key].values()))
+        # Rows stay in the vectors file
+        self.assertEqual(len(self.storage.vectors), 10)
+        self.storage.delete_vector('testHash', ['a'], 3)
+        self.storage.flush()
+        # Tombstones are persisted
+        storage = MemoryMappedStorage(self.path)
+        self.assertEqual(storage.deleted_count, 5)
+        self.assertEqual([data for v, data
+                          in storage.get_bucket('testHash', 'a')],
+                         [4, 6, 7, 8, 9])
+
 
 class RedisStorageTest(StorageTest):
 
@@ -146,6 +441,22 @@ class RedisStorageTest(StorageTest):
     def test_delete_vector(self):
         self.check_delete_vector(numpy.ones(100))
 
+    def test_store_packed_key(self):
+        self.check_store_packed_key()
+
+    def test_store_postings(self):
+        self.check_store_postings(numpy.random.randn(3, 10))
+
+    def test_get_buckets(self):
+        self.check_get_buckets(numpy.random.randn(3, 10))
+
+    def test_data_bucket_keys(self):
+        # Without index_data there is no reverse index
+        self.storage.store_vector('testHash', '1', numpy.ones(10), 'a')
+        self.assertIsNone(self.storage.get_data_bucket_keys('testHash', 'a'))
+        self.storage.delete_vector('testHash', ['1'], 'a')
+        self.assertEqual(self.storage.get_bucket('testHash', '1'), [])
+
     def test_store_zero(self):
         x = numpy.ones(100)
         hash_name, bucket_name = "tastHash", "testBucket"
@@ -158,6 +469,185 @@ class RedisStorageTest(StorageTest):
         x = numpy.random.randn(100, 10)
         self.check_store_many_vectors(x)
 
+    def test_binary_rows(self):
+        xs = numpy.random.randn(20, 10).astype(numpy.float32)
+        x_data = [None, {'id': 1}, 'a' * 1000] + list(range(17))
+        self.storage.store_many_vectors('testHash', ['1'] * 20, xs, x_data)
+        bucket = self.storage.get_bucket('testHash', '1')
+        self.assertEqual([data for v, data in bucket], x_data)
+        self.assertEqual(bucket[0][0].dtype, numpy.float32)
+        self.assertTrue(numpy.array_equal([v for v, data in bucket], xs))
+
+    def test_pickled_rows(self):
+        # Rows stored by older versions are pickled dicts
+        x = numpy.random.randn(10)
+        row = pickle.dumps({'vector': x.tobytes(), 'dtype': 'float64',
+                            'data': 'old'}, protocol=2)
+        self.storage.redis_object.rpush(
+            self.storage._format_redis_key('testHash', '1'), row)
+        self.storage.store_vector('testHash', '1', x, 'new')
+        bucket = self.storage.get_bucket('testHash', '1')
+        self.assertEqual([data for v, data in bucket], ['old', 'new'])
+        self.assertTrue(numpy.array_equal(bucket[0][0], x))
+        self.storage.delete_vector('testHash', ['1'], 'old')
+        self.assertEqual([data for v, data
+                          in self.storage.get_bucket('testHash', '1')],
+                         ['new'])
+
+class RedisStorageOnceTest(RedisStorageTest):
+
+    def setUp(self):
+        self.redis_object = Redis()
+        self.storage = RedisStorage(self.redis_object, store_vectors_once=True)
+        StorageTest.setUp(self)
+
+    def test_vectors_stored_once(self):
+        xs = numpy.random.randn(2, 10)
+        postings = [('firstHash', '1', 0), ('secondHash', '2', 0),
+                    ('firstHash', '1', 1)]
+        self.storage.store_postings(postings, xs, ['a', 'b'])
+        self.assertEqual(self.redis_object.hlen('nearpy__vectors'), 2)
+        ids = self.storage.get_bucket_ids('firstHash', '1')
+        self.assertEqual([data for v, data in self.storage.get_vectors(ids)],
+                         ['a', 'b'])
+
+        self.storage.delete_vector('firstHash', ['1'], 'a')
+        self.assertEqual(self.redis_object.hlen('nearpy__vectors'), 1)
+        # The id left behind in the other hash is dropped on fetch
+        self.assertEqual(self.storage.get_bucket('secondHash', '2'), [])
+
+    def test_compact(self):
+        self.check_compact(lambda key: self.redis_object.llen(
+            self.storage._format_redis_key('testHash', key)))
+        # Tombstones are dropped once no bucket holds their ids
+        self.assertEqual(self.redis_object.scard('nearpy__deleted'), 0)
+
+    def test_clean_buckets(self):
+        self.check_clean_buckets_once(
+            lambda: self.redis_object.hlen('nearpy__vectors'),
+            lambda: self.redis_object.scard('nearpy__deleted'))
+
+    def test_pickled_rows(self):
+        x = numpy.random.randn(10)
+        row = pickle.dumps({'vector': x.tobytes(), 'dtype': 'float64',
+                            'data': 'old'}, protocol=2)
+        self.redis_object.hset('nearpy__vectors', 1000, row)
+        self.redis_object.rpush(
+            self.storage._format_redis_key('testHash', '1'), 1000)
+        self.storage.store_vector('testHash', '1', x, 'new')
+        bucket = self.storage.get_bucket('testHash', '1')
+        self.assertEqual([data for v, data in bucket], ['old', 'new'])
+        self.assertTrue(numpy.array_equal(bucket[0][0], x))
+
+
+class RedisStorageIndexTest(RedisStorageTest):
+
+    def setUp(self):
+        self.storage = RedisStorage(Redis(), index_data=True)
+        StorageTest.setUp(self)
+
+    def test_data_bucket_keys(self):
+        self.check_data_bucket_keys(numpy.random.randn(3, 10))
+
+    def test_clean_buckets_data_index(self):
+        self.check_clean_buckets_data_index()
+
+
+class RedisStorageOnceIndexTest(RedisStorageOnceTest):
+
+    def setUp(self):
+        self.redis_object = Redis()
+        self.storage = RedisStorage(self.redis_object, store_vectors_once=True,
+                                    index_data=True)
+        StorageTest.setUp(self)
+
+    def test_data_bucket_keys(self):
+        self.check_data_bucket_keys(numpy.random.randn(3, 10))
+
+    def test_clean_buckets_data_index(self):
+        self.check_clean_buckets_data_index()
+
+
+class CachingStorageTest(StorageTest):
+
+    def setUp(self):
+        self.redis_object = Redis()
+        self.storage = CachingStorage(RedisStorage(self.redis_object,
+                                                   index_data=True))
+        super(CachingStorageTest, self).setUp()
+
+    def test_store_vector(self):
+        self.check_store_vector(numpy.random.randn(100))
+
+    def test_store_sparse_vector(self):
+        self.check_store_vector(scipy.sparse.rand(100, 1, density=0.1))
+
+    def test_get_all_bucket_keys(self):
+        self.check_get_all_bucket_keys()
+
+    def test_delete_vector(self):
+        self.check_delete_vector(numpy.ones(100))
+
+    def test_store_packed_key(self):
+        self.check_store_packed_key()
+
+    def test_store_postings(self):
+        self.check_store_postings(numpy.random.randn(3, 10))
+
+    def test_get_buckets(self):
+        self.check_get_buckets(numpy.random.randn(3, 10))
+
+    def test_data_bucket_keys(self):
+        self.check_data_bucket_keys(numpy.random.randn(3, 10))
+
+    def test_store_many_vectors(self):
+        self.check_store_many_vectors(numpy.random.randn(100, 10))
+
+    def test_cache(self):
+        xs = numpy.random.randn(3, 10)
+        self.storage.store_postings([('hash', '1', 0), ('hash', '2', 1)],
+                                    xs[:2], ['a', 'b'])
+        self.storage.get_buckets([('hash', '1'), ('hash', '2')])
+        self.assertEqual((self.storage.hits, self.storage.misses), (0, 2))
+
+        # Cached buckets are returned without asking redis
+        self.redis_object.delete('nearpy_hash_1')
+        self.assertEqual([data for v, data
+                          in self.storage.get_bucket('hash', '1')], ['a'])
+        self.assertEqual((self.storage.hits, self.storage.misses), (1, 2))
+
+        # Storing into a bucket invalidates it
+        self.storage.store_vector('hash', '2', xs[2], 'c')
+        self.assertEqual([data for v, data
+                          in self.storage.get_bucket('hash', '2')], ['b', 'c'])
+        self.storage.delete_vector('hash', ['2'], 'b')
+        self.assertEqual([data for v, data
+                          in self.storage.get_bucket('hash', '2')], ['c'])
+        self.assertEqual((self.storage.hits, self.storage.misses), (1, 4))
+
+    def test_store_vectors_once(self):
+        storage = CachingStorage(RedisStorage(Redis(), store_vectors_once=True))
+        xs = numpy.random.randn(2, 10)
+        storage.store_postings([('hash', '1', 0), ('hash', '1', 1),
+                                ('other', '1', 0)], xs, ['a', 'b'])
+        self.assertFalse(storage.store_vectors_once)
+        self.assertEqual([[data for v, data in bucket] for bucket
+                          in storage.get_buckets([('hash', '1'),
+                                                  ('other', '1')])],
+                         [['a', 'b'], ['a']])
+
+    def test_byte_budget(self):
+        self.storage.max_bytes = 2000
+        for k in range(10):
+            self.storage.store_vector('hash', k, numpy.random.randn(100), k)
+            self.storage.get_bucket('hash', k)
+        self.assertTrue(self.storage.cached_bytes <= 2000)
+        self.assertEqual(len(self.storage.cache), 2)
+        # Least recently used buckets have been removed
+        self.assertEqual([key for _, key in self.storage.cache],
+                         ['8', '9'])
+
+
 class MongoStorageTest(StorageTest):
     def setUp(self):
         self.storage = MongoStorage(mongomock.MongoClient().db.collection)
@@ -177,6 +667,18 @@ class MongoStorageTest(StorageTest):
     def test_delete_vector(self):
         self.check_delete_vector(numpy.ones(100))
 
+    def test_store_packed_key(self):
+        self.check_store_packed_key()
+
+    def test_store_postings(self):
+        self.check_store_postings(numpy.random.randn(3, 10))
+
+    def test_get_buckets(self):
+        self.check_get_buckets(numpy.random.randn(3, 10))
+
+    def test_data_bucket_keys(self):
+        self.check_data_bucket_keys(numpy.random.randn(3, 10))
+
     def test_store_zero(self):
         x = numpy.ones(100)
         hash_name, bucket_name = "tastHash", "testBucket"
@@ -186,5 +688,60 @@ class MongoStorageTest(StorageTest):
         self.assertEqual(data, 0)
 
 
+class MongoStorageOnceTest(MongoStorageTest):
+
+    def setUp(self):
+        self.mongo_object = mongomock.MongoClient().db.collection
+        self.storage = MongoStorage(self.mongo_object, store_vectors_once=True)
+        StorageTest.setUp(self)
+
+    def test_vectors_stored_once(self):
+        xs = numpy.random.randn(2, 10)
+        postings = [('firstHash', '1', 0), ('secondHash', '2', 0),
+                    ('firstHash', '1', 1)]
+        self.storage.store_postings(postings, xs, ['a', 'b'])
+        self.assertEqual(self.mongo_object.count_documents(
+            {'nearpy_vector_id': {'$exists': True}}), 2)
+        ids = self.storage.get_bucket_ids('firstHash', '1')
+        self.assertEqual([data for v, data in self.storage.get_vectors(ids)],
+                         ['a', 'b'])
+
+        self.storage.delete_vector('firstHash', ['1'], 'a')
+        self.assertEqual(self.mongo_object.count_documents(
+            {'nearpy_vector_id': {'$exists': True}}), 1)
+        self.assertEqual(self.storage.get_bucket('secondHash', '2'), [])
+
+    def test_compact(self):
+        def bucket_size(key):
+            return len(self.mongo_object.find_one(
+                {'lsh': self.storage._format_mongo_key('testHash', key)}
+            )['ids'])
+        self.check_compact(bucket_size)
+        # Tombstones are dropped once no bucket holds their ids
+        self.assertEqual(self.mongo_object.count_documents(
+            {'nearpy_tombstone': {'$exists': True}}), 0)
+
+    def test_clean_buckets(self):
+        self.check_clean_buckets_once(
+            lambda: self.mongo_object.count_documents(
+                {'nearpy_vector_id': {'$exists': True}}),
+            lambda: self.mongo_object.count_documents(
+                {'nearpy_tombstone': {'$exists': True}}))
+
+    def test_tombstone_documents(self):
+        xs = numpy.random.randn(3, 5)
+        self.storage.store_postings([('testHash', 'a', row)
+                                     for row in range(3)], xs, list(range(3)))
+        self.storage.delete_vector('testHash', ['a'], 0)
+        self.storage.delete_vector('testHash', ['a'], 2)
+        # Every deleted vector gets a document of its own
+        self.assertEqual(sorted(row['nearpy_tombstone'] for row
+                                in self.mongo_object.find(
+                                    {'nearpy_tombstone': {'$exists': True}})),
+                         [0, 2])
+        self.storage.clean_all_buckets()
+        self.assertEqual(self.mongo_object.count_documents({}), 0)
+
+
 if __name__ == '__main__':
     unittest.main()